@@ -1,15 +1,26 @@
 import itertools
 import logging
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
 import time
 
 import numpy as np
 import scipy as sp
 import scipy.cluster
+import scipy.linalg
+import scipy.sparse
 
 from generative_model import GenerativeModel
 
 ZEROLOGPROB = -1e200
 
+# Upper bound on the number of elements in the (chunksize, nstates)
+# temporaries allocated when observations are processed in chunks.
+MAX_CHUNK_NELEMENTS = 2**20
+
 log = logging.getLogger('gm.gmm')
 
 def almost_equal(actual, desired, decimal=7):
@@ -20,20 +31,42 @@ def logsum(A, axis=None):
     """Computes the sum of A assuming A is in the log domain.
 
     Returns log(sum(exp(A), axis)) while minimizing the possibility of
-    over/underflow.
+    over/underflow.  The sum is always accumulated in double
+    precision, but the result has the same precision as A.
     """
     Amax = A.max(axis)
     if axis and A.ndim > 1:
         shape = list(A.shape)
         shape[axis] = 1
         Amax.shape = shape
-    Asum = np.log(np.sum(np.exp(A - Amax), axis))
+    Asum = np.log(np.sum(np.exp(A - Amax), axis, dtype=np.float64))
+    if A.dtype.kind == 'f' and A.dtype.itemsize < Asum.dtype.itemsize:
+        Asum = Asum.astype(A.dtype)
     Asum += Amax.reshape(Asum.shape)
     if axis:
         # Look out for underflow.
         Asum[np.isnan(Asum)] = -np.Inf
     return Asum
 
+def _logsum_rows_inplace(A, normalize=False):
+    """Equivalent to logsum(A, axis=1) for a 2D array A, but reuses A
+    for the exponentials instead of allocating a temporary.
+
+    A is overwritten with exp(A - A.max(axis=1)), or with the
+    normalized exp(A - logsum(A, axis=1)) if `normalize` is True.
+    """
+    Amax = A.max(axis=1)[:,np.newaxis]
+    A -= Amax
+    np.exp(A, A)
+    Asum = A.sum(axis=1, dtype=np.float64)
+    if normalize:
+        A /= Asum[:,np.newaxis]
+    Asum = np.log(Asum).astype(A.dtype)
+    Asum += Amax[:,0]
+    # Look out for underflow.
+    Asum[np.isnan(Asum)] = -np.Inf
+    return Asum
+
 def normalize(A, axis=None):
     Asum = A.sum(axis)
     if axis and A.ndim > 1:
@@ -44,7 +77,7 @@ def normalize(A, axis=None):
         Asum.shape = shape
     return A / Asum
 
-def lmvnpdf(obs, means, covars, cvtype='diag'):
+def lmvnpdf(obs, means, covars, cvtype='diag', cv_chol=None, dtype=None):
     """Compute the log probability under a multivariate Gaussian distribution.
 
     Parameters
@@ -65,6 +98,21 @@ def lmvnpdf(obs, means, covars, cvtype='diag'):
     cvtype : string
         Type of the covariance parameters.  Must be one of
         'spherical', 'tied', 'diag', 'full'.  Defaults to 'diag'.
+    cv_chol : tuple, optional
+        Cholesky factors and log-determinants of `covars` as returned
+        by `covar_cholesky`.  Only used if `cvtype` is 'tied' or
+        'full', in which case they are computed from `covars` if not
+        given.
+    dtype : numpy dtype
+        If not None, floating point type to do the computation in,
+        e.g. numpy.float32 to halve memory use and bandwidth.  The
+        Cholesky factorization and log-determinants of 'tied' and
+        'full' covars are still computed in double precision.  Note
+        that the 'spherical' and 'diag' kernels expand the squared
+        distance, so single precision loses accuracy when the
+        features are far from zero relative to their standard
+        deviation (center them first).  Defaults to None (use the
+        type of the inputs).
 
     Returns
     -------
@@ -76,10 +124,71 @@ def lmvnpdf(obs, means, covars, cvtype='diag'):
                     'tied': _lmvnpdftied,
                     'diag': _lmvnpdfdiag,
                     'full': _lmvnpdffull}
+    if dtype is not None:
+        obs = np.asarray(obs, dtype=dtype)
+        means = np.asarray(means, dtype=dtype)
+        if cvtype in ('tied', 'full'):
+            if cv_chol is None:
+                cv_chol = covar_cholesky(covars, cvtype)
+            cv_chol = (np.asarray(cv_chol[0], dtype=dtype),
+                       np.asarray(cv_chol[1], dtype=dtype))
+        else:
+            covars = np.asarray(covars, dtype=dtype)
+    if cvtype in ('tied', 'full'):
+        return lmvnpdf_dict[cvtype](obs, means, covars, cv_chol)
     return lmvnpdf_dict[cvtype](obs, means, covars)
 
+def covar_cholesky(covars, cvtype):
+    """Compute the Cholesky factorization of 'tied' or 'full' covars.
 
-def sample_gaussian(mean, covar, cvtype='diag', n=1):
+    Parameters
+    ----------
+    covars : array_like
+        Covariance parameters.  The shape depends on `cvtype`:
+            (D, D)    if 'tied',
+            (C, D, D) if 'full'
+    cvtype : string
+        Type of the covariance parameters.  Must be one of 'tied' or
+        'full'.
+
+    Returns
+    -------
+    cv_chol : array_like
+        Lower triangular Cholesky factors of `covars` (same shape as
+        `covars`).
+    cv_log_det : float or array_like, shape (C,)
+        Log-determinants of `covars`.
+    """
+    if cvtype not in ('tied', 'full'):
+        raise ValueError, "cvtype must be one of 'tied', 'full'"
+    cv_chol = np.linalg.cholesky(covars)
+    cv_log_det = 2 * np.log(np.diagonal(cv_chol, axis1=-2, axis2=-1)).sum(-1)
+    return cv_chol, cv_log_det
+
+def _cached_covar_cholesky(model):
+    """Return `covar_cholesky` of the covars of `model`.
+
+    The factors are stored in `model._cv_chol` and only recomputed
+    after the covars are reassigned: the `covars` setter, and
+    everything else that replaces `model._covars`, resets
+    `model._cv_chol` to None.  Modifying the covars in place is not
+    detected.
+    """
+    if getattr(model, '_cv_chol', None) is None:
+        model._cv_chol = covar_cholesky(model._covars, model._cvtype)
+    return model._cv_chol
+
+def _model_lmvnpdf(model, obs):
+    """Evaluate `lmvnpdf` on the parameters of `model`, reusing its
+    cached Cholesky factors for 'tied' and 'full' covars."""
+    cv_chol = None
+    if model._cvtype in ('tied', 'full'):
+        cv_chol = _cached_covar_cholesky(model)
+    return lmvnpdf(obs, model._means, model._covars, model._cvtype, cv_chol,
+                   model._dtype)
+
+
+def sample_gaussian(mean, covar, cvtype='diag', n=1, random_state=None):
     """Generate random samples from a Gaussian distribution.
 
     Parameters
@@ -96,14 +205,19 @@ def sample_gaussian(mean, covar, cvtype='diag', n=1):
         'spherical', 'tied', 'diag', 'full'.  Defaults to 'diag'.
     n : int
         Number of samples to generate.
+    random_state : None, int or numpy.random.RandomState
+        Source of randomness.  If an int, it is used to seed a new
+        RandomState.  Defaults to None (the global numpy.random
+        state).
 
     Returns
     -------
     obs : array, shape (n, ndim)
         Randomly generated sample
     """
+    rng = _get_random_state(random_state)
     ndim = len(mean)
-    rand = np.random.randn(ndim, n)
+    rand = rng.randn(ndim, n)
     if n == 1:
         rand.shape = (ndim,)
 
@@ -119,6 +233,21 @@ def sample_gaussian(mean, covar, cvtype='diag', n=1):
 
     return (rand.T + mean).T
 
+def _get_random_state(random_state):
+    """Turn `random_state` into an object with the sampling methods of
+    numpy.random.RandomState.
+
+    None gives the numpy.random module, whose functions draw from the
+    global random state.
+    """
+    if random_state is None:
+        return np.random
+    if isinstance(random_state, (int, long, np.integer)):
+        return np.random.RandomState(random_state)
+    if isinstance(random_state, np.random.RandomState):
+        return random_state
+    raise ValueError, 'random_state must be None, an int or a RandomState'
+
 
 class GMM(GenerativeModel):
     """Gaussian Mixture Model
@@ -136,6 +265,8 @@ class GMM(GenerativeModel):
         Dimensionality of the Gaussians.
     nstates : int (read-only)
         Number of states (mixture components).
+    dtype : numpy dtype (read-only)
+        Floating point type used to evaluate the model.
     weights : array, shape (`nstates`,)
         Mixing weights for each mixture component.
     means : array, shape (`nstates`, `ndim`)
@@ -154,6 +285,9 @@ class GMM(GenerativeModel):
     -------
     eval(obs)
         Compute the log likelihood of `obs` under the model.
+    eval_pruned(obs)
+        Approximately compute the log likelihood of `obs` and sparse
+        posteriors using Gaussian selection.
     decode(obs)
         Find most likely mixture components for each point in `obs`.
     rvs(n=1)
@@ -183,7 +317,7 @@ class GMM(GenerativeModel):
     >>> gmm.train(numpy.concatenate((20 * [0], 20 * [10])))
     """
 
-    def __init__(self, nstates=1, ndim=1, cvtype='diag'):
+    def __init__(self, nstates=1, ndim=1, cvtype='diag', dtype=np.float64):
         """Create a Gaussian mixture model
 
         Initializes parameters such that every mixture component has
@@ -199,11 +333,17 @@ class GMM(GenerativeModel):
             String describing the type of covariance parameters to
             use.  Must be one of 'spherical', 'tied', 'diag', 'full'.
             Defaults to 'diag'.
+        dtype : numpy dtype (read-only)
+            Floating point type used to evaluate the model.  Use
+            numpy.float32 to halve the memory use of `eval` for bulk
+            scoring.  Parameters are always estimated in double
+            precision.  Defaults to numpy.float64.
         """
 
         self._nstates = nstates
         self._ndim = ndim
         self._cvtype = cvtype
+        self._dtype = np.dtype(dtype)
 
         self.weights = np.tile(1.0 / nstates, nstates)
         self.means = np.zeros((nstates, ndim))
@@ -226,6 +366,11 @@ class GMM(GenerativeModel):
         """Dimensionality of the mixture components."""
         return self._ndim
 
+    @property
+    def dtype(self):
+        """Floating point type used to evaluate the model."""
+        return self._dtype
+
     @property
     def nstates(self):
         """Number of mixture components in the model."""
@@ -268,8 +413,9 @@ class GMM(GenerativeModel):
         covars = np.asarray(covars)
         _validate_covars(covars, self._cvtype, self._nstates, self._ndim)
         self._covars = covars.copy()
+        self._cv_chol = None
     
-    def eval(self, obs):
+    def eval(self, obs, chunksize=None, out=None):
         """Evaluate the model on data
 
         Compute the log probability of `obs` under the model and
@@ -281,6 +427,16 @@ class GMM(GenerativeModel):
         obs : array_like, shape (n, ndim)
             List of ndim-dimensional data points.  Each row corresponds to a
             single data point.
+        chunksize : int
+            Number of rows of `obs` to evaluate at once.  Temporary
+            memory use is bounded by `chunksize` * `nstates`
+            regardless of n.  Defaults to None, which picks a chunk
+            size automatically.
+        out : tuple
+            Optional preallocated (logprob, posteriors) arrays of
+            shape (n,) and (n, `nstates`) (e.g. memory-mapped arrays)
+            to write the results into.  `posteriors` can be None to
+            skip computing the posteriors.
 
         Returns
         -------
@@ -290,13 +446,21 @@ class GMM(GenerativeModel):
             Posterior probabilities of each mixture component for each
             observation
         """
-        lpr = (lmvnpdf(obs, self._means, self._covars, self._cvtype)
-               + self._log_weights)
-        logprob = logsum(lpr, axis=1)
-        posteriors = np.exp(lpr - logprob[:,np.newaxis])
+        if out is None:
+            out = (np.empty(len(obs), dtype=self._dtype),
+                   np.empty((len(obs), self._nstates), dtype=self._dtype))
+        logprob, posteriors = out
+
+        for start, lpr in self._iter_chunk_log_likelihoods(obs, chunksize):
+            stop = start + len(lpr)
+            if posteriors is None:
+                logprob[start:stop] = _logsum_rows_inplace(lpr)
+            else:
+                logprob[start:stop] = _logsum_rows_inplace(lpr, True)
+                posteriors[start:stop] = lpr
         return logprob, posteriors
 
-    def lpdf(self, obs):
+    def lpdf(self, obs, chunksize=None, out=None):
         """Compute the log probability under the model.
 
         Parameters
@@ -304,16 +468,191 @@ class GMM(GenerativeModel):
         obs : array_like, shape (n, ndim)
             List of ndim-dimensional data points.  Each row corresponds to a
             single data point.
+        chunksize : int
+            Number of rows of `obs` to evaluate at once.  Defaults to
+            None, which picks a chunk size automatically.
+        out : array_like, shape (n,)
+            Optional preallocated array to write the result into.
 
         Returns
         -------
         logprob : array_like, shape (n,)
             Log probabilities of each data point in `obs`
         """
-        logprob, posteriors = self.eval(obs)
+        if out is None:
+            out = np.empty(len(obs), dtype=self._dtype)
+        logprob, posteriors = self.eval(obs, chunksize, (out, None))
         return logprob
 
-    def decode(self, obs):
+    def eval_pruned(self, obs, maxrank=None, beamlogprob=-np.Inf,
+                    nclusters=None, nselect=1, chunksize=None):
+        """Approximately evaluate the model on data using Gaussian
+        selection.
+
+        The mixture components are grouped into `nclusters` clusters
+        by running k-means on their means.  For each observation only
+        the components in the `nselect` clusters that best match it
+        are evaluated; the others are assumed to have zero posterior
+        probability.  Of the evaluated components, only the top
+        `maxrank` within `beamlogprob` of the best one are kept in the
+        posteriors.  This is much faster than `eval` for models with
+        many components, since only a handful of them carry
+        significant posterior mass for any single observation.
+
+        Parameters
+        ----------
+        obs : array_like, shape (n, ndim)
+            List of ndim-dimensional data points.  Each row corresponds to a
+            single data point.
+        maxrank : int
+            Maximum number of components with non-zero posterior
+            probability for each observation.  Defaults to None (keep
+            all evaluated components).
+        beamlogprob : float
+            Only keep components whose weighted log likelihood is
+            within `beamlogprob` of the best component.  Defaults to
+            -numpy.Inf (no beam pruning).
+        nclusters : int
+            Number of clusters in the Gaussian selection index.  The
+            index is cached until the means are reassigned.  Defaults
+            to None (sqrt(`nstates`) clusters).
+        nselect : int
+            Number of clusters to evaluate for each observation.
+            Defaults to 1.
+        chunksize : int
+            Number of rows of `obs` to evaluate at once.  Defaults to
+            None, which picks a chunk size automatically.
+
+        Returns
+        -------
+        logprob : array_like, shape (n,)
+            Approximate log probabilities of each data point in `obs`,
+            summed over all evaluated components.
+        posteriors: scipy.sparse.csr_matrix, shape (n, nstates)
+            Posterior probabilities of the kept mixture components for
+            each observation, normalized to sum to one.
+
+        See Also
+        --------
+        eval : Exactly evaluate the model on data.
+        """
+        if nclusters is None:
+            nclusters = int(np.ceil(np.sqrt(self._nstates)))
+        centroids, cluster_covars, members = self._cached_selection_index(
+            nclusters)
+        nselect = min(nselect, len(members))
+        maxsize = max(len(x) for x in members)
+        if chunksize is None:
+            chunksize = _get_chunksize(nselect * maxsize, self._ndim)
+
+        log_weights = self._log_weights.astype(self._dtype)
+        cv_chol = None
+        if self._cvtype in ('tied', 'full'):
+            cv_chol = _cached_covar_cholesky(self)
+
+        logprob = np.empty(len(obs), dtype=self._dtype)
+        posteriors = []
+        for start in xrange(0, len(obs), chunksize):
+            chunk = np.asarray(obs[start:start+chunksize])
+            nobs = len(chunk)
+
+            # Find the best matching clusters for each observation.
+            cluster_lpr = lmvnpdf(chunk, centroids, cluster_covars, 'diag',
+                                  dtype=self._dtype)
+            selected = np.argpartition(-cluster_lpr, nselect - 1,
+                                       axis=1)[:,:nselect]
+
+            # Evaluate every component in the selected clusters.
+            cand_lpr = np.empty((nobs, nselect * maxsize), dtype=self._dtype)
+            cand_lpr[:] = -np.Inf
+            cand_idx = np.zeros((nobs, nselect * maxsize), dtype=np.int)
+            for s in xrange(nselect):
+                for k, comps in enumerate(members):
+                    rows = np.flatnonzero(selected[:,s] == k)
+                    if len(rows) == 0:
+                        continue
+                    cols = s * maxsize + np.arange(len(comps))
+                    cand_lpr[rows[:,np.newaxis], cols] = (
+                        self._lmvnpdf_components(chunk[rows], comps, cv_chol)
+                        + log_weights[comps])
+                    cand_idx[rows[:,np.newaxis], cols] = comps
+            logprob[start:start+nobs] = logsum(cand_lpr, axis=1)
+
+            # Rank and beam pruning.
+            if maxrank is not None and maxrank < cand_lpr.shape[1]:
+                top = np.argpartition(-cand_lpr, maxrank - 1,
+                                      axis=1)[:,:maxrank]
+                rows = np.arange(nobs)[:,np.newaxis]
+                cand_lpr = cand_lpr[rows, top]
+                cand_idx = cand_idx[rows, top]
+            keep = ((cand_lpr >= cand_lpr.max(axis=1)[:,np.newaxis]
+                     + beamlogprob) & (cand_lpr > -np.Inf))
+            cand_lpr[~keep] = -np.Inf
+            _logsum_rows_inplace(cand_lpr, True)
+
+            rows, cols = np.nonzero(keep)
+            posteriors.append(sp.sparse.csr_matrix(
+                (cand_lpr[rows, cols], (rows, cand_idx[rows, cols])),
+                shape=(nobs, self._nstates)))
+        if posteriors:
+            posteriors = sp.sparse.vstack(posteriors, format='csr')
+        else:
+            posteriors = sp.sparse.csr_matrix((0, self._nstates),
+                                              dtype=self._dtype)
+        return logprob, posteriors
+
+    def _lmvnpdf_components(self, obs, comps, cv_chol=None):
+        """Evaluate lmvnpdf on the subset `comps` of the mixture
+        components."""
+        if self._cvtype == 'tied':
+            return lmvnpdf(obs, self._means[comps], self._covars, 'tied',
+                           cv_chol, self._dtype)
+        if self._cvtype == 'full':
+            cv_chol = (cv_chol[0][comps], cv_chol[1][comps])
+        return lmvnpdf(obs, self._means[comps], self._covars[comps],
+                       self._cvtype, cv_chol, self._dtype)
+
+    def _cached_selection_index(self, nclusters):
+        """Return the Gaussian selection index used by `eval_pruned`.
+
+        Returns the centroids and diagonal covariances of each cluster
+        of mixture components and the list of components in each
+        cluster.  The index is cached until the means or covariances
+        are reassigned.
+        """
+        cache = getattr(self, '_selection_index_cache', None)
+        if (cache is not None and cache[0] is self._means
+            and cache[1] is self._covars and cache[2] == nclusters):
+            return cache[3]
+
+        nclusters = min(nclusters, self._nstates)
+        if self._cvtype == 'spherical':
+            diag_covars = np.tile(self._covars[:,np.newaxis], (1, self._ndim))
+        elif self._cvtype == 'tied':
+            diag_covars = np.tile(np.diag(self._covars), (self._nstates, 1))
+        elif self._cvtype == 'diag':
+            diag_covars = self._covars
+        elif self._cvtype == 'full':
+            diag_covars = np.diagonal(self._covars, axis1=1, axis2=2)
+
+        # Start k-means from evenly spaced components so that the
+        # index does not depend on the random state.
+        means = np.asarray(self._means, dtype=np.float64)
+        init = means[np.linspace(0, self._nstates - 1, nclusters).astype(int)]
+        tmp, labels = sp.cluster.vq.kmeans2(means, init, minit='matrix')
+        members = [np.flatnonzero(labels == k) for k in xrange(nclusters)]
+        members = [x for x in members if len(x) > 0]
+        centroids = np.array([means[x].mean(axis=0) for x in members])
+        cluster_covars = np.array(
+            [(diag_covars[x] + (means[x] - mu)**2).mean(axis=0)
+             for x, mu in itertools.izip(members, centroids)])
+
+        index = (centroids, cluster_covars, members)
+        self._selection_index_cache = (self._means, self._covars, nclusters,
+                                       index)
+        return index
+
+    def decode(self, obs, chunksize=None):
         """Find most likely mixture components for each point in `obs`.
 
         Parameters
@@ -321,54 +660,103 @@ class GMM(GenerativeModel):
         obs : array_like, shape (n, ndim)
             List of ndim-dimensional data points.  Each row corresponds to a
             single data point.
+        chunksize : int
+            Number of rows of `obs` to evaluate at once.  Defaults to
+            None, which picks a chunk size automatically.
 
         Returns
         -------
+        logprob : array_like, shape (n,)
+            Log probabilities of each data point in `obs`
         components : array_like, shape (n,)
             Index of the most likelihod mixture components for each observation
         """
-        logprob, posteriors = self.eval(obs)
-        return logprob, posteriors.argmax(axis=1)
+        logprob = np.empty(len(obs), dtype=self._dtype)
+        components = np.empty(len(obs), dtype=np.int)
+        for start, lpr in self._iter_chunk_log_likelihoods(obs, chunksize):
+            stop = start + len(lpr)
+            # The most likely component has the largest weighted
+            # likelihood, so there is no need for the posteriors.
+            components[start:stop] = lpr.argmax(axis=1)
+            logprob[start:stop] = _logsum_rows_inplace(lpr)
+        return logprob, components
+
+    def _iter_chunk_log_likelihoods(self, obs, chunksize=None):
+        """Yield (start, lpr) for consecutive chunks of `obs`, where
+        lpr holds the weighted log likelihoods of each mixture
+        component for obs[start:start+len(lpr)]."""
+        if chunksize is None:
+            chunksize = _get_chunksize(self._nstates, self._ndim)
+        log_weights = self._log_weights.astype(self._dtype)
+        for start in xrange(0, len(obs), chunksize):
+            chunk = np.asarray(obs[start:start+chunksize])
+            lpr = _model_lmvnpdf(self, chunk)
+            lpr += log_weights
+            yield start, lpr
         
-    def rvs(self, n=1):
+    def rvs(self, n=1, random_state=None):
         """Generate random samples from the model.
 
         Parameters
         ----------
         n : int
             Number of samples to generate.
+        random_state : None, int or numpy.random.RandomState
+            Source of randomness.  If an int, it is used to seed a new
+            RandomState so that independent generators are
+            reproducible.  Defaults to None (the global numpy.random
+            state).
 
         Returns
         -------
         obs : array_like, shape (n, ndim)
             List of samples
         """
-        weight_pdf = self.weights
-        weight_cdf = np.cumsum(weight_pdf)
-
-        obs = np.empty((n, self._ndim))
-        for x in xrange(n):
-            rand = np.random.rand()
-            c = (weight_cdf > rand).argmax()
-            if self._cvtype == 'tied':
-                cv = self._covars
-            else:
-                cv = self._covars[c]
-            obs[x] = sample_gaussian(self._means[c], cv, self._cvtype)
+        rng = _get_random_state(random_state)
+        weight_cdf = np.cumsum(self.weights)
+
+        # Draw the mixture component for every sample at once.
+        comps = weight_cdf.searchsorted(rng.rand(n), side='right')
+        comps = np.minimum(comps, self._nstates - 1)
+        rand = rng.randn(n, self._ndim)
+
+        if self._cvtype == 'spherical':
+            obs = rand * np.sqrt(self._covars[comps])[:,np.newaxis]
+        elif self._cvtype == 'diag':
+            obs = rand * np.sqrt(self._covars[comps])
+        elif self._cvtype == 'tied':
+            chol, log_det = _cached_covar_cholesky(self)
+            obs = np.dot(rand, chol.T)
+        elif self._cvtype == 'full':
+            chols, log_dets = _cached_covar_cholesky(self)
+            obs = np.empty((n, self._ndim))
+            for c in np.unique(comps):
+                idx = comps == c
+                obs[idx] = np.dot(rand[idx], chols[c].T)
+        obs += self._means[comps]
         return obs
 
-    def init(self, obs, params='wmc', **kwargs):
+    def init(self, obs, params='wmc', chunksize=None, **kwargs):
         """Initialize model parameters from data using the k-means algorithm
 
         Parameters
         ----------
         obs : array_like, shape (n, ndim)
             List of ndim-dimensional data points.  Each row corresponds to a
-            single data point.
+            single data point.  Can be a memory-mapped array
+            (e.g. from numpy.load(filename, mmap_mode='r')).
         params : string
             Controls which parameters are updated in the training
             process.  Can contain any combination of 'w' for weights,
             'm' for means, and 'c' for covars.  Defaults to 'wmc'.
+        chunksize : int
+            If not None, never load more than `chunksize` rows of
+            `obs` into memory at once.  The covariance is accumulated
+            chunk by chunk and the k-means algorithm is run on a
+            random subset of `chunksize` rows.  Defaults to None,
+            which uses all of `obs` at once unless it is a
+            memory-mapped array, in which case a chunk size is chosen
+            automatically.
         **kwargs :
             Keyword arguments to pass through to the k-means function 
             (scipy.cluster.vq.kmeans2)
@@ -377,20 +765,31 @@ class GMM(GenerativeModel):
         --------
         scipy.cluster.vq.kmeans2
         """
+        if chunksize is None and isinstance(obs, np.memmap):
+            chunksize = _get_chunksize(self._nstates, self._ndim)
         
         if 'm' in params:
-            self._means, tmp = sp.cluster.vq.kmeans2(obs, self._nstates,
+            kmeans_obs = obs
+            if chunksize is not None and len(obs) > chunksize:
+                idx = _sample_indices(len(obs), chunksize)
+                kmeans_obs = np.asarray(obs[idx])
+            self._means, tmp = sp.cluster.vq.kmeans2(kmeans_obs, self._nstates,
                                                      **kwargs)
         if 'w' in params:
             self.weights = np.tile(1.0 / self._nstates, self._nstates)
         if 'c' in params:
-            cv = np.cov(obs.T)
+            if chunksize is None:
+                cv = np.cov(obs.T)
+            else:
+                cv = _chunked_cov(obs, chunksize)
             if not cv.shape:
                 cv.shape = (1, 1)
             self._covars = _distribute_covar_matrix_to_match_cvtype(
                 cv, self._cvtype, self._nstates)
+            self._cv_chol = None
 
-    def train(self, obs, iter=10, min_covar=1.0, thresh=1e-2, params='wmc'):
+    def train(self, obs, iter=10, min_covar=1.0, thresh=1e-2, params='wmc',
+              chunksize=None, n_jobs=1):
         """Estimate model parameters with the expectation-maximization
         algorithm.
 
@@ -398,7 +797,8 @@ class GMM(GenerativeModel):
         ----------
         obs : array_like, shape (n, ndim)
             List of ndim-dimensional data points.  Each row corresponds to a
-            single data point.
+            single data point.  Can be a memory-mapped array
+            (e.g. from numpy.load(filename, mmap_mode='r')).
         iter : int
             Number of EM iterations to perform.
         min_covar : float
@@ -410,53 +810,287 @@ class GMM(GenerativeModel):
             Controls which parameters are updated in the training
             process.  Can contain any combination of 'w' for weights,
             'm' for means, and 'c' for covars.  Defaults to 'wmc'.
+        chunksize : int
+            Number of rows of `obs` to process at once in the
+            expectation step.  The sufficient statistics are
+            accumulated chunk by chunk, so memory use is bounded by
+            `chunksize` * `nstates` instead of n * `nstates`.  The
+            result is the same as processing `obs` all at once (up to
+            rounding).  Defaults to None, which picks a chunk size
+            automatically.
+        n_jobs : int
+            Number of worker processes to use for the expectation
+            step.  `obs` is split into `n_jobs` contiguous shards, each
+            worker accumulates the sufficient statistics of its shard,
+            and the results are summed before the maximization step.
+            The shards are shared with the workers through a
+            memory-mapped file (`obs` itself if it is already
+            memory-mapped) instead of being sent every iteration.
+            Defaults to 1 (no worker processes).
 
         Returns
         -------
         logprob : list
             Log probabilities of each data point in `obs` for each iteration
         """
-        covar_mstep_fun = {'spherical': _covar_mstep_spherical,
-                           'diag': _covar_mstep_diag,
-                           #'tied': _covar_mstep_tied,
-                           #'full': _covar_mstep_full,
-                           'tied': _covar_mstep_slow,
-                           'full': _covar_mstep_slow,
-                           }[self._cvtype]
+        if chunksize is None:
+            chunksize = _get_chunksize(self._nstates, self._ndim)
+
+        pool = None
+        tmpdir = None
+        try:
+            if n_jobs > 1:
+                tmpdir = tempfile.mkdtemp(prefix='gmm')
+                pool = multiprocessing.Pool(
+                    n_jobs, _init_estep_worker, _share_obs(obs, tmpdir))
+                bounds = np.linspace(0, len(obs), n_jobs + 1).astype(int)
+
+            T = time.time()
+            logprob = []
+            for i in xrange(iter):
+                # Expectation step
+                if pool is None:
+                    curr_logprob, stats = self._compute_sufficient_statistics(
+                        obs, params, chunksize)
+                else:
+                    results = pool.map(_estep_worker,
+                                       [(self, bounds[j], bounds[j+1], params,
+                                         chunksize) for j in xrange(n_jobs)])
+                    curr_logprob, stats = results[0]
+                    for worker_logprob, worker_stats in results[1:]:
+                        curr_logprob += worker_logprob
+                        for key in stats:
+                            stats[key] += worker_stats[key]
+                logprob.append(curr_logprob)
+
+                currT = time.time()
+                log.info('Iteration %d: log likelihood = %f (took %f seconds).'
+                          % (i, logprob[-1], currT - T))
+                T = currT
+
+
+                # Check for convergence.
+                if i > 0 and abs(logprob[-1] - logprob[-2]) < thresh:
+                    log.info('Converged at iteration %d.' % i)
+                    break
+
+                # Maximization step
+                self._do_mstep(stats, params, min_covar)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir)
+
+        return logprob
+
+    def train_online(self, obs_chunks, min_covar=1.0, params='wmc',
+                     stepsize=0.6, reset=False):
+        """Estimate model parameters with stepwise (online) EM.
+
+        Processes `obs_chunks` one chunk at a time.  The sufficient
+        statistics of each chunk (normalized by its length) are
+        interpolated into running statistics,
+            s_k = (1 - eta_k) * s_{k-1} + eta_k * s(chunk_k),
+        and the parameters are re-estimated from the running
+        statistics after every chunk.  The running statistics are
+        kept on the model, so later calls continue from where the
+        previous one stopped without rescanning earlier data.
+
+        Parameters
+        ----------
+        obs_chunks : iterable
+            Iterable (e.g. generator) of array_like observation
+            chunks, each of shape (n_k, ndim).
+        min_covar : float
+            Floor on the diagonal of the covariance matrix to prevent
+            overfitting.  Defaults to 1.0.
+        params : string
+            Controls which parameters are updated in the training
+            process.  Can contain any combination of 'w' for weights,
+            'm' for means, and 'c' for covars.  Defaults to 'wmc'.
+        stepsize : float or callable
+            Step-size schedule.  If a float `alpha` in (0.5, 1], the
+            step size for the k-th chunk is eta_k = (k + 1)**-alpha.
+            If callable, eta_k = stepsize(k).  k counts every chunk
+            processed since the running statistics were last reset.
+            Defaults to 0.6.
+        reset : bool
+            If True, discard the running statistics accumulated by
+            previous calls and start over with k = 0.  Defaults to
+            False.
+
+        Returns
+        -------
+        logprob : list
+            Log probability of each chunk under the model before it
+            was used to update the parameters.
+        """
+        if not callable(stepsize):
+            if not 0.5 < stepsize <= 1:
+                raise ValueError, 'stepsize must be in (0.5, 1]'
+            alpha = stepsize
+            stepsize = lambda k: (k + 1.0)**-alpha
+
+        if reset or getattr(self, '_online_state', None) is None:
+            self._online_state = (None, 0)
+        running_stats, k = self._online_state
 
-        T = time.time()
         logprob = []
-        for i in xrange(iter):
-            # Expectation step
+        for obs in obs_chunks:
+            obs = np.asarray(obs)
+            if len(obs) == 0:
+                continue
             curr_logprob, posteriors = self.eval(obs)
             logprob.append(curr_logprob.sum())
 
-            currT = time.time()
-            log.info('Iteration %d: log likelihood = %f (took %f seconds).'
-                      % (i, logprob[-1], currT - T))
-            T = currT
-
-
-            # Check for convergence.
-            if i > 0 and abs(logprob[-1] - logprob[-2]) < thresh:
-                log.info('Converged at iteration %d.' % i)
-                break
-
-            # Maximization step
-            w = posteriors.sum(axis=0)
-            avg_obs = np.dot(posteriors.T, obs)
-            norm = 1.0 / w[:,np.newaxis]
-            
-            if 'w' in params:
-                self.weights = w / w.sum()
-            if 'm' in params:
-                self._means = avg_obs * norm
-            if 'c' in params:
-                self._covars = covar_mstep_fun(self, obs, posteriors,
-                                               avg_obs, norm, min_covar)
+            stats = self._initialize_sufficient_statistics()
+            self._accumulate_sufficient_statistics(stats, obs, posteriors,
+                                                   params)
+            eta = stepsize(k)
+            if running_stats is None:
+                running_stats = dict((key, val * (eta / len(obs)))
+                                     for key, val in stats.iteritems())
+            else:
+                for key in running_stats:
+                    running_stats[key] *= 1.0 - eta
+                    running_stats[key] += stats[key] * (eta / len(obs))
+            self._do_mstep(running_stats, params, min_covar)
+            k += 1
+            self._online_state = (running_stats, k)
+
+            log.info('Chunk %d: log likelihood = %f (step size %f).'
+                     % (k - 1, logprob[-1], eta))
 
         return logprob
 
+    def _compute_sufficient_statistics(self, obs, params, chunksize):
+        """Run the expectation step over `obs`, `chunksize` rows at a
+        time.
+
+        Returns the total log probability of `obs` and the
+        accumulated sufficient statistics.
+        """
+        logprob = 0.0
+        stats = self._initialize_sufficient_statistics()
+        for chunk in _iter_chunks(obs, chunksize):
+            curr_logprob, posteriors = self.eval(chunk)
+            logprob += curr_logprob.sum()
+            self._accumulate_sufficient_statistics(stats, chunk, posteriors,
+                                                   params)
+        return logprob, stats
+
+    def _initialize_sufficient_statistics(self):
+        stats = {'post': np.zeros(self._nstates),
+                 'obs':  np.zeros((self._nstates, self._ndim))}
+        if self._cvtype in ('spherical', 'diag'):
+            stats['obs**2'] = np.zeros((self._nstates, self._ndim))
+        elif self._cvtype == 'tied':
+            stats['obs*obs.T'] = np.zeros((self._ndim, self._ndim))
+        elif self._cvtype == 'full':
+            stats['obs*obs.T'] = np.zeros((self._nstates, self._ndim,
+                                           self._ndim))
+        return stats
+
+    def _accumulate_sufficient_statistics(self, stats, obs, posteriors,
+                                          params):
+        stats['post'] += posteriors.sum(axis=0)
+        if 'm' in params or 'c' in params:
+            stats['obs'] += np.dot(posteriors.T, obs)
+        if 'c' in params:
+            if self._cvtype in ('spherical', 'diag'):
+                stats['obs**2'] += np.dot(posteriors.T, obs**2)
+            elif self._cvtype == 'tied':
+                stats['obs*obs.T'] += np.dot(obs.T * posteriors.sum(axis=1),
+                                             obs)
+            elif self._cvtype == 'full':
+                stats['obs*obs.T'] += _weighted_scatter(obs, posteriors)
+
+    def _do_mstep(self, stats, params, min_covar):
+        covar_mstep_fun = {'spherical': _covar_mstep_spherical,
+                           'diag': _covar_mstep_diag,
+                           'tied': _covar_mstep_tied,
+                           'full': _covar_mstep_full,
+                           }[self._cvtype]
+
+        w = stats['post']
+        norm = 1.0 / w[:,np.newaxis]
+        if 'w' in params:
+            self.weights = w / w.sum()
+        if 'm' in params:
+            self._means = stats['obs'] * norm
+        if 'c' in params:
+            self._covars = covar_mstep_fun(self, stats, norm, min_covar)
+            self._cv_chol = None
+
+
+def _get_chunksize(nstates, ndim):
+    """Number of observations to process at once so that temporaries
+    stay below MAX_CHUNK_NELEMENTS elements."""
+    return max(1, MAX_CHUNK_NELEMENTS // max(nstates, ndim))
+
+def _sample_indices(n, k):
+    """Draw `k` distinct indices from xrange(n) in sorted order.
+
+    Unlike np.random.permutation(n)[:k], this takes O(k) memory unless
+    `k` is more than half of `n`.
+    """
+    if 2 * k > n:
+        return np.sort(np.random.permutation(n)[:k])
+    idx = np.unique(np.random.randint(0, n, k))
+    while len(idx) < k:
+        idx = np.union1d(idx, np.random.randint(0, n, k - len(idx)))
+    return idx
+
+def _iter_chunks(obs, chunksize):
+    """Iterate over consecutive blocks of at most `chunksize` rows of
+    `obs`, loading each one into memory."""
+    for start in xrange(0, len(obs), chunksize):
+        yield np.asarray(obs[start:start+chunksize])
+
+# Observations shared with the worker processes of GMM.train.
+_worker_obs = None
+
+def _share_obs(obs, tmpdir):
+    """Return the arguments to `_init_estep_worker` needed to map
+    `obs` into a worker process.
+
+    Memory-mapped arrays are shared through their own file, anything
+    else is written once to a temporary .npy file in `tmpdir`.
+    """
+    if not (isinstance(obs, np.memmap) and isinstance(obs.base, mmap.mmap)
+            and (obs.flags.c_contiguous or obs.flags.f_contiguous)):
+        obs = np.asarray(obs)
+        mmobs = np.lib.format.open_memmap(os.path.join(tmpdir, 'obs.npy'),
+                                          mode='w+', dtype=obs.dtype,
+                                          shape=obs.shape)
+        mmobs[:] = obs
+        mmobs.flush()
+        obs = mmobs
+    order = 'C' if obs.flags.c_contiguous else 'F'
+    return (obs.filename, obs.dtype, obs.shape, obs.offset, order)
+
+def _init_estep_worker(filename, dtype, shape, offset, order):
+    global _worker_obs
+    _worker_obs = np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                            offset=offset, order=order)
+
+def _estep_worker(args):
+    model, start, stop, params, chunksize = args
+    return model._compute_sufficient_statistics(_worker_obs[start:stop],
+                                                params, chunksize)
+
+def _chunked_cov(obs, chunksize):
+    """Equivalent to numpy.cov(obs.T), but only loads `chunksize` rows
+    of `obs` into memory at once."""
+    nobs = len(obs)
+    mean = sum(x.sum(axis=0) for x in _iter_chunks(obs, chunksize)) / nobs
+    scatter = 0
+    for x in _iter_chunks(obs, chunksize):
+        x = x - mean
+        scatter += np.dot(x.T, x)
+    return np.squeeze(scatter / (nobs - 1.0))
 
 def _lmvnpdfdiag(obs, means=0.0, covars=1.0):
     nobs, ndim = obs.shape
@@ -475,31 +1109,37 @@ def _lmvnpdfspherical(obs, means=0.0, covars=1.0):
         cv = cv[:,np.newaxis]
     return _lmvnpdfdiag(obs, means, np.tile(cv, (1, obs.shape[-1])))
 
-def _lmvnpdftied(obs, means, covars):
+def _lmvnpdftied(obs, means, covars, cv_chol=None):
+    obs = np.asarray(obs)
     nobs, ndim = obs.shape
-    nmix = len(means)
-    # (x-y).T A (x-y) = x.T A x - 2x.T A y + y.T A y
-    icv = np.linalg.inv(covars)
-    lpr = -0.5 * (ndim * np.log(2 * np.pi) + np.log(np.linalg.det(covars))
-                  + np.sum(obs * np.dot(obs, icv), 1)[:,np.newaxis]
-                  - 2 * np.dot(np.dot(obs, icv), means.T)
-                  + np.sum(means * np.dot(means, icv), 1))
+    if cv_chol is None:
+        cv_chol = covar_cholesky(covars, 'tied')
+    chol, log_det = cv_chol
+    # (x-y).T A (x-y) = |L^-1 x|^2 - 2 (L^-1 x).T (L^-1 y) + |L^-1 y|^2
+    # where A^-1 = L L.T
+    sol_obs = sp.linalg.solve_triangular(chol, obs.T, lower=True)
+    sol_means = sp.linalg.solve_triangular(chol, means.T, lower=True)
+    lpr = -0.5 * (ndim * np.log(2 * np.pi) + log_det
+                  + np.sum(sol_obs**2, 0)[:,np.newaxis]
+                  - 2 * np.dot(sol_obs.T, sol_means)
+                  + np.sum(sol_means**2, 0))
     return lpr
 
-def _lmvnpdffull(obs, means, covars):
-    # FIXME: this representation of covars is going to lose for caching
+def _lmvnpdffull(obs, means, covars, cv_chol=None):
+    obs = np.asarray(obs)
     nobs, ndim = obs.shape
     nmix = len(means)
-    lpr = np.empty((nobs,nmix))
-    for c, (mu, cv) in enumerate(itertools.izip(means, covars)):
-        icv = np.linalg.inv(cv)
-        lpr[:,c] = -0.5 * (ndim * np.log(2 * np.pi) + np.log(np.linalg.det(cv)))
-        for o, currobs in enumerate(obs):
-            dzm = (currobs - mu)
-            lpr[o,c] += -0.5 * np.dot(np.dot(dzm, icv), dzm.T)
-        #dzm = (obs - mu)
-        #lpr[:,c] = -0.5 * (np.dot(np.dot(dzm, np.linalg.inv(cv)), dzm.T)
-        #                   + np.log(2 * np.pi) + np.linalg.det(cv)).diagonal()
+    if cv_chol is None:
+        cv_chol = covar_cholesky(covars, 'full')
+    chols, log_dets = cv_chol
+    lpr = np.empty((nobs, nmix), dtype=np.result_type(obs, chols))
+    for c, (mu, chol) in enumerate(itertools.izip(means, chols)):
+        # Mahalanobis distance of every observation at once:
+        # |L^-1 (x - mu)|^2 where cv = L L.T.
+        sol = sp.linalg.solve_triangular(chol, (obs - mu).T, lower=True)
+        lpr[:,c] = np.sum(sol**2, 0)
+    lpr += ndim * np.log(2 * np.pi) + log_dets
+    lpr *= -0.5
     return lpr
 
 def _validate_covars(covars, cvtype, nmix, ndim):
@@ -545,7 +1185,7 @@ def _distribute_covar_matrix_to_match_cvtype(tiedcv, cvtype, nstates):
                "cvtype must be one of 'spherical', 'tied', 'diag', 'full'")
     return cv
 
-def _covar_mstep_diag(gmm, obs, posteriors, avg_obs, norm, min_covar):
+def _covar_mstep_diag(gmm, stats, norm, min_covar):
     # For column vectors:
     # covars_c = average((obs(t) - means_c) (obs(t) - means_c).T,
     #                    weights_c)
@@ -554,59 +1194,48 @@ def _covar_mstep_diag(gmm, obs, posteriors, avg_obs, norm, min_covar):
     #
     # But everything here is a row vector, so all of the
     # above needs to be transposed.
-    avg_obs2 = np.dot(posteriors.T, obs * obs) * norm
+    avg_obs2 = stats['obs**2'] * norm
     avg_means2 = gmm._means**2 
-    avg_obs_means = gmm._means * avg_obs * norm
+    avg_obs_means = gmm._means * stats['obs'] * norm
     return avg_obs2 - 2 * avg_obs_means + avg_means2 + min_covar
 
 def _covar_mstep_spherical(*args):
     return _covar_mstep_diag(*args).mean(axis=1)
 
-def _covar_mstep_full(gmm, obs, posteriors, avg_obs, norm, min_covar):
-    print "THIS IS BROKEN"
+def _weighted_scatter(obs, posteriors):
+    """Compute the posterior weighted scatter matrices of `obs`.
+
+    Returns an array of shape (nstates, ndim, ndim) whose c-th element
+    is sum_t posteriors[t,c] * outer(obs[t], obs[t]).
+    """
+    nobs, ndim = obs.shape
+    nstates = posteriors.shape[1]
+    # A single matrix product per chunk of frames:
+    # (ndim, n) x (n, nstates * ndim) -> (ndim, nstates, ndim).
+    scatter = np.zeros((ndim, nstates * ndim))
+    chunksize = max(1, MAX_CHUNK_NELEMENTS // (nstates * ndim))
+    for start in xrange(0, nobs, chunksize):
+        o = obs[start:start+chunksize]
+        weighted = (posteriors[start:start+chunksize,:,np.newaxis]
+                    * o[:,np.newaxis,:])
+        scatter += np.dot(o.T, weighted.reshape((len(o), nstates * ndim)))
+    return scatter.reshape((ndim, nstates, ndim)).transpose(1, 0, 2)
+
+def _covar_mstep_full(gmm, stats, norm, min_covar):
     # Eq. 12 from K. Murphy, "Fitting a Conditional Linear Gaussian
     # Distribution"
-    avg_obs2 = np.dot(obs.T, obs)
-    #avg_obs2 = np.dot(obs.T, avg_obs)
-    cv = np.empty((gmm._nstates, gmm._ndim, gmm._ndim))
-    for c in xrange(gmm._nstates):
-        wobs = obs.T * posteriors[:,c]
-        avg_obs2 = np.dot(wobs, obs) / posteriors[:,c].sum()
-        mu = gmm._means[c][np.newaxis]
-        cv[c] = (avg_obs2 - np.dot(mu, mu.T)
-                 + min_covar * np.eye(gmm._ndim))
-    return cv
-
-def _covar_mstep_tied2(*args):
-    return _covar_mstep_full(*args).mean(axis=0)
-
-def _covar_mstep_tied(gmm, obs, posteriors, avg_obs, norm, min_covar):
-    print "THIS IS BROKEN"
+    avg_obs2 = stats['obs*obs.T'] * norm[:,:,np.newaxis]
+    obsmean = ((stats['obs'] * norm)[:,:,np.newaxis]
+               * gmm._means[:,np.newaxis,:])
+    avg_means2 = gmm._means[:,:,np.newaxis] * gmm._means[:,np.newaxis,:]
+    return (avg_obs2 - obsmean - obsmean.transpose(0, 2, 1) + avg_means2
+            + min_covar * np.eye(gmm._ndim))
+
+def _covar_mstep_tied(gmm, stats, norm, min_covar):
     # Eq. 15 from K. Murphy, "Fitting a Conditional Linear Gaussian
     # Distribution"
-    avg_obs2 = np.dot(obs.T, obs)
-    avg_means2 = np.dot(gmm._means.T, gmm._means)
-    return (avg_obs2 - avg_means2 + min_covar * np.eye(gmm._ndim))
-
-def _covar_mstep_slow(gmm, obs, posteriors, avg_obs, norm, min_covar):
-    w = posteriors.sum(axis=0)
-    covars = np.zeros(gmm.covars.shape)
-    for c in xrange(gmm._nstates):
-        mu = gmm._means[c]
-        #cv = np.dot(mu.T, mu)
-        avg_obs2 = np.zeros((gmm._ndim, gmm._ndim))
-        for t,o in enumerate(obs):
-            avg_obs2 += posteriors[t,c] * np.outer(o, o)
-        cv = (avg_obs2 / w[c]
-              - 2 * np.outer(avg_obs[c] / w[c], mu)
-              + np.outer(mu, mu)
-              + min_covar * np.eye(gmm._ndim))
-        if gmm.cvtype == 'spherical':
-            covars[c] = np.diag(cv).mean()
-        elif gmm.cvtype == 'diag':
-            covars[c] = np.diag(cv)
-        elif gmm.cvtype == 'full':
-            covars[c] = cv
-        elif gmm.cvtype == 'tied':
-            covars += cv / gmm._nstates
-    return covars
+    w = stats['post'][:,np.newaxis]
+    obsmean = np.dot(stats['obs'].T, gmm._means)
+    avg_means2 = np.dot((gmm._means * w).T, gmm._means)
+    return ((stats['obs*obs.T'] - obsmean - obsmean.T + avg_means2) / w.sum()
+            + min_covar * np.eye(gmm._ndim))
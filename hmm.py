@@ -1,19 +1,31 @@
 import abc
+import collections
 import functools
 import itertools
 import logging
+import os
+import tempfile
 import time
 
 import numpy as np
 import scipy as sp
 import scipy.cluster
+import scipy.sparse
 
 from generative_model import GenerativeModel
 from gmm import *
 from gmm import _distribute_covar_matrix_to_match_cvtype, _validate_covars
+from gmm import _model_lmvnpdf
 import hmm_trainers
 
 ZEROLOGPROB = -1e200
+# Beam of the HTK style pruning in the backward passes (p. 137 of HTK
+# Book version 3.4): states whose forward times backward probability
+# is further than this from the best state of their frame are skipped.
+BACKWARD_BEAMLOGPROB = -50
+
+# Source of the values of `_BaseHMM._emission_version`.
+_emission_versions = itertools.count()
 
 log = logging.getLogger('gm.hmm')
 
@@ -25,6 +37,315 @@ def HMM(emission_type='gaussian', *args, **kwargs):
         return supported_emission_types[emission_type](*args, **kwargs)
     else:
         raise ValueError, 'Unknown emission_type'
+
+def _sparse_transitions(log_transmat, dtype):
+    """Build the arc lists used by the lattice passes for a CSR
+    matrix of log transition probabilities.
+
+    Arcs are kept both in CSR order (grouped by source state, for
+    the backward recursion) and grouped by destination state (for
+    the forward and Viterbi recursions).
+    """
+    nstates = log_transmat.shape[0]
+    nsucc = np.diff(log_transmat.indptr)
+    src = np.repeat(np.arange(nstates), nsucc)
+    dst = log_transmat.indices
+    logprob = log_transmat.data.astype(dtype)
+    order = np.argsort(dst, kind='mergesort')
+    npred = np.bincount(dst, minlength=nstates)
+    predptr = np.concatenate(([0], np.cumsum(npred)))
+    return {'src': src, 'dst': dst, 'logprob': logprob,
+            'hassucc': nsucc > 0,
+            'succstarts': log_transmat.indptr[:-1][nsucc > 0],
+            'src_by_dst': src[order], 'logprob_by_dst': logprob[order],
+            'npred': npred, 'haspred': npred > 0,
+            'predstarts': predptr[:-1][npred > 0],
+            'transmat': sp.sparse.csr_matrix((np.exp(logprob), dst,
+                                              log_transmat.indptr),
+                                             shape=log_transmat.shape)}
+
+def _reduce_arcs(ufunc, values, starts, nonempty, identity):
+    """Reduce consecutive groups of arcs along the last axis of
+    `values` with `ufunc`.
+
+    Group i starts at `starts[i]`; states without arcs (where
+    `nonempty` is False) are set to `identity`.
+    """
+    out = np.empty(values.shape[:-1] + (len(nonempty),), dtype=values.dtype)
+    out.fill(identity)
+    out[...,nonempty] = ufunc.reduceat(values, starts, axis=-1)
+    return out
+
+def _inactive(idx, nstates):
+    """Boolean mask of the states not in `idx`, or None if all
+    states are active."""
+    if len(idx) == nstates:
+        return None
+    inactive = np.ones(nstates, dtype=bool)
+    inactive[idx] = False
+    return inactive
+
+def _is_pruned(maxrank, beamlogprob, target_active):
+    """Whether any of the pruning options is set."""
+    return (maxrank is not None or beamlogprob > -np.Inf
+            or target_active is not None)
+
+def _count_active(frame, idx):
+    """Number of states in `idx` with nonzero probability in `frame`."""
+    return np.count_nonzero(frame[idx] > ZEROLOGPROB)
+
+def _adapt_beam(lattice_frame, beamlogprob, target_active):
+    """Beam width for the frame after `lattice_frame`.
+
+    Moves `beamlogprob` halfway towards the beam that would have kept
+    the `target_active` best states of `lattice_frame` active.
+    """
+    if target_active >= len(lattice_frame):
+        return -np.Inf
+    kth = np.partition(lattice_frame, -target_active)[-target_active]
+    if kth <= ZEROLOGPROB:
+        # Fewer than target_active states are alive.
+        return -np.Inf
+    target_beam = kth - lattice_frame.max()
+    if beamlogprob == -np.Inf:
+        return target_beam
+    return 0.5 * (beamlogprob + target_beam)
+
+def _index_dtype(nstates):
+    """Smallest unsigned integer type that can hold a state index."""
+    return np.min_scalar_type(max(nstates - 1, 0))
+
+class _ViterbiTraceback(object):
+    """Backpointers stored by `_BaseHMM._do_viterbi_pass`.
+
+    Step n holds the backpointers from frame n+1 to frame n.  Without
+    pruning they are kept in a dense (nsteps, nstates) array.  With
+    pruning, only the states of a frame that survive pruning can be on
+    the best path, so only their backpointers are kept: they are
+    packed together with the states into flat buffers, and step n
+    occupies [offsets[n], offsets[n+1]) of both.
+    """
+
+    def __init__(self, nsteps, nstates, pruned):
+        self._nstates = nstates
+        self._dtype = _index_dtype(nstates)
+        self._nsteps = 0
+        if not pruned:
+            self._dense = np.empty((nsteps, nstates), dtype=self._dtype)
+            return
+        self._dense = None
+        self._offsets = np.zeros(nsteps + 1, dtype=np.int64)
+        # Start small and let `append` grow the buffers as needed, so
+        # that heavy pruning keeps the traceback small.
+        capacity = max(min(nsteps * nstates, max(4 * nstates, 1024)), 1)
+        self._states = np.empty(capacity, dtype=self._dtype)
+        self._backpointers = np.empty(capacity, dtype=self._dtype)
+
+    def append(self, backpointers, idx=None):
+        """Store the backpointers of the next step, keeping only those
+        of the active states `idx` (all states if None)."""
+        n = self._nsteps
+        self._nsteps += 1
+        if self._dense is not None:
+            self._dense[n] = backpointers
+            return
+        if idx is None:
+            idx = np.arange(self._nstates)
+        start = self._offsets[n]
+        stop = start + len(idx)
+        if stop > len(self._backpointers):
+            capacity = max(2 * len(self._backpointers), stop)
+            for name in ('_states', '_backpointers'):
+                buf = np.empty(capacity, dtype=self._dtype)
+                buf[:start] = getattr(self, name)[:start]
+                setattr(self, name, buf)
+        self._states[start:stop] = idx
+        self._backpointers[start:stop] = backpointers[idx]
+        self._offsets[n+1] = stop
+
+    def backtrack(self, state):
+        """Return the state sequence of the best path ending in
+        `state` after the last step."""
+        state_sequence = np.empty(self._nsteps + 1, dtype=np.int)
+        for n in xrange(self._nsteps - 1, -1, -1):
+            state_sequence[n+1] = state
+            if self._dense is not None:
+                state = self._dense[n,state]
+                continue
+            start, stop = self._offsets[n], self._offsets[n+1]
+            if stop - start == self._nstates:
+                state = self._backpointers[start + state]
+            else:
+                state = self._backpointers[
+                    start + np.searchsorted(self._states[start:stop], state)]
+        state_sequence[0] = state
+        return state_sequence
+
+def _forward_step(log_transitions, frame, idx):
+    """Compute log sum_i exp(frame[i] + log a_ij) for every state j,
+    summing only over the active states `idx`."""
+    if isinstance(log_transitions, np.ndarray):
+        if len(idx) < len(frame):
+            # Only gather the rows of the active states.
+            log_transitions, frame = log_transitions[idx], frame[idx]
+        return logsum(log_transitions.T + frame, axis=1)
+    inactive = _inactive(idx, len(frame))
+    if inactive is not None:
+        frame = np.where(inactive, -np.Inf, frame)
+    return _forward_step_batch(log_transitions, frame[np.newaxis])[0]
+
+def _viterbi_step(log_transitions, frame, idx):
+    """Compute max_i frame[i] + log a_ij and its argmax i for every
+    state j, maximizing only over the active states `idx`."""
+    if isinstance(log_transitions, np.ndarray):
+        if len(idx) == len(frame):
+            pr = log_transitions.T + frame
+            return np.max(pr, axis=1), np.argmax(pr, axis=1)
+        pr = log_transitions[idx].T + frame[idx]
+        return np.max(pr, axis=1), idx[np.argmax(pr, axis=1)]
+    inactive = _inactive(idx, len(frame))
+    if inactive is not None:
+        frame = np.where(inactive, -np.Inf, frame)
+    best, backpointers = _viterbi_step_batch(log_transitions,
+                                             frame[np.newaxis])
+    return best[0], backpointers[0]
+
+def _backward_step(log_transitions, frame, idx):
+    """Compute log sum_j exp(log a_ij + frame[j]) for every state i,
+    summing only over the active states `idx`."""
+    if isinstance(log_transitions, np.ndarray):
+        if len(idx) < len(frame):
+            log_transitions, frame = log_transitions[:,idx], frame[idx]
+        return logsum(log_transitions + frame, axis=1)
+    inactive = _inactive(idx, len(frame))
+    if inactive is not None:
+        frame = np.where(inactive, -np.Inf, frame)
+    return _backward_step_batch(log_transitions, frame[np.newaxis])[0]
+
+def _scaled_forward_step(transmat, frame, idx):
+    """Compute sum_i frame[i] * a_ij over the active states `idx`."""
+    if not sp.sparse.issparse(transmat):
+        if len(idx) < len(frame):
+            transmat, frame = transmat[idx], frame[idx]
+        return np.dot(frame, transmat)
+    inactive = _inactive(idx, len(frame))
+    if inactive is not None:
+        frame = np.where(inactive, 0, frame)
+    return transmat.T.dot(frame)
+
+def _scaled_backward_step(transmat, frame, idx):
+    """Compute sum_j a_ij * frame[j] over the active states `idx`."""
+    if not sp.sparse.issparse(transmat):
+        if len(idx) < len(frame):
+            transmat, frame = transmat[:,idx], frame[idx]
+        return np.dot(transmat, frame)
+    inactive = _inactive(idx, len(frame))
+    if inactive is not None:
+        frame = np.where(inactive, 0, frame)
+    return transmat.dot(frame)
+
+# The batch steps advance many sequences at once.  Each row of
+# `frames` belongs to one sequence; pruned states are set to -inf
+# (0 for the scaled steps) instead of being passed as indices.
+
+def _forward_step_batch(log_transitions, frames):
+    """`_forward_step` for every row of `frames`."""
+    if isinstance(log_transitions, np.ndarray):
+        return logsum(frames[:,:,np.newaxis] + log_transitions, axis=1)
+    values = (frames[:,log_transitions['src_by_dst']]
+              + log_transitions['logprob_by_dst'])
+    return _reduce_arcs(np.logaddexp, values, log_transitions['predstarts'],
+                        log_transitions['haspred'], -np.Inf)
+
+def _viterbi_step_batch(log_transitions, frames):
+    """`_viterbi_step` for every row of `frames`."""
+    if isinstance(log_transitions, np.ndarray):
+        pr = frames[:,:,np.newaxis] + log_transitions
+        return np.max(pr, axis=1), np.argmax(pr, axis=1)
+    src = log_transitions['src_by_dst']
+    values = frames[:,src] + log_transitions['logprob_by_dst']
+    haspred = log_transitions['haspred']
+    starts = log_transitions['predstarts']
+    best = _reduce_arcs(np.maximum, values, starts, haspred, -np.Inf)
+    # Pick the first arc attaining the maximum into each state.
+    isbest = values == np.repeat(best[:,haspred],
+                                 log_transitions['npred'][haspred], axis=1)
+    narcs = values.shape[1]
+    arcidx = np.where(isbest, np.arange(narcs), narcs)
+    backpointers = np.zeros(best.shape, dtype=np.int)
+    backpointers[:,haspred] = src[np.minimum.reduceat(arcidx, starts, axis=1)]
+    return best, backpointers
+
+def _backward_step_batch(log_transitions, frames):
+    """`_backward_step` for every row of `frames`."""
+    if isinstance(log_transitions, np.ndarray):
+        return logsum(log_transitions + frames[:,np.newaxis,:], axis=2)
+    values = log_transitions['logprob'] + frames[:,log_transitions['dst']]
+    return _reduce_arcs(np.logaddexp, values, log_transitions['succstarts'],
+                        log_transitions['hassucc'], -np.Inf)
+
+def _scaled_forward_step_batch(transmat, frames):
+    """`_scaled_forward_step` for every row of `frames`."""
+    if not sp.sparse.issparse(transmat):
+        return np.dot(frames, transmat)
+    return transmat.T.dot(frames.T).T
+
+def _scaled_backward_step_batch(transmat, frames):
+    """`_scaled_backward_step` for every row of `frames`."""
+    if not sp.sparse.issparse(transmat):
+        return np.dot(frames, transmat.T)
+    return transmat.dot(frames.T).T
+
+def _length_buckets(lengths, nstates, batchsize=None):
+    """Group sequences of similar length into batches.
+
+    Sequences are sorted by length, so little padding is needed
+    within a batch.  A batch holds at most `batchsize` sequences and
+    about MAX_CHUNK_NELEMENTS lattice entries (or transition scores
+    for a frame, if that is larger).  Yields arrays of indices into
+    `lengths`.
+    """
+    bucket = []
+    for i in np.argsort(lengths, kind='mergesort'):
+        size = (len(bucket) + 1) * max(lengths[i], nstates) * nstates
+        if bucket and (len(bucket) == batchsize
+                       or size > MAX_CHUNK_NELEMENTS):
+            yield np.array(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        yield np.array(bucket)
+
+def _exp_normalized(frames, logscale):
+    """Compute exp(frames - logscale) row by row, with rows whose
+    `logscale` is -inf set to zero."""
+    frames = np.exp(frames - logscale[:,np.newaxis])
+    frames[np.isinf(logscale)] = 0.0
+    return frames
+
+def _check_fbtype(fbtype):
+    if fbtype not in ('log', 'scaled'):
+        raise ValueError, "fbtype must be one of 'log', 'scaled'"
+    return fbtype
+
+def _scale_framelogprob(framelogprob):
+    """Exponentiate each frame of `framelogprob` relative to its maximum.
+
+    Returns the scaled emission probabilities and the per-frame log
+    scaling factors.
+    """
+    emission_scale = framelogprob.max(axis=-1)
+    emission_scale[~np.isfinite(emission_scale)] = 0.0
+    emissions = np.exp(framelogprob - emission_scale[...,np.newaxis])
+    return emissions, emission_scale
+
+def _log_nonzero(A):
+    """np.log(A) without divide-by-zero warnings for zero entries."""
+    old_settings = np.seterr(divide='ignore')
+    try:
+        return np.log(A)
+    finally:
+        np.seterr(**old_settings)
     
 
 class _BaseHMM(GenerativeModel):
@@ -41,12 +362,15 @@ class _BaseHMM(GenerativeModel):
     ----------
     nstates : int (read-only)
         Number of states in the model.
-    transmat : array, shape (`nstates`, `nstates`)
+    transmat : array or sparse matrix, shape (`nstates`, `nstates`)
         Matrix of transition probabilities between states.
     startprob : array, shape ('nstates`,)
         Initial state occupation distribution.
     labels : list, len `nstates`
         Optional labels for each state.
+    dtype : numpy dtype (read-only)
+        Floating point type of the forward, backward and Viterbi
+        lattices.
 
     Methods
     -------
@@ -86,8 +410,10 @@ class _BaseHMM(GenerativeModel):
         return None
 
     def __init__(self, nstates=1, startprob=None, transmat=None,
-        labels=None, trainer=hmm_trainers.BaseHMMBaumWelchTrainer()):
+        labels=None, trainer=hmm_trainers.BaseHMMBaumWelchTrainer(),
+        dtype=np.float64):
         self._nstates = nstates
+        self._dtype = np.dtype(dtype)
 
         if startprob is None:
             startprob = np.tile(1.0 / nstates, nstates)
@@ -103,7 +429,8 @@ class _BaseHMM(GenerativeModel):
 
         self.trainer = trainer
 
-    def eval(self, obs, maxrank=None, beamlogprob=-np.Inf):
+    def eval(self, obs, maxrank=None, beamlogprob=-np.Inf, fbtype='log',
+             pruning_stats=None, target_active=None):
         """Compute the log probability under the model and compute posteriors
 
         Implements rank and beam pruning in the forward-backward
@@ -123,6 +450,22 @@ class _BaseHMM(GenerativeModel):
             Width of the beam-pruning beam in log-probability units.
             Defaults to -numpy.Inf (no beam pruning).  See The HTK
             Book for more details.
+        fbtype : string
+            Forward-backward implementation to use.  'log' computes
+            the lattices in the log domain.  'scaled' works with
+            per-frame scaled probabilities, which is faster for
+            models with many states, and falls back to the log
+            domain for frames that underflow.  Defaults to 'log'.
+        pruning_stats : PruningStats
+            If not None, record the active states and running time of
+            every lattice pass in `pruning_stats`.  Defaults to None.
+        target_active : int
+            If not None, adapt the beam width frame by frame so that
+            about `target_active` states stay active in the forward
+            recursion, and keep between `target_active` / 2 and
+            2 * `target_active` states active at every frame.
+            `beamlogprob` is the initial beam width and `maxrank`
+            stays a hard limit.  Defaults to None.
 
         Returns
         -------
@@ -139,9 +482,15 @@ class _BaseHMM(GenerativeModel):
         """
         framelogprob = self._compute_log_likelihood(obs)
         logprob, fwdlattice = self._do_forward_pass(framelogprob, maxrank,
-                                                    beamlogprob)
+                                                    beamlogprob, fbtype,
+                                                    pruning_stats,
+                                                    target_active)
+        self._check_pruning(pruning_stats, logprob, maxrank, beamlogprob,
+                            target_active,
+                            lambda: self._do_forward_pass(framelogprob)[0])
         bwdlattice = self._do_backward_pass(framelogprob, fwdlattice, maxrank,
-                                            beamlogprob)
+                                            beamlogprob, fbtype,
+                                            pruning_stats)
         gamma = fwdlattice + bwdlattice
         # gamma is guaranteed to be correctly normalized by logprob at
         # all frames, unless we do approximate inference using pruning.
@@ -150,7 +499,8 @@ class _BaseHMM(GenerativeModel):
         posteriors = np.exp(gamma.T - logsum(gamma, axis=1)).T
         return logprob, posteriors
 
-    def lpdf(self, obs, maxrank=None, beamlogprob=-np.Inf):
+    def lpdf(self, obs, maxrank=None, beamlogprob=-np.Inf, fbtype='log',
+             pruning_stats=None, target_active=None):
         """Compute the log probability under the model.
 
         Parameters
@@ -167,6 +517,22 @@ class _BaseHMM(GenerativeModel):
             Width of the beam-pruning beam in log-probability units.
             Defaults to -numpy.Inf (no beam pruning).  See The HTK
             Book for more details.
+        fbtype : string
+            Forward-backward implementation to use.  'log' computes
+            the lattices in the log domain.  'scaled' works with
+            per-frame scaled probabilities, which is faster for
+            models with many states, and falls back to the log
+            domain for frames that underflow.  Defaults to 'log'.
+        pruning_stats : PruningStats
+            If not None, record the active states and running time of
+            every lattice pass in `pruning_stats`.  Defaults to None.
+        target_active : int
+            If not None, adapt the beam width frame by frame so that
+            about `target_active` states stay active in the forward
+            recursion, and keep between `target_active` / 2 and
+            2 * `target_active` states active at every frame.
+            `beamlogprob` is the initial beam width and `maxrank`
+            stays a hard limit.  Defaults to None.
 
         Returns
         -------
@@ -180,10 +546,16 @@ class _BaseHMM(GenerativeModel):
         """
         framelogprob = self._compute_log_likelihood(obs)
         logprob, fwdlattice =  self._do_forward_pass(framelogprob, maxrank,
-                                                     beamlogprob)
+                                                     beamlogprob, fbtype,
+                                                     pruning_stats,
+                                                     target_active)
+        self._check_pruning(pruning_stats, logprob, maxrank, beamlogprob,
+                            target_active,
+                            lambda: self._do_forward_pass(framelogprob)[0])
         return logprob
 
-    def decode(self, obs, maxrank=None, beamlogprob=-np.Inf):
+    def decode(self, obs, maxrank=None, beamlogprob=-np.Inf,
+               pruning_stats=None, target_active=None):
         """Find most likely state sequence corresponding to `obs`.
 
         Uses the Viterbi algorithm.
@@ -202,6 +574,16 @@ class _BaseHMM(GenerativeModel):
             Width of the beam-pruning beam in log-probability units.
             Defaults to -numpy.Inf (no beam pruning).  See The HTK
             Book for more details.
+        pruning_stats : PruningStats
+            If not None, record the active states and running time of
+            every lattice pass in `pruning_stats`.  Defaults to None.
+        target_active : int
+            If not None, adapt the beam width frame by frame so that
+            about `target_active` states stay active in the Viterbi
+            recursion, and keep between `target_active` / 2 and
+            2 * `target_active` states active at every frame.
+            `beamlogprob` is the initial beam width and `maxrank`
+            stays a hard limit.  Defaults to None.
 
         Returns
         -------
@@ -217,8 +599,158 @@ class _BaseHMM(GenerativeModel):
         """
         framelogprob = self._compute_log_likelihood(obs)
         logprob, state_sequence = self._do_viterbi_pass(framelogprob, maxrank,
-                                                        beamlogprob)
+                                                        beamlogprob,
+                                                        pruning_stats,
+                                                        target_active)
+        self._check_pruning(pruning_stats, logprob, maxrank, beamlogprob,
+                            target_active,
+                            lambda: self._do_viterbi_pass(framelogprob)[0])
         return logprob, state_sequence
+
+    def streaming_decoder(self, maxrank=None, beamlogprob=-np.Inf,
+                          maxdelay=None, target_active=None):
+        """Create a decoder for observations that arrive incrementally.
+
+        Parameters
+        ----------
+        maxrank : int
+            Maximum rank to evaluate for rank pruning.  See `decode`.
+        beamlogprob : float
+            Width of the beam-pruning beam in log-probability units.
+            See `decode`.
+        maxdelay : int
+            Maximum number of frames that may remain undecided.  See
+            `StreamingViterbiDecoder`.  Defaults to None (no limit).
+        target_active : int
+            Number of active states to adapt the beam width to.  See
+            `decode`.  Defaults to None (fixed beam).
+
+        Returns
+        -------
+        decoder : StreamingViterbiDecoder
+
+        See Also
+        --------
+        decode : Find most likely state sequence corresponding to a `obs`
+        """
+        return StreamingViterbiDecoder(self, maxrank, beamlogprob, maxdelay,
+                                       target_active)
+
+    def forward_filter(self, maxrank=None, beamlogprob=-np.Inf, lag=0,
+                       target_active=None):
+        """Create a filter that tracks the state distribution of an
+        observation stream.
+
+        Parameters
+        ----------
+        maxrank : int
+            Maximum rank to evaluate for rank pruning.  See `lpdf`.
+        beamlogprob : float
+            Width of the beam-pruning beam in log-probability units.
+            See `lpdf`.
+        lag : int
+            Number of past frames to keep for fixed-lag smoothing.
+            See `ForwardFilter.smooth`.  Defaults to 0 (no smoothing).
+        target_active : int
+            Number of active states to adapt the beam width to.  See
+            `lpdf`.  Defaults to None (fixed beam).
+
+        Returns
+        -------
+        filter : ForwardFilter
+
+        See Also
+        --------
+        eval : Compute the log probability under the model and compute
+            posteriors
+        """
+        return ForwardFilter(self, maxrank, beamlogprob, lag, target_active)
+
+    def lpdf_batch(self, obs, maxrank=None, beamlogprob=-np.Inf,
+                   fbtype='log', batchsize=None):
+        """Compute the log probability of many sequences.
+
+        Sequences of similar length are grouped into batches that are
+        evaluated in lockstep, which is much faster than calling
+        `lpdf` on many short sequences.
+
+        Parameters
+        ----------
+        obs : list
+            List of array-like observation sequences (shape (n_i, ndim)).
+        maxrank : int
+            Maximum rank to evaluate for rank pruning.  See `lpdf`.
+        beamlogprob : float
+            Width of the beam-pruning beam in log-probability units.
+            See `lpdf`.
+        fbtype : string
+            Forward-backward implementation to use, 'log' or
+            'scaled'.  See `eval`.  Defaults to 'log'.
+        batchsize : int
+            Maximum number of sequences to evaluate at once.
+            Defaults to None (as many as fit in memory).
+
+        Returns
+        -------
+        logprob : array_like, shape (len(obs),)
+            Log probability of each sequence in `obs`
+
+        See Also
+        --------
+        lpdf : Compute the log probability of a single sequence
+        decode_batch : Find most likely state sequences for many sequences
+        """
+        logprob = np.empty(len(obs))
+        for batch, framelogprob, lengths in self._iter_batches(obs,
+                                                               batchsize):
+            logprob[batch], fwdlattice = self._do_forward_pass_batch(
+                framelogprob, lengths, maxrank, beamlogprob, fbtype)
+        return logprob
+
+    def decode_batch(self, obs, maxrank=None, beamlogprob=-np.Inf,
+                     batchsize=None):
+        """Find most likely state sequences corresponding to many
+        sequences.
+
+        Sequences of similar length are grouped into batches that are
+        decoded in lockstep.
+
+        Parameters
+        ----------
+        obs : list
+            List of array-like observation sequences (shape (n_i, ndim)).
+        maxrank : int
+            Maximum rank to evaluate for rank pruning.  See `decode`.
+        beamlogprob : float
+            Width of the beam-pruning beam in log-probability units.
+            See `decode`.
+        batchsize : int
+            Maximum number of sequences to decode at once.
+            Defaults to None (as many as fit in memory).
+
+        Returns
+        -------
+        viterbi_logprob : array_like, shape (len(obs),)
+            Log probability of the maximum likelihood path for each
+            sequence in `obs`
+        components : list
+            Index of the most likely states for each observation of
+            each sequence in `obs`
+
+        See Also
+        --------
+        decode : Find most likely state sequence for a single sequence
+        lpdf_batch : Compute the log probability of many sequences
+        """
+        logprob = np.empty(len(obs))
+        state_sequences = [None] * len(obs)
+        for batch, framelogprob, lengths in self._iter_batches(obs,
+                                                               batchsize):
+            logprob[batch], state_sequence = self._do_viterbi_pass_batch(
+                framelogprob, lengths, maxrank, beamlogprob)
+            for i, seq, n in itertools.izip(batch, state_sequence, lengths):
+                state_sequences[i] = seq[:n]
+        return logprob, state_sequences
         
     def rvs(self, n=1):
         """Generate random samples from the model.
@@ -236,8 +768,9 @@ class _BaseHMM(GenerativeModel):
 
         startprob_pdf = self.startprob
         startprob_cdf = np.cumsum(startprob_pdf)
-        transmat_pdf = self.transmat
-        transmat_cdf = np.cumsum(transmat_pdf, 1);
+        # Only the successors of each state are needed, so sample
+        # from the arcs of a CSR matrix.
+        transmat_pdf = sp.sparse.csr_matrix(self.transmat)
 
         # Initial state.
         rand = np.random.rand()
@@ -246,7 +779,10 @@ class _BaseHMM(GenerativeModel):
 
         for x in xrange(n-1):
             rand = np.random.rand()
-            currstate = (transmat_cdf[currstate] > rand).argmax()
+            start, stop = transmat_pdf.indptr[currstate:currstate+2]
+            transmat_cdf = np.cumsum(transmat_pdf.data[start:stop])
+            currstate = transmat_pdf.indices[start
+                                             + (transmat_cdf > rand).argmax()]
             obs.append(self._generate_sample_from_state(currstate))
 
         return np.array(obs)
@@ -274,7 +810,9 @@ class _BaseHMM(GenerativeModel):
         self._init(obs, params, **kwargs)
 
     def train(self, obs, iter=10, thresh=1e-2, params='stmpc',
-              maxrank=None, beamlogprob=-np.Inf, **kwargs):
+              maxrank=None, beamlogprob=-np.Inf, fbtype='log', n_jobs=1,
+              checkpoint=False, pruning_stats=None, target_active=None,
+              framelogprob_cache=None, batchsize=None, **kwargs):
         """Estimate model parameters with the Baum-Welch algorithm.
 
         Parameters
@@ -299,6 +837,35 @@ class _BaseHMM(GenerativeModel):
             Width of the beam-pruning beam in log-probability units.
             Defaults to -numpy.Inf (no beam pruning).  See "The HTK
             Book" for more details.
+        fbtype : string
+            Forward-backward implementation to use, 'log' or
+            'scaled'.  See `eval`.  Defaults to 'log'.
+        n_jobs : int
+            Number of worker processes to use for the expectation
+            step.  See `HMMTrainer.train`.  Defaults to 1.
+        checkpoint : bool or int
+            Whether to use checkpointed forward-backward, which keeps
+            O(sqrt(n_i) * nstates) lattice entries per sequence instead
+            of O(n_i * nstates).  See `HMMTrainer.train`.  Defaults to
+            False.
+        pruning_stats : PruningStats
+            If not None, record the active states and running time of
+            every lattice pass in `pruning_stats`.  Defaults to None.
+        target_active : int
+            If not None, adapt the beam width frame by frame so that
+            about `target_active` states stay active in the forward
+            recursion, and keep between `target_active` / 2 and
+            2 * `target_active` states active at every frame.
+            `beamlogprob` is the initial beam width and `maxrank`
+            stays a hard limit.  Defaults to None.
+        framelogprob_cache : FrameLogProbCache
+            If not None, reuse the frame log likelihoods of every
+            sequence across iterations while the emission parameters
+            are unchanged.  See `HMMTrainer.train`.  Defaults to None.
+        batchsize : int
+            If not None, run the lattice passes on batches of at most
+            `batchsize` sequences of similar length in lockstep.  See
+            `HMMTrainer.train`.  Defaults to None.
 
         Returns
         -------
@@ -306,13 +873,24 @@ class _BaseHMM(GenerativeModel):
             Log probabilities of each data point in `obs` for each iteration
         """
         return self.trainer.train(self, obs, iter, thresh, params,
-                                  maxrank, beamlogprob, **kwargs)
+                                  maxrank, beamlogprob, fbtype=fbtype,
+                                  n_jobs=n_jobs, checkpoint=checkpoint,
+                                  pruning_stats=pruning_stats,
+                                  target_active=target_active,
+                                  framelogprob_cache=framelogprob_cache,
+                                  batchsize=batchsize, **kwargs)
 
     @property
     def nstates(self):
         """Number of states in the model."""
         return self._nstates
 
+    @property
+    def dtype(self):
+        """Floating point type of the forward, backward and Viterbi
+        lattices."""
+        return self._dtype
+
     @property
     def startprob(self):
         """Mixing startprob for each state."""
@@ -329,17 +907,46 @@ class _BaseHMM(GenerativeModel):
 
     @property
     def transmat(self):
-        """Matrix of transition probabilities."""
+        """Matrix of transition probabilities.
+
+        May be set to a scipy.sparse matrix for models with few
+        successors per state, in which case it is stored (and
+        returned) as a CSR matrix and the lattice passes only visit
+        its nonzero arcs.
+        """
+        if sp.sparse.issparse(self._log_transmat):
+            return sp.sparse.csr_matrix((np.exp(self._log_transmat.data),
+                                         self._log_transmat.indices.copy(),
+                                         self._log_transmat.indptr.copy()),
+                                        shape=self._log_transmat.shape)
         return np.exp(self._log_transmat)
 
     @transmat.setter
     def transmat(self, transmat):
-        if np.asarray(transmat).shape != (self._nstates, self._nstates):
+        if sp.sparse.issparse(transmat):
+            transmat = sp.sparse.csr_matrix(transmat, dtype=np.float64,
+                                            copy=True)
+            transmat.sum_duplicates()
+            transmat.eliminate_zeros()
+            transmat.sort_indices()
+            rowsum = np.asarray(transmat.sum(axis=1)).ravel()
+        else:
+            transmat = np.asarray(transmat)
+            rowsum = np.sum(transmat, axis=1) if transmat.ndim == 2 else None
+        if transmat.shape != (self._nstates, self._nstates):
             raise ValueError, 'transmat must have shape (nstates, nstates)'
-        if not np.all(almost_equal(np.sum(transmat, axis=1), 1.0)):
+        if not np.all(almost_equal(rowsum, 1.0)):
             raise ValueError, 'each row of transmat must sum to 1.0'
+
+        if sp.sparse.issparse(transmat):
+            # Keep the arcs explicitly: log(1) == 0 must not be
+            # dropped from the sparsity structure.
+            self._log_transmat = sp.sparse.csr_matrix(
+                (np.log(transmat.data), transmat.indices, transmat.indptr),
+                shape=transmat.shape)
+            return
         
-        self._log_transmat = np.log(np.asarray(transmat).copy())
+        self._log_transmat = np.log(transmat.copy())
         underflow_idx = np.isnan(self._log_transmat)
         self._log_transmat[underflow_idx] = -np.Inf
 
@@ -354,94 +961,649 @@ class _BaseHMM(GenerativeModel):
             raise ValueError, 'trainer has incompatible emission_type'
         self._trainer = trainer
 
-    def _do_viterbi_pass(self, framelogprob, maxrank=None, beamlogprob=-np.Inf):
+    def _do_viterbi_pass(self, framelogprob, maxrank=None, beamlogprob=-np.Inf,
+                         stats=None, target_active=None):
+        start = time.time()
+        nactive = []
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        log_transitions, transmat = self._get_transitions()
         nobs = len(framelogprob)
-        lattice = np.zeros((nobs, self._nstates))
-        traceback = np.zeros((nobs, self._nstates), dtype=np.int) 
 
-        lattice[0] = self._log_startprob + framelogprob[0]
+        # Only the current lattice frame is kept.
+        traceback = _ViterbiTraceback(
+            max(nobs - 1, 0), self._nstates,
+            _is_pruned(maxrank, beamlogprob, target_active))
+        backpointers = None
+        frame = np.asarray(self._log_startprob + framelogprob[0],
+                           dtype=self._dtype)
         for n in xrange(1, nobs):
-            idx = self._prune_states(lattice[n-1], maxrank, beamlogprob)
-            pr = self._log_transmat[idx].T + lattice[n-1,idx]
-            lattice[n]   = np.max(pr, axis=1) + framelogprob[n]
-            traceback[n] = np.argmax(pr, axis=1)
-        lattice[lattice <= ZEROLOGPROB] = -np.Inf;
-        
+            idx, beamlogprob = self._prune_states_adaptive(
+                frame, maxrank, beamlogprob, target_active)
+            if stats is not None:
+                nactive.append(_count_active(frame, idx))
+            if backpointers is not None:
+                traceback.append(backpointers, idx)
+            pr, backpointers = _viterbi_step(log_transitions, frame, idx)
+            frame = np.asarray(pr + framelogprob[n], dtype=self._dtype)
+        if backpointers is not None:
+            traceback.append(backpointers)
+        frame[frame <= ZEROLOGPROB] = -np.Inf
+
         # Do traceback.
-        reverse_state_sequence = []
-        s = lattice[-1].argmax()
-        for frame in reversed(traceback):
-            reverse_state_sequence.append(s)
-            s = frame[s]
+        state_sequence = traceback.backtrack(frame.argmax())
+
+        if stats is not None:
+            stats._add_pass('viterbi', nactive, time.time() - start)
+        return logsum(frame), state_sequence
+
+    def _do_forward_pass(self, framelogprob, maxrank=None, beamlogprob=-np.Inf,
+                         fbtype='log', stats=None, target_active=None):
+        if _check_fbtype(fbtype) == 'scaled':
+            return self._do_scaled_forward_pass(framelogprob, maxrank,
+                                                beamlogprob, stats,
+                                                target_active)
+        start = time.time()
+        nactive = None if stats is None else []
+        fwdlattice, beamlogprob = self._forward_lattice(
+            framelogprob, None, maxrank, beamlogprob, nactive, target_active)
+        fwdlattice[fwdlattice <= ZEROLOGPROB] = -np.Inf
+        if stats is not None:
+            stats._add_pass('forward', nactive, time.time() - start)
+
+        return logsum(fwdlattice[-1]), fwdlattice
 
-        reverse_state_sequence.reverse()
-        return logsum(lattice[-1]), np.array(reverse_state_sequence)
+    def _do_backward_pass(self, framelogprob, fwdlattice, maxrank=None,
+                          beamlogprob=-np.Inf, fbtype='log', stats=None):
+        if _check_fbtype(fbtype) == 'scaled':
+            return self._do_scaled_backward_pass(framelogprob, fwdlattice,
+                                                 maxrank, beamlogprob, stats)
+        start = time.time()
+        nactive = None if stats is None else []
+        bwdlattice = self._backward_lattice(framelogprob, fwdlattice,
+                                            nactive=nactive)
+        bwdlattice[bwdlattice <= ZEROLOGPROB] = -np.Inf
+        if stats is not None:
+            stats._add_pass('backward', nactive, time.time() - start)
+
+        return bwdlattice
 
-    def _do_forward_pass(self, framelogprob, maxrank=None, beamlogprob=-np.Inf):
+    def _forward_lattice(self, framelogprob, frame=None, maxrank=None,
+                         beamlogprob=-np.Inf, nactive=None,
+                         target_active=None):
+        """Run the log-domain forward recursion over `framelogprob`.
+
+        `frame` holds the forward log probabilities of the frame
+        preceding `framelogprob`, or None if `framelogprob` starts the
+        sequence.  Log probabilities below ZEROLOGPROB are left as is.
+        If `nactive` is a list, the number of active states of every
+        step is appended to it.  Returns the lattice and the beam
+        width for the next step, which differs from `beamlogprob` if
+        `target_active` is set.
+        """
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        log_transitions, transmat = self._get_transitions()
         nobs = len(framelogprob)
-        fwdlattice = np.zeros((nobs, self._nstates))
+        fwdlattice = np.zeros((nobs, self._nstates), dtype=self._dtype)
 
-        fwdlattice[0] = self._log_startprob + framelogprob[0]
+        if frame is None:
+            fwdlattice[0] = self._log_startprob + framelogprob[0]
+        else:
+            idx, beamlogprob = self._prune_states_adaptive(
+                frame, maxrank, beamlogprob, target_active)
+            if nactive is not None:
+                nactive.append(_count_active(frame, idx))
+            fwdlattice[0] = (_forward_step(log_transitions, frame, idx)
+                             + framelogprob[0])
         for n in xrange(1, nobs):
-            idx = self._prune_states(fwdlattice[n-1], maxrank, beamlogprob)
-            fwdlattice[n] = (logsum(self._log_transmat[idx].T
-                                    + fwdlattice[n-1,idx], axis=1)
+            idx, beamlogprob = self._prune_states_adaptive(
+                fwdlattice[n-1], maxrank, beamlogprob, target_active)
+            if nactive is not None:
+                nactive.append(_count_active(fwdlattice[n-1], idx))
+            fwdlattice[n] = (_forward_step(log_transitions, fwdlattice[n-1],
+                                           idx)
                              + framelogprob[n])
-        fwdlattice[fwdlattice <= ZEROLOGPROB] = -np.Inf
+        return fwdlattice, beamlogprob
 
-        return logsum(fwdlattice[-1]), fwdlattice
+    def _backward_lattice(self, framelogprob, fwdlattice, frame=None,
+                          nactive=None):
+        """Run the log-domain backward recursion over `framelogprob`.
 
-    def _do_backward_pass(self, framelogprob, fwdlattice, maxrank=None,
-                          beamlogprob=-np.Inf):
+        `frame` holds the backward log probabilities of the last frame
+        of `framelogprob`, or None if it ends the sequence.  Log
+        probabilities below ZEROLOGPROB are left as is.  If `nactive`
+        is a list, the number of active states of every step is
+        appended to it.
+        """
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        log_transitions, transmat = self._get_transitions()
         nobs = len(framelogprob)
-        bwdlattice = np.zeros((nobs, self._nstates))
+        bwdlattice = np.zeros((nobs, self._nstates), dtype=self._dtype)
 
+        if frame is not None:
+            bwdlattice[-1] = frame
         for n in xrange(nobs - 1, 0, -1):
-            # Do HTK style pruning (p. 137 of HTK Book version 3.4).
-            # Don't bother computing backward probability if
-            # fwdlattice * bwdlattice is more than a certain distance
-            # from the total log likelihood.
+            # Do HTK style pruning: don't bother computing backward
+            # probability if fwdlattice * bwdlattice is more than
+            # BACKWARD_BEAMLOGPROB from the best state.
             idx = self._prune_states(bwdlattice[n] + fwdlattice[n], None,
-                                     -50)
-                                     #beamlogprob)
-                                     #-np.Inf)
-            bwdlattice[n-1] = logsum(self._log_transmat[:,idx]
-                                     + bwdlattice[n,idx] + framelogprob[n,idx],
-                                     axis=1)
+                                     BACKWARD_BEAMLOGPROB)
+            if nactive is not None:
+                nactive.append(_count_active(bwdlattice[n] + fwdlattice[n],
+                                             idx))
+            bwdlattice[n-1] = _backward_step(log_transitions,
+                                             bwdlattice[n] + framelogprob[n],
+                                             idx)
+        return bwdlattice
+
+    def _do_checkpointed_forward_pass(self, obs, maxrank=None,
+                                      beamlogprob=-np.Inf, segmentlen=None,
+                                      stats=None, target_active=None):
+        """Forward pass that only keeps one frame per segment.
+
+        `obs` is split into segments of `segmentlen` frames (defaults
+        to about sqrt(len(obs))), and the frame log likelihoods are
+        computed one segment at a time.  Returns the log probability
+        of `obs`, the segment boundaries, and the forward log
+        probabilities of the last frame of every segment but the
+        last, together with the beam width that follows it, from
+        which `_iter_checkpointed_lattices` recomputes the lattices.
+        Memory use is O(sqrt(n) * nstates) instead of O(n * nstates).
+        """
+        start = time.time()
+        nactive = None if stats is None else []
+        nobs = len(obs)
+        if segmentlen is None:
+            segmentlen = int(np.ceil(np.sqrt(nobs)))
+        if segmentlen < 1:
+            raise ValueError, 'segmentlen must be positive'
+        bounds = np.append(np.arange(0, nobs, segmentlen), nobs)
+        checkpoints = []
+
+        frame = None
+        for k in xrange(len(bounds) - 1):
+            framelogprob = self._compute_log_likelihood(
+                obs[bounds[k]:bounds[k+1]])
+            fwdlattice, beamlogprob = self._forward_lattice(
+                framelogprob, frame, maxrank, beamlogprob, nactive,
+                target_active)
+            # Copy so that the lattice of the segment can be freed.
+            frame = fwdlattice[-1].copy()
+            checkpoints.append((frame, beamlogprob))
+        frame = frame.copy()
+        frame[frame <= ZEROLOGPROB] = -np.Inf
+        if stats is not None:
+            stats._add_pass('forward', nactive, time.time() - start)
+        return logsum(frame), bounds, checkpoints[:-1]
+
+    def _iter_checkpointed_lattices(self, obs, bounds, checkpoints,
+                                    maxrank=None, beamlogprob=-np.Inf,
+                                    stats=None, target_active=None):
+        """Recompute the lattices of `obs` one segment at a time.
+
+        Takes the segment boundaries and checkpoints returned by
+        `_do_checkpointed_forward_pass` and yields the start frame,
+        frame log likelihoods, and forward and backward lattices of
+        every segment, last segment first.  The lattices equal the
+        corresponding rows of `_do_forward_pass` and
+        `_do_backward_pass`.  Every segment but the first also
+        includes the last frame of the segment preceding it, so that
+        the transitions between segments can be computed.
+        """
+        seconds = 0.0
+        nactive = None if stats is None else []
+        frame = None
+        for k in xrange(len(bounds) - 2, -1, -1):
+            start_time = time.time()
+            if k == 0:
+                start = 0
+                framelogprob = self._compute_log_likelihood(
+                    obs[:bounds[1]])
+                fwdlattice = self._forward_lattice(
+                    framelogprob, None, maxrank, beamlogprob,
+                    target_active=target_active)[0]
+            else:
+                start = bounds[k] - 1
+                framelogprob = self._compute_log_likelihood(
+                    obs[start:bounds[k+1]])
+                checkpoint, checkpoint_beam = checkpoints[k-1]
+                fwdlattice = np.vstack((
+                    checkpoint,
+                    self._forward_lattice(framelogprob[1:], checkpoint,
+                                          maxrank, checkpoint_beam,
+                                          target_active=target_active)[0]))
+            bwdlattice = self._backward_lattice(framelogprob, fwdlattice,
+                                                frame, nactive)
+            frame = bwdlattice[0]
+            fwdlattice[fwdlattice <= ZEROLOGPROB] = -np.Inf
+            bwdlattice = bwdlattice.copy()
+            bwdlattice[bwdlattice <= ZEROLOGPROB] = -np.Inf
+            seconds += time.time() - start_time
+            yield start, framelogprob, fwdlattice, bwdlattice
+        if stats is not None:
+            stats._add_pass('backward', nactive, seconds)
+
+    def _do_scaled_forward_pass(self, framelogprob, maxrank=None,
+                                beamlogprob=-np.Inf, stats=None,
+                                target_active=None):
+        """Forward pass using per-frame scaling factors (Rabiner 1989).
+
+        The recursion is carried out on normalized probabilities, so
+        every frame costs a single vector-matrix product against the
+        cached transition matrix.  Frames whose scaled probabilities
+        underflow are recomputed in the log domain.  The returned
+        lattice holds log probabilities, like `_do_forward_pass`,
+        except that states whose probability underflows relative to
+        the rest of their frame are set to -inf.
+        """
+        start = time.time()
+        nactive = []
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        log_transitions, transmat = self._get_transitions()
+        nobs = len(framelogprob)
+        emissions, emission_scale = _scale_framelogprob(framelogprob)
+        underflow = np.sqrt(np.finfo(self._dtype).tiny)
+
+        alpha = np.zeros((nobs, self._nstates), dtype=self._dtype)
+        logscale = np.zeros(nobs)
+
+        frame = np.asarray(self._log_startprob + framelogprob[0],
+                           dtype=self._dtype)
+        logscale[0] = logsum(frame)
+        if logscale[0] > -np.Inf:
+            alpha[0] = np.exp(frame - logscale[0])
+        pruned = _is_pruned(maxrank, beamlogprob, target_active)
+        allidx = np.arange(self._nstates)
+        for n in xrange(1, nobs):
+            if pruned:
+                logalpha = _log_nonzero(alpha[n-1])
+                idx, beamlogprob = self._prune_states_adaptive(
+                    logalpha, maxrank, beamlogprob, target_active)
+                if stats is not None:
+                    nactive.append(_count_active(logalpha, idx))
+            else:
+                # The scaled step needs no log probabilities.
+                logalpha, idx = None, allidx
+                if stats is not None:
+                    nactive.append(np.count_nonzero(alpha[n-1]))
+            frame = (_scaled_forward_step(transmat, alpha[n-1], idx)
+                     * emissions[n])
+            scale = frame.sum()
+            if scale > underflow:
+                alpha[n] = frame / scale
+                logscale[n] = np.log(scale) + emission_scale[n]
+            else:
+                if logalpha is None:
+                    logalpha = _log_nonzero(alpha[n-1])
+                frame = (_forward_step(log_transitions, logalpha, idx)
+                         + framelogprob[n])
+                logscale[n] = logsum(frame)
+                if logscale[n] > -np.Inf:
+                    alpha[n] = np.exp(frame - logscale[n])
+
+        logscale = np.cumsum(logscale)
+        fwdlattice = np.asarray(_log_nonzero(alpha) + logscale[:,np.newaxis],
+                                dtype=self._dtype)
+        fwdlattice[fwdlattice <= ZEROLOGPROB] = -np.Inf
+        if stats is not None:
+            stats._add_pass('forward', nactive, time.time() - start)
+        return logscale[-1], fwdlattice
+
+    def _do_scaled_backward_pass(self, framelogprob, fwdlattice, maxrank=None,
+                                 beamlogprob=-np.Inf, stats=None):
+        """Backward pass using per-frame scaling factors.
+
+        Counterpart of `_do_scaled_forward_pass`; returns a lattice of
+        log probabilities like `_do_backward_pass`.
+        """
+        start = time.time()
+        nactive = []
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        log_transitions, transmat = self._get_transitions()
+        nobs = len(framelogprob)
+        emissions, emission_scale = _scale_framelogprob(framelogprob)
+        underflow = np.sqrt(np.finfo(self._dtype).tiny)
+
+        beta = np.zeros((nobs, self._nstates), dtype=self._dtype)
+        logscale = np.zeros(nobs)
+
+        beta[-1] = 1.0
+        for n in xrange(nobs - 1, 0, -1):
+            # Same HTK style pruning as `_do_backward_pass`.
+            logbeta = _log_nonzero(beta[n])
+            lattice_frame = logbeta + logscale[n] + fwdlattice[n]
+            idx = self._prune_states(lattice_frame, None,
+                                     BACKWARD_BEAMLOGPROB)
+            if stats is not None:
+                nactive.append(_count_active(lattice_frame, idx))
+            frame = _scaled_backward_step(transmat, beta[n] * emissions[n],
+                                          idx)
+            scale = frame.max()
+            if scale > underflow:
+                beta[n-1] = frame / scale
+                logscale[n-1] = logscale[n] + np.log(scale) + emission_scale[n]
+            else:
+                frame = _backward_step(log_transitions,
+                                       logbeta + framelogprob[n], idx)
+                scale = frame.max()
+                if scale > -np.Inf:
+                    beta[n-1] = np.exp(frame - scale)
+                logscale[n-1] = logscale[n] + scale
+
+        bwdlattice = np.asarray(_log_nonzero(beta) + logscale[:,np.newaxis],
+                                dtype=self._dtype)
+        bwdlattice[bwdlattice <= ZEROLOGPROB] = -np.Inf
+        if stats is not None:
+            stats._add_pass('backward', nactive, time.time() - start)
+        return bwdlattice
+
+    def _iter_batches(self, obs, batchsize=None, framelogprob_cache=None):
+        """Group the sequences in `obs` into batches of similar length.
+
+        Yields the indices of the sequences in each batch, their
+        frame log likelihoods padded with zeros to shape (nseq,
+        maxlen, nstates), and their lengths.  The frame log
+        likelihoods are looked up in `framelogprob_cache` if it is
+        not None.
+        """
+        lengths = np.array([len(seq) for seq in obs])
+        for batch in _length_buckets(lengths, self._nstates, batchsize):
+            batch_lengths = lengths[batch]
+            if framelogprob_cache is None:
+                framelogprob = self._compute_log_likelihood(
+                    np.concatenate([np.asarray(obs[i]) for i in batch]))
+            else:
+                framelogprob = np.concatenate(
+                    [framelogprob_cache.get(self, obs[i]) for i in batch])
+            mask = (np.arange(batch_lengths.max())
+                    < batch_lengths[:,np.newaxis])
+            padded = np.zeros(mask.shape + (self._nstates,),
+                              dtype=framelogprob.dtype)
+            padded[mask] = framelogprob
+            yield batch, padded, batch_lengths
+
+    def _do_viterbi_pass_batch(self, framelogprob, lengths, maxrank=None,
+                               beamlogprob=-np.Inf):
+        """Viterbi pass over a batch of sequences in lockstep.
+
+        `framelogprob` has shape (nseq, maxlen, nstates) and holds the
+        frame log likelihoods of each sequence, padded to the length
+        of the longest one; `lengths` holds the actual lengths.
+        Returns the log probabilities and the state sequences (shape
+        (nseq, maxlen), padded with -1).
+        """
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        lengths = np.asarray(lengths)
+        log_transitions, transmat = self._get_transitions()
+        nseq, maxlen = framelogprob.shape[:2]
+        traceback = np.zeros(framelogprob.shape,
+                             dtype=_index_dtype(self._nstates))
+
+        # Only the current lattice frame of every sequence is kept,
+        # plus the frame at which each sequence ends.
+        frames = np.asarray(self._log_startprob + framelogprob[:,0],
+                            dtype=self._dtype)
+        lastframe = np.empty(frames.shape, dtype=self._dtype)
+        lastframe[lengths == 1] = frames[lengths == 1]
+        for n in xrange(1, maxlen):
+            pruned = self._prune_states_batch(frames, maxrank, beamlogprob)
+            pr, traceback[:,n] = _viterbi_step_batch(log_transitions, pruned)
+            frames = np.asarray(pr + framelogprob[:,n], dtype=self._dtype)
+            lastframe[lengths == n + 1] = frames[lengths == n + 1]
+        lastframe[lastframe <= ZEROLOGPROB] = -np.Inf
+
+        # Do traceback, starting each sequence at its last frame.
+        state_sequence = np.empty((nseq, maxlen), dtype=np.int)
+        s = np.zeros(nseq, dtype=np.int)
+        for n in xrange(maxlen - 1, -1, -1):
+            ends = lengths - 1 == n
+            s[ends] = lastframe[ends].argmax(axis=1)
+            state_sequence[:,n] = s
+            s = traceback[np.arange(nseq),n,s]
+        state_sequence[np.arange(maxlen) >= lengths[:,np.newaxis]] = -1
+
+        return logsum(lastframe, axis=1), state_sequence
+
+    def _do_forward_pass_batch(self, framelogprob, lengths, maxrank=None,
+                               beamlogprob=-np.Inf, fbtype='log'):
+        """Forward pass over a batch of sequences in lockstep.
+
+        See `_do_viterbi_pass_batch` for the arguments.  Returns the
+        log probabilities and the forward lattices (shape (nseq,
+        maxlen, nstates), -inf past the end of each sequence).
+        """
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        lengths = np.asarray(lengths)
+        log_transitions, transmat = self._get_transitions()
+        nseq, maxlen = framelogprob.shape[:2]
+        padding = np.arange(maxlen) >= lengths[:,np.newaxis]
+
+        if _check_fbtype(fbtype) == 'scaled':
+            emissions, emission_scale = _scale_framelogprob(framelogprob)
+            underflow = np.sqrt(np.finfo(self._dtype).tiny)
+            alpha = np.zeros(framelogprob.shape, dtype=self._dtype)
+            logscale = np.zeros((nseq, maxlen))
+
+            frames = np.asarray(self._log_startprob + framelogprob[:,0],
+                                dtype=self._dtype)
+            logscale[:,0] = logsum(frames, axis=1)
+            alpha[:,0] = _exp_normalized(frames, logscale[:,0])
+            for n in xrange(1, maxlen):
+                logalpha = self._prune_states_batch(
+                    _log_nonzero(alpha[:,n-1]), maxrank, beamlogprob)
+                frames = (_scaled_forward_step_batch(transmat,
+                                                     np.exp(logalpha))
+                          * emissions[:,n])
+                scale = frames.sum(axis=1)
+                ok = scale > underflow
+                alpha[ok,n] = frames[ok] / scale[ok][:,np.newaxis]
+                logscale[ok,n] = np.log(scale[ok]) + emission_scale[ok,n]
+                # Recompute frames that underflowed in the log domain.
+                bad = np.flatnonzero(~ok)
+                if len(bad):
+                    frames = (_forward_step_batch(log_transitions,
+                                                  logalpha[bad])
+                              + framelogprob[bad,n])
+                    logscale[bad,n] = logsum(frames, axis=1)
+                    alpha[bad,n] = _exp_normalized(frames, logscale[bad,n])
+            logscale = np.cumsum(logscale, axis=1)
+            fwdlattice = np.asarray(_log_nonzero(alpha)
+                                    + logscale[:,:,np.newaxis],
+                                    dtype=self._dtype)
+        else:
+            fwdlattice = np.zeros(framelogprob.shape, dtype=self._dtype)
+            fwdlattice[:,0] = self._log_startprob + framelogprob[:,0]
+            for n in xrange(1, maxlen):
+                frames = self._prune_states_batch(fwdlattice[:,n-1], maxrank,
+                                                  beamlogprob)
+                fwdlattice[:,n] = (_forward_step_batch(log_transitions, frames)
+                                   + framelogprob[:,n])
+        fwdlattice[fwdlattice <= ZEROLOGPROB] = -np.Inf
+        fwdlattice[padding] = -np.Inf
+
+        return (logsum(fwdlattice[np.arange(nseq), lengths - 1], axis=1),
+                fwdlattice)
+
+    def _do_backward_pass_batch(self, framelogprob, fwdlattice, lengths,
+                                maxrank=None, beamlogprob=-np.Inf,
+                                fbtype='log'):
+        """Backward pass over a batch of sequences in lockstep.
+
+        See `_do_viterbi_pass_batch` for the arguments.  Returns the
+        backward lattices (shape (nseq, maxlen, nstates), -inf past
+        the end of each sequence).
+        """
+        framelogprob = np.asarray(framelogprob, dtype=self._dtype)
+        lengths = np.asarray(lengths)
+        log_transitions, transmat = self._get_transitions()
+        nseq, maxlen = framelogprob.shape[:2]
+        padding = np.arange(maxlen) >= lengths[:,np.newaxis]
+
+        if _check_fbtype(fbtype) == 'scaled':
+            emissions, emission_scale = _scale_framelogprob(framelogprob)
+            underflow = np.sqrt(np.finfo(self._dtype).tiny)
+            beta = np.ones(framelogprob.shape, dtype=self._dtype)
+            logscale = np.zeros((nseq, maxlen))
+            for n in xrange(maxlen - 1, 0, -1):
+                # Same HTK style pruning as `_do_backward_pass`.
+                logbeta = _log_nonzero(beta[:,n])
+                active = np.isfinite(self._prune_states_batch(
+                    logbeta + logscale[:,n][:,np.newaxis] + fwdlattice[:,n],
+                    None, BACKWARD_BEAMLOGPROB))
+                frames = _scaled_backward_step_batch(
+                    transmat, np.where(active, beta[:,n] * emissions[:,n], 0))
+                scale = frames.max(axis=1)
+                ok = (scale > underflow) & (n < lengths)
+                beta[ok,n-1] = frames[ok] / scale[ok][:,np.newaxis]
+                logscale[ok,n-1] = (logscale[ok,n] + np.log(scale[ok])
+                                    + emission_scale[ok,n])
+                # Recompute frames that underflowed in the log domain.
+                bad = np.flatnonzero((scale <= underflow) & (n < lengths))
+                if len(bad):
+                    frames = _backward_step_batch(
+                        log_transitions,
+                        np.where(active[bad], logbeta[bad]
+                                 + framelogprob[bad,n], -np.Inf))
+                    scale = frames.max(axis=1)
+                    beta[bad,n-1] = _exp_normalized(frames, scale)
+                    logscale[bad,n-1] = logscale[bad,n] + scale
+            bwdlattice = np.asarray(_log_nonzero(beta)
+                                    + logscale[:,:,np.newaxis],
+                                    dtype=self._dtype)
+        else:
+            bwdlattice = np.zeros(framelogprob.shape, dtype=self._dtype)
+            for n in xrange(maxlen - 1, 0, -1):
+                # Same HTK style pruning as `_do_backward_pass`.
+                active = np.isfinite(self._prune_states_batch(
+                    bwdlattice[:,n] + fwdlattice[:,n], None,
+                    BACKWARD_BEAMLOGPROB))
+                frames = np.where(active, bwdlattice[:,n] + framelogprob[:,n],
+                                  -np.Inf)
+                # Sequences shorter than n+1 frames have not started yet.
+                bwdlattice[:,n-1] = np.where((n < lengths)[:,np.newaxis],
+                                             _backward_step_batch(
+                                                 log_transitions, frames),
+                                             0)
         bwdlattice[bwdlattice <= ZEROLOGPROB] = -np.Inf
+        bwdlattice[padding] = -np.Inf
 
         return bwdlattice
 
+    def _check_pruning(self, stats, logprob, maxrank, beamlogprob,
+                       target_active, unpruned):
+        """Let `stats` compare `logprob` with the log probability
+        returned by `unpruned()`, which repeats the pass without
+        pruning, if it samples this sequence."""
+        if stats is None:
+            return
+        if not maxrank and beamlogprob == -np.Inf and not target_active:
+            unpruned = lambda: logprob
+        stats._check(logprob, unpruned)
+
+    def _prune_states_batch(self, lattice_frames, maxrank, beamlogprob):
+        """Rank and beam pruning for every row of `lattice_frames`.
+
+        Returns `lattice_frames` with the pruned states set to -inf.
+        """
+        if not maxrank and beamlogprob == -np.Inf:
+            return lattice_frames
+        threshlogprob = lattice_frames.max(axis=1) + beamlogprob
+        if maxrank and maxrank < self._nstates:
+            rankthresh = np.partition(lattice_frames, -maxrank,
+                                      axis=1)[:,-maxrank]
+            threshlogprob = np.maximum(threshlogprob, rankthresh)
+        return np.where(lattice_frames >= threshlogprob[:,np.newaxis],
+                        lattice_frames, -np.Inf)
+
+    def _get_transitions(self):
+        """Return the transition structures used by the lattice passes.
+
+        Returns the log transition probabilities (a dense array, or
+        the arc lists built by `_sparse_transitions` if the transition
+        matrix is sparse) and the transition probabilities (a dense
+        array or a CSR matrix), both in `dtype`.  They are cached
+        until `_log_transmat` is reassigned.
+        """
+        cache = getattr(self, '_transitions_cache', None)
+        if (cache is None or cache[0] is not self._log_transmat
+            or cache[1] != self._dtype):
+            if sp.sparse.issparse(self._log_transmat):
+                log_transitions = _sparse_transitions(self._log_transmat,
+                                                      self._dtype)
+                transmat = log_transitions['transmat']
+            else:
+                log_transitions = np.asarray(self._log_transmat,
+                                             dtype=self._dtype)
+                transmat = np.exp(log_transitions)
+            cache = self._transitions_cache = (self._log_transmat, self._dtype,
+                                               log_transitions, transmat)
+        return cache[2], cache[3]
+
     def _prune_states(self, lattice_frame, maxrank, beamlogprob):
         """ Returns indices of the active states in `lattice_frame`
-        after rank and beam pruning.
+        after rank and beam pruning, in increasing order.
+
+        Rank pruning keeps the `maxrank` most likely states, which
+        are found by linear-time selection.  Beam pruning keeps the
+        states within `beamlogprob` of the most likely state.  The
+        step functions gather only the rows (or columns) of the
+        transition matrix that belong to the returned states.
         """
-        # Beam pruning
-        threshlogprob = logsum(lattice_frame) + beamlogprob
-        
+        nstates = len(lattice_frame)
+
         # Rank pruning
-        if maxrank:
-            # How big should our rank pruning histogram be?
-            nbins = 3 * len(lattice_frame)
+        if maxrank and maxrank < nstates:
+            state_idx = np.argpartition(lattice_frame, -maxrank)[-maxrank:]
+            state_idx.sort()
+        else:
+            state_idx = np.arange(nstates)
 
-            lattice_min = lattice_frame[lattice_frame > ZEROLOGPROB].min() - 1
-            hst, cdf = np.histogram(lattice_frame, bins=nbins, new=True,
-                                    range=(lattice_min, lattice_frame.max()))
-        
-            # Want to look at the high ranks.
-            hst = hst[::-1].cumsum()
-            cdf = cdf[::-1]
-
-            rankthresh = cdf[hst >= min(maxrank, self._nstates)].max()
-      
-            # Only change the threshold if it is stricter than the beam
-            # threshold.
-            threshlogprob = max(threshlogprob, rankthresh)
-    
-        # Which states are active?
-        state_idx, = np.nonzero(lattice_frame >= threshlogprob)
+        # Beam pruning
+        if beamlogprob > -np.Inf:
+            frame = lattice_frame[state_idx]
+            state_idx = state_idx[frame >= frame.max() + beamlogprob]
         return state_idx
 
+    def _prune_states_adaptive(self, lattice_frame, maxrank, beamlogprob,
+                               target_active):
+        """`_prune_states` with beam adaptation.
+
+        Returns the active states in `lattice_frame` and the beam
+        width for the next frame, adapted towards `target_active`
+        active states unless `target_active` is None.  To keep the
+        cost of every frame close to the budget, between
+        `target_active` / 2 and 2 * `target_active` states are kept
+        active whatever the beam (and at most `maxrank`).
+        """
+        if not target_active:
+            return self._prune_states(lattice_frame, maxrank,
+                                      beamlogprob), beamlogprob
+        maxactive = 2 * target_active
+        if maxrank:
+            maxactive = min(maxactive, maxrank)
+        idx = self._prune_states(lattice_frame, maxactive, beamlogprob)
+        minactive = min(max(target_active // 2, 1), maxactive)
+        if len(idx) < minactive:
+            idx = self._prune_states(lattice_frame, minactive, -np.Inf)
+        beamlogprob = _adapt_beam(lattice_frame, beamlogprob, target_active)
+        return idx, beamlogprob
+
+    # Version of the emission parameters, used by FrameLogProbCache.
+    # None (the default) disables the cache; subclasses that call
+    # `_bump_emission_version` whenever they reassign their emission
+    # parameters enable it.
+    _emission_version = None
+
+    def _bump_emission_version(self):
+        """Record that the emission parameters were reassigned.
+
+        The versions come from a counter shared by all models, so two
+        models only have the same version if one is a copy of the
+        other with unchanged emission parameters.  Worker processes
+        receive pickled copies and never bump them, so they agree
+        with their parent.
+        """
+        self._emission_version = _emission_versions.next()
+
     @abc.abstractmethod
     def _compute_log_likelihood(self, obs):
         pass
@@ -454,7 +1616,7 @@ class _BaseHMM(GenerativeModel):
     def _init(self, obs, params, **kwargs):
         if 's' in params:
             self.startprob[:] = 1.0 / self._nstates
-        if 't' in params:
+        if 't' in params and not sp.sparse.issparse(self._log_transmat):
             self.transmat[:] = 1.0 / self._nstates
 
 
@@ -474,10 +1636,12 @@ class GaussianHMM(_BaseHMM):
         Dimensionality of the Gaussian components.
     nstates : int (read-only)
         Number of states in the model.
-    transmat : array, shape (`nstates`, `nstates`)
+    transmat : array or sparse matrix, shape (`nstates`, `nstates`)
         Matrix of transition probabilities between states.
     startprob : array, shape ('nstates`,)
         Initial state occupation distribution.
+    dtype : numpy dtype (read-only)
+        Floating point type used to evaluate the model.
     means : array, shape (`nstates`, `ndim`)
         Mean parameters for each state.
     covars : array
@@ -518,7 +1682,8 @@ class GaussianHMM(_BaseHMM):
     def __init__(self, nstates=1, ndim=1, cvtype='diag',
                  startprob=None, transmat=None, labels=None,
                  means=None, covars=None,
-                 trainer=hmm_trainers.GaussianHMMBaumWelchTrainer()):
+                 trainer=hmm_trainers.GaussianHMMBaumWelchTrainer(),
+                 dtype=np.float64):
         """Create a hidden Markov model with Gaussian emissions.
 
         Initializes parameters such that every state has zero mean and
@@ -534,9 +1699,15 @@ class GaussianHMM(_BaseHMM):
             String describing the type of covariance parameters to
             use.  Must be one of 'spherical', 'tied', 'diag', 'full'.
             Defaults to 'diag'.
+        dtype : numpy dtype (read-only)
+            Floating point type used to evaluate the emission
+            likelihoods and the forward, backward and Viterbi
+            lattices.  Use numpy.float32 to halve their memory use for
+            bulk scoring.  Parameters are always estimated in double
+            precision.  Defaults to numpy.float64.
         """
         super(GaussianHMM, self).__init__(nstates, startprob,
-                                          transmat, labels, trainer)
+                                          transmat, labels, trainer, dtype)
 
         self._ndim = ndim
         self._cvtype = cvtype
@@ -577,6 +1748,7 @@ class GaussianHMM(_BaseHMM):
         if means.shape != (self._nstates, self._ndim):
             raise ValueError, 'means must have shape (nstates, ndim)'
         self._means = means.copy()
+        self._bump_emission_version()
 
     @property
     def covars(self):
@@ -588,9 +1760,11 @@ class GaussianHMM(_BaseHMM):
         covars = np.asarray(covars)
         _validate_covars(covars, self._cvtype, self._nstates, self._ndim)
         self._covars = covars.copy()
+        self._cv_chol = None
+        self._bump_emission_version()
 
     def _compute_log_likelihood(self, obs):
-        return lmvnpdf(obs, self._means, self._covars, self._cvtype)
+        return _model_lmvnpdf(self, obs)
 
     def _generate_sample_from_state(self, state):
         if self._cvtype == 'tied':
@@ -611,7 +1785,534 @@ class GaussianHMM(_BaseHMM):
                 cv.shape = (1, 1)
             self._covars = _distribute_covar_matrix_to_match_cvtype(
                 cv, self._cvtype, self._nstates)
+            self._cv_chol = None
+        if 'm' in params or 'c' in params:
+            self._bump_emission_version()
 
 
 class GMMHMM(_BaseHMM):
     emission_type = 'gmm'
+
+
+class StreamingViterbiDecoder(object):
+    """Viterbi decoder for observation streams of unbounded length.
+
+    Frames are passed to `decode` as they arrive.  Only the current
+    frame of the Viterbi lattice and the backpointers of the frames
+    that are still undecided are kept.  A frame is decided, and its
+    state returned, as soon as the best paths into all surviving
+    states agree on it (convergence-point traceback).  The
+    concatenated output of `decode` and `finish` is the state
+    sequence that `_BaseHMM.decode` returns for the whole stream.
+
+    If `maxdelay` is given, at most `maxdelay` frames are kept
+    undecided: older frames are decided along the currently best
+    path, and surviving states that disagree with that decision are
+    pruned.  This bounds memory and latency on streams whose paths
+    do not converge, at the cost of possibly suboptimal decisions.
+
+    Use `_BaseHMM.streaming_decoder` to create one.
+    """
+
+    def __init__(self, hmm, maxrank=None, beamlogprob=-np.Inf,
+                 maxdelay=None, target_active=None):
+        if maxdelay is not None and maxdelay < 1:
+            raise ValueError, 'maxdelay must be at least 1'
+        self._hmm = hmm
+        self.maxrank = maxrank
+        self.beamlogprob = beamlogprob
+        self.maxdelay = maxdelay
+        self.target_active = target_active
+        self.reset()
+
+    @property
+    def nframes(self):
+        """Number of frames received so far."""
+        return self._nframes
+
+    @property
+    def ndecided(self):
+        """Number of frames whose state has been returned."""
+        return self._ndecided
+
+    def reset(self):
+        """Forget the stream decoded so far."""
+        self._frame = None
+        self._beamlogprob = self.beamlogprob
+        # self._traceback[k] holds the backpointers from frame
+        # ndecided + k + 1 to frame ndecided + k.
+        self._traceback = []
+        self._nframes = 0
+        self._ndecided = 0
+
+    def decode(self, obs):
+        """Add frames to the stream.
+
+        Parameters
+        ----------
+        obs : array_like, shape (n, ndim) or (ndim,)
+            New frames, or a single new frame.
+
+        Returns
+        -------
+        components : array_like
+            States of the frames that were decided by the new frames,
+            in order.  May be empty.
+        """
+        obs = np.asarray(obs)
+        if obs.ndim == 1:
+            obs = obs[np.newaxis]
+        framelogprob = np.asarray(self._hmm._compute_log_likelihood(obs),
+                                  dtype=self._hmm._dtype)
+        log_transitions, transmat = self._hmm._get_transitions()
+
+        decided = []
+        for flp in framelogprob:
+            if self._frame is None:
+                frame = self._hmm._log_startprob + flp
+            else:
+                idx, self._beamlogprob = self._hmm._prune_states_adaptive(
+                    self._frame, self.maxrank, self._beamlogprob,
+                    self.target_active)
+                pr, backpointers = _viterbi_step(log_transitions, self._frame,
+                                                 idx)
+                frame = pr + flp
+                if self._ndecided < self._nframes:
+                    self._traceback.append(backpointers.astype(
+                        _index_dtype(self._hmm._nstates)))
+            frame = np.asarray(frame, dtype=self._hmm._dtype)
+            frame[frame <= ZEROLOGPROB] = -np.Inf
+            self._frame = frame
+            self._nframes += 1
+            decided.extend(self._partial_traceback())
+        return np.array(decided, dtype=np.int)
+
+    def finish(self):
+        """End the stream.
+
+        Decides the remaining frames along the best path and resets
+        the decoder.
+
+        Returns
+        -------
+        viterbi_logprob : float
+            Log probability of the maximum likelihood path through
+            the HMM, as returned by `_BaseHMM.decode`.
+        components : array_like
+            States of the remaining frames.
+        """
+        if self._frame is None:
+            raise ValueError, 'no frames to decode'
+        logprob = logsum(self._frame)
+        states = []
+        if self._ndecided < self._nframes:
+            states = self._traceback_from(self._frame.argmax(),
+                                          len(self._traceback))
+        self.reset()
+        return logprob, np.array(states, dtype=np.int)
+
+    def _partial_traceback(self):
+        """Return the states of the frames that have become decided."""
+        states = np.flatnonzero(self._frame > -np.Inf)
+        if len(states) == 0:
+            states = np.arange(len(self._frame))
+        k = len(self._traceback)
+        while len(states) > 1 and k > 0:
+            k -= 1
+            states = np.unique(self._traceback[k][states])
+        if len(states) > 1:
+            npending = self._nframes - self._ndecided
+            if self.maxdelay is None or npending <= self.maxdelay:
+                return []
+            # Decide the oldest frames along the best path and prune
+            # the paths that disagree with it.
+            k = npending - self.maxdelay - 1
+            best = self._traceback_from(self._frame.argmax(),
+                                        len(self._traceback))[k]
+            ancestors = np.arange(len(self._frame))
+            for backpointers in reversed(self._traceback[k:]):
+                ancestors = backpointers[ancestors]
+            self._frame[ancestors != best] = -np.Inf
+            states = [best]
+        decided = self._traceback_from(states[0], k)
+        self._traceback = self._traceback[k+1:]
+        self._ndecided += k + 1
+        return decided
+
+    def _traceback_from(self, state, k):
+        """Return the path ending in `state` at frame ndecided + k."""
+        path = [state]
+        for backpointers in reversed(self._traceback[:k]):
+            path.append(backpointers[path[-1]])
+        path.reverse()
+        return path
+
+
+class ForwardFilter(object):
+    """Online state estimation for observation streams.
+
+    Holds the forward probabilities of the frames received so far,
+    so every new frame passed to `update` costs one step of the
+    forward algorithm (O(nstates**2), or O(nnz) for sparse
+    transition matrices) however long the stream is.  The forward
+    probabilities are kept normalized and the log likelihood of the
+    stream is accumulated separately.
+
+    If `lag` is positive, the last `lag` + 1 frames are kept so
+    that `smooth` can compute fixed-lag smoothed posteriors.
+
+    Use `_BaseHMM.forward_filter` to create one.
+    """
+
+    def __init__(self, hmm, maxrank=None, beamlogprob=-np.Inf, lag=0,
+                 target_active=None):
+        if lag < 0:
+            raise ValueError, 'lag must be non-negative'
+        self._hmm = hmm
+        self.maxrank = maxrank
+        self.beamlogprob = beamlogprob
+        self.lag = lag
+        self.target_active = target_active
+        self.reset()
+
+    @property
+    def nframes(self):
+        """Number of frames received so far."""
+        return self._nframes
+
+    @property
+    def logprob(self):
+        """Log probability of the frames received so far."""
+        return self._logprob
+
+    @property
+    def posteriors(self):
+        """Filtered posterior probabilities of each state at the last
+        frame, p(state_t | obs_1, ..., obs_t)."""
+        if self._frame is None:
+            return self._hmm.startprob
+        return np.exp(self._frame)
+
+    def reset(self):
+        """Forget the stream filtered so far."""
+        self._frame = None
+        self._beamlogprob = self.beamlogprob
+        self._logprob = 0.0
+        self._nframes = 0
+        # (normalized forward frame, frame log likelihoods) of the
+        # last lag + 1 frames.
+        self._window = []
+
+    def update(self, obs):
+        """Add frames to the stream.
+
+        Parameters
+        ----------
+        obs : array_like, shape (n, ndim) or (ndim,)
+            New frames, or a single new frame.
+
+        Returns
+        -------
+        logprob : array_like, shape (n,)
+            Log probability of the stream after each new frame
+        posteriors : array_like, shape (n, nstates)
+            Filtered posterior probabilities of each state for each
+            new frame
+        """
+        obs = np.asarray(obs)
+        if obs.ndim == 1:
+            obs = obs[np.newaxis]
+        framelogprob = np.asarray(self._hmm._compute_log_likelihood(obs),
+                                  dtype=self._hmm._dtype)
+        log_transitions, transmat = self._hmm._get_transitions()
+
+        logprob = np.empty(len(framelogprob))
+        posteriors = np.empty(framelogprob.shape, dtype=self._hmm._dtype)
+        for n, flp in enumerate(framelogprob):
+            if self._frame is None:
+                frame = self._hmm._log_startprob + flp
+            else:
+                idx, self._beamlogprob = self._hmm._prune_states_adaptive(
+                    self._frame, self.maxrank, self._beamlogprob,
+                    self.target_active)
+                frame = _forward_step(log_transitions, self._frame, idx) + flp
+            frame = np.asarray(frame, dtype=self._hmm._dtype)
+            scale = logsum(frame)
+            self._logprob += scale
+            frame -= scale
+            frame[frame <= ZEROLOGPROB] = -np.Inf
+            self._frame = frame
+            self._nframes += 1
+            if self.lag:
+                self._window.append((frame, flp))
+                del self._window[:-(self.lag + 1)]
+            logprob[n] = self._logprob
+            posteriors[n] = np.exp(frame)
+        return logprob, posteriors
+
+    def smooth(self):
+        """Compute smoothed posteriors of the last frames.
+
+        Returns
+        -------
+        posteriors : array_like, shape (min(lag + 1, nframes), nstates)
+            Posterior probabilities of each state for each of the
+            last `lag` + 1 frames given all frames received so far.
+            The first row is the fixed-lag smoothed estimate
+            p(state_{t-lag} | obs_1, ..., obs_t); the last row equals
+            the filtered `posteriors`.
+        """
+        if not self._window:
+            if self._frame is None:
+                raise ValueError, 'no frames to smooth'
+            return self.posteriors[np.newaxis]
+        log_transitions, transmat = self._hmm._get_transitions()
+        allstates = np.arange(self._hmm._nstates)
+        gamma = np.empty((len(self._window), self._hmm._nstates),
+                         dtype=self._hmm._dtype)
+        bwd = np.zeros(self._hmm._nstates, dtype=self._hmm._dtype)
+        for n in xrange(len(self._window) - 1, -1, -1):
+            frame, flp = self._window[n]
+            gamma[n] = frame + bwd
+            bwd = _backward_step(log_transitions, bwd + flp, allstates)
+        return np.exp(gamma.T - logsum(gamma, axis=1)).T
+
+
+class PruningStats(object):
+    """Statistics on rank and beam pruning in the lattice passes.
+
+    Pass an instance as the `pruning_stats` argument of `eval`,
+    `lpdf`, `decode` or `train` to record, for every forward, backward and
+    Viterbi pass, the number of active states at each step of the
+    recursion and the time taken by the pass.  Statistics accumulate
+    over calls until `reset`.
+
+    Parameters
+    ----------
+    check_every : int
+        If not None, every `check_every`-th sequence is also run
+        without pruning, and the difference between the pruned and
+        unpruned log probabilities is recorded in `logprob_gaps`.
+        Defaults to None (no checks).
+
+    Notes
+    -----
+    Only states with nonzero probability are counted as active, so a
+    count of zero means that no path survived pruning at that frame.
+    The batch methods (`lpdf_batch`, `decode_batch`, and `train`
+    with `batchsize`) do not record statistics.
+    """
+
+    passes = ('forward', 'backward', 'viterbi')
+
+    def __init__(self, check_every=None):
+        self.check_every = check_every
+        self.reset()
+
+    def reset(self):
+        """Discard all recorded statistics."""
+        self._nactive = dict((name, []) for name in self.passes)
+        self._seconds = dict((name, 0.0) for name in self.passes)
+        self._npasses = dict((name, 0) for name in self.passes)
+        self._nsequences = 0
+        self._gaps = []
+
+    @property
+    def logprob_gaps(self):
+        """Pruned minus unpruned log probability of every checked
+        sequence."""
+        return np.array(self._gaps)
+
+    def npasses(self, name):
+        """Number of recorded passes of type `name` ('forward',
+        'backward' or 'viterbi')."""
+        return self._npasses[name]
+
+    def seconds(self, name):
+        """Total time taken by the recorded passes of type `name`."""
+        return self._seconds[name]
+
+    def nactive(self, name):
+        """Number of active states at every step of the recorded
+        passes of type `name`."""
+        if not self._nactive[name]:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(self._nactive[name])
+
+    def histogram(self, name):
+        """Histogram of `nactive(name)`: element i is the number of
+        steps with i active states."""
+        return np.bincount(self.nactive(name))
+
+    def nempty(self, name):
+        """Number of steps of the recorded passes of type `name` at
+        which no state was active."""
+        return np.sum(self.nactive(name) == 0)
+
+    def summary(self):
+        """Summarize the recorded statistics.
+
+        Returns
+        -------
+        summary : dict
+            Maps every pass type that was recorded to a dict with
+            keys 'npasses', 'nsteps', 'seconds', 'mean_active',
+            'min_active', 'max_active' and 'nempty'.  If any sequence
+            was checked against an unpruned pass, 'logprob_gap' maps
+            to a dict with keys 'nchecked', 'mean' and 'min'.
+        """
+        summary = {}
+        for name in self.passes:
+            if not self._npasses[name]:
+                continue
+            nactive = self.nactive(name)
+            summary[name] = {
+                'npasses': self._npasses[name],
+                'nsteps': len(nactive),
+                'seconds': self._seconds[name],
+                'mean_active': nactive.mean() if len(nactive) else 0.0,
+                'min_active': nactive.min() if len(nactive) else 0,
+                'max_active': nactive.max() if len(nactive) else 0,
+                'nempty': np.sum(nactive == 0)}
+        if self._gaps:
+            summary['logprob_gap'] = {'nchecked': len(self._gaps),
+                                      'mean': np.mean(self._gaps),
+                                      'min': np.min(self._gaps)}
+        return summary
+
+    def merge(self, other):
+        """Add the statistics recorded in `other` to this object."""
+        for name in self.passes:
+            self._nactive[name].extend(other._nactive[name])
+            self._seconds[name] += other._seconds[name]
+            self._npasses[name] += other._npasses[name]
+        self._nsequences += other._nsequences
+        self._gaps.extend(other._gaps)
+
+    def _add_pass(self, name, nactive, seconds):
+        self._nactive[name].append(np.asarray(nactive, dtype=int))
+        self._seconds[name] += seconds
+        self._npasses[name] += 1
+
+    def _check(self, logprob, unpruned):
+        self._nsequences += 1
+        if self.check_every and self._nsequences % self.check_every == 0:
+            self._gaps.append(logprob - unpruned())
+
+
+class FrameLogProbCache(object):
+    """Cache of the frame log likelihoods of observation sequences.
+
+    `HMMTrainer.train` evaluates the emission densities of every
+    sequence in every iteration.  When the emission parameters are
+    not trained (e.g. params='st'), pass an instance as the
+    `framelogprob_cache` argument of `train` to evaluate them only
+    once.  Entries are keyed by the sequence object and are only
+    reused while `_BaseHMM._emission_version` is unchanged, so they
+    are invalidated whenever the emission parameters are reassigned
+    (by the property setters or by a trainer).  Modifying the
+    parameters in place is not detected: reassign them (e.g.
+    ``hmm.means = means``) or call `clear` afterwards.
+
+    Parameters
+    ----------
+    maxbytes : int
+        Maximum memory taken by the cached arrays.  The least recently
+        used arrays are evicted first.  Defaults to 2**28 (256 MB).
+    spilldir : string
+        If not None, evicted arrays are saved to .npy files in this
+        directory and memory-mapped when they are needed again,
+        instead of being discarded.  Defaults to None.
+
+    Attributes
+    ----------
+    nhits : int
+        Number of lookups served from the cache.
+    nmisses : int
+        Number of lookups that evaluated the emission densities.
+    """
+
+    def __init__(self, maxbytes=2**28, spilldir=None):
+        self.maxbytes = maxbytes
+        self.spilldir = spilldir
+        # id(seq) -> [seq, emission version, framelogprob or None,
+        # spill filename or None], least recently used first.
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self.nhits = 0
+        self.nmisses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """Memory taken by the cached arrays that are not spilled."""
+        return self._nbytes
+
+    def get(self, hmm, seq):
+        """Return the frame log likelihoods of `seq` under `hmm`.
+
+        Parameters
+        ----------
+        hmm : HMM object
+        seq : array_like, shape (n, ndim)
+            Observation sequence.  Must be the same object on every
+            call to hit the cache.
+
+        Returns
+        -------
+        framelogprob : array_like, shape (n, nstates)
+        """
+        version = hmm._emission_version
+        if version is None:
+            return hmm._compute_log_likelihood(seq)
+        entry = self._entries.pop(id(seq), None)
+        if entry is not None and entry[0] is seq and entry[1] == version:
+            self.nhits += 1
+            if entry[2] is not None:
+                framelogprob = entry[2]
+            else:
+                framelogprob = np.load(entry[3], mmap_mode='c')
+        else:
+            if entry is not None:
+                self._discard(entry)
+            self.nmisses += 1
+            framelogprob = hmm._compute_log_likelihood(seq)
+            entry = [seq, version, framelogprob, None]
+            self._nbytes += framelogprob.nbytes
+        self._entries[id(seq)] = entry
+        self._evict()
+        return framelogprob
+
+    def clear(self):
+        """Remove all entries and their spill files."""
+        for entry in self._entries.itervalues():
+            self._discard(entry)
+        self._entries.clear()
+
+    def _new(self):
+        """Return an empty cache with the same settings."""
+        return FrameLogProbCache(self.maxbytes, self.spilldir)
+
+    def _discard(self, entry):
+        if entry[2] is not None:
+            self._nbytes -= entry[2].nbytes
+        if entry[3] is not None:
+            os.remove(entry[3])
+
+    def _evict(self):
+        for k, entry in self._entries.items():
+            if self._nbytes <= self.maxbytes:
+                break
+            if entry[2] is None:
+                continue
+            self._nbytes -= entry[2].nbytes
+            if self.spilldir is None:
+                del self._entries[k]
+                continue
+            fd, filename = tempfile.mkstemp(suffix='.npy', dir=self.spilldir)
+            os.close(fd)
+            np.save(filename, entry[2])
+            entry[2] = None
+            entry[3] = filename
@@ -1,11 +1,19 @@
 import abc
+import itertools
 import logging
+import multiprocessing
+import shutil
+import tempfile
 import time
 
 import numpy as np
+import scipy as sp
+import scipy.sparse
 
+import gmm
 import hmm
 from gmm import *
+from gmm import _share_obs, _weighted_scatter
 
 log = logging.getLogger('gm.hmm_trainers')
 
@@ -19,7 +27,9 @@ class HMMTrainer(object):
         pass
 
     def train(self, hmm, obs, iter=10, thresh=1e-2, params='stmpc',
-              maxrank=None, beamlogprob=-np.Inf, **kwargs):
+              maxrank=None, beamlogprob=-np.Inf, fbtype='log', n_jobs=1,
+              checkpoint=False, pruning_stats=None, target_active=None,
+              framelogprob_cache=None, batchsize=None, **kwargs):
         """Estimate model parameters.
 
         Parameters
@@ -46,6 +56,56 @@ class HMMTrainer(object):
             Width of the beam-pruning beam in log-probability units.
             Defaults to -numpy.Inf (no beam pruning).  See The HTK
             Book for more details.
+        fbtype : string
+            Forward-backward implementation to use, 'log' or
+            'scaled'.  Defaults to 'log'.
+        n_jobs : int
+            Number of worker processes to use for the expectation
+            step.  The sequences in `obs` are split into `n_jobs`
+            contiguous shards with about the same number of frames,
+            each worker accumulates the sufficient statistics of its
+            shard, and the results are summed before the maximization
+            step.  The sequences are shared with the workers once
+            through a memory-mapped file; only the model is sent
+            every iteration.  Defaults to 1 (no worker processes).
+        checkpoint : bool or int
+            If true, run checkpointed forward-backward: the forward
+            pass only keeps the forward probabilities at the end of
+            segments of about sqrt(n_i) frames, and the backward pass
+            recomputes the lattices one segment at a time and
+            accumulates the sufficient statistics of each segment
+            directly.  This needs O(sqrt(n_i) * nstates) memory per
+            sequence instead of O(n_i * nstates), for the cost of
+            one extra forward pass.  An int sets the segment length.
+            Checkpointed passes are always carried out in the log
+            domain (`fbtype` is ignored).  Defaults to False.
+        pruning_stats : hmm.PruningStats
+            If not None, record the active states and running time of
+            every lattice pass of the expectation steps in
+            `pruning_stats`.  Defaults to None.
+        target_active : int
+            If not None, adapt the beam width of the forward (or
+            Viterbi) recursion frame by frame so that about
+            `target_active` states stay active, and keep between
+            `target_active` / 2 and 2 * `target_active` states active
+            at every frame.  `beamlogprob` is the initial beam width
+            and `maxrank` stays a hard limit.  Defaults to None.
+        framelogprob_cache : hmm.FrameLogProbCache
+            If not None, look up the frame log likelihoods of every
+            sequence in this cache, so they are only computed again
+            when the emission parameters change.  Use it when the
+            emission parameters are not trained (e.g. params='st').
+            Worker processes use caches of their own with the same
+            settings.  Checkpointed forward-backward does not use
+            the cache.  Defaults to None.
+        batchsize : int
+            If not None, group the sequences into batches of at most
+            `batchsize` sequences of similar length and run the
+            lattice passes of each batch in lockstep, as
+            `lpdf_batch` does.  This is much faster for many short
+            sequences.  Cannot be combined with `checkpoint`,
+            `pruning_stats` or `target_active`.  Defaults to None
+            (one sequence at a time).
 
         Returns
         -------
@@ -61,44 +121,189 @@ class HMMTrainer(object):
         (e.g. based on model adaptation), getting more training data,
         or decreasing `covarprior`.
         """
-        T = time.time()
-        logprob = []
-        for i in xrange(iter):
-            # Expectation step
-            stats = self._initialize_sufficient_statistics(hmm)
-            curr_logprob = 0
-            for seq in obs:
-                framelogprob = hmm._compute_log_likelihood(seq)
-                lpr, fwdlattice = hmm._do_forward_pass(framelogprob, maxrank,
-                                                       beamlogprob)
-                bwdlattice = hmm._do_backward_pass(framelogprob, fwdlattice,
-                                                   maxrank, beamlogprob)
-                gamma = fwdlattice + bwdlattice
-                posteriors = np.exp(gamma.T - logsum(gamma, axis=1)).T
-                curr_logprob += lpr
-                self._accumulate_sufficient_statistics(hmm, stats, seq,
-                                                       framelogprob, posteriors,
-                                                       fwdlattice, bwdlattice,
-                                                       params)
-            logprob.append(curr_logprob)
-
-            currT = time.time()
-            log.info('Iteration %d: log likelihood = %f (took %f seconds).'
-                      % (i, logprob[-1], currT - T))
-            T = currT
-
-            if i > 0:
-                if logprob[-1] < logprob[-2]:
-                    log.warning("Log likelihood decreased at iteration %d.", i)
-                if abs(logprob[-1] - logprob[-2]) < thresh:
-                    log.info('Converged at iteration %d.' % i)
-                    break
-
-            # Maximization step
-            self._do_mstep(hmm, stats, params, **kwargs)
+        if batchsize is not None and (checkpoint or target_active
+                                      or pruning_stats is not None):
+            raise ValueError, ('batchsize cannot be combined with checkpoint, '
+                               'pruning_stats or target_active')
+        pool = None
+        tmpdir = None
+        spilldir = None
+        try:
+            if n_jobs > 1:
+                lengths = np.array([len(seq) for seq in obs])
+                tmpdir = tempfile.mkdtemp(prefix='hmm')
+                worker_cache = None
+                if framelogprob_cache is not None:
+                    worker_cache = framelogprob_cache._new()
+                    if worker_cache.spilldir is not None:
+                        # The worker caches are lost when training
+                        # ends, so their files are removed as well.
+                        spilldir = tempfile.mkdtemp(
+                            prefix='hmm', dir=worker_cache.spilldir)
+                        worker_cache.spilldir = spilldir
+                pool = multiprocessing.Pool(
+                    n_jobs, _init_estep_worker,
+                    (_share_obs(np.concatenate(obs), tmpdir),
+                     np.cumsum(lengths)[:-1], worker_cache))
+                # Balance the shards by number of frames.
+                cumlengths = np.cumsum(lengths)
+                bounds = np.concatenate((
+                    [0], np.searchsorted(cumlengths,
+                                         cumlengths[-1] * np.arange(1, n_jobs)
+                                         / float(n_jobs)) + 1,
+                    [len(obs)]))
+
+            T = time.time()
+            logprob = []
+            for i in xrange(iter):
+                # Expectation step
+                if pool is None:
+                    curr_logprob, stats = self._compute_sufficient_statistics(
+                        hmm, obs, params, maxrank, beamlogprob, fbtype,
+                        checkpoint, pruning_stats, target_active,
+                        framelogprob_cache, batchsize)
+                else:
+                    # Every worker records its pruning statistics in a
+                    # fresh object that is sent back with its results.
+                    worker_pruning_stats = None
+                    if pruning_stats is not None:
+                        worker_pruning_stats = type(pruning_stats)(
+                            pruning_stats.check_every)
+                    results = pool.map(_estep_worker,
+                                       [(self, hmm, bounds[j], bounds[j+1],
+                                         params, maxrank, beamlogprob, fbtype,
+                                         checkpoint, worker_pruning_stats,
+                                         target_active, batchsize)
+                                        for j in xrange(n_jobs)])
+                    curr_logprob, stats = 0, None
+                    for worker_logprob, worker_stats, worker_pruning_stats \
+                            in results:
+                        curr_logprob += worker_logprob
+                        if stats is None:
+                            stats = worker_stats
+                        else:
+                            _merge_sufficient_statistics(stats, worker_stats)
+                        if pruning_stats is not None:
+                            pruning_stats.merge(worker_pruning_stats)
+                logprob.append(curr_logprob)
+
+                currT = time.time()
+                log.info('Iteration %d: log likelihood = %f (took %f seconds).'
+                          % (i, logprob[-1], currT - T))
+                T = currT
+
+                if i > 0:
+                    if logprob[-1] < logprob[-2]:
+                        log.warning(
+                            "Log likelihood decreased at iteration %d.", i)
+                    if abs(logprob[-1] - logprob[-2]) < thresh:
+                        log.info('Converged at iteration %d.' % i)
+                        break
+
+                # Maximization step
+                self._do_mstep(hmm, stats, params, **kwargs)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir)
+            if spilldir is not None:
+                shutil.rmtree(spilldir)
 
         return logprob
 
+    def _compute_sufficient_statistics(self, hmm, obs, params, maxrank=None,
+                                       beamlogprob=-np.Inf, fbtype='log',
+                                       checkpoint=False, pruning_stats=None,
+                                       target_active=None,
+                                       framelogprob_cache=None,
+                                       batchsize=None):
+        """Run forward-backward on every sequence in `obs`.
+
+        Returns the total log probability of `obs` and the sufficient
+        statistics accumulated over all sequences.
+        """
+        stats = self._initialize_sufficient_statistics(hmm)
+        logprob = 0
+        if batchsize is not None:
+            for batch, framelogprob, lengths in hmm._iter_batches(
+                    obs, batchsize, framelogprob_cache):
+                lpr, fwdlattice = hmm._do_forward_pass_batch(
+                    framelogprob, lengths, maxrank, beamlogprob, fbtype)
+                bwdlattice = hmm._do_backward_pass_batch(
+                    framelogprob, fwdlattice, lengths, maxrank, beamlogprob,
+                    fbtype)
+                logprob += lpr.sum()
+                for i, n, frames, fwd, bwd in itertools.izip(
+                        batch, lengths, framelogprob, fwdlattice, bwdlattice):
+                    self._accumulate_sufficient_statistics(
+                        hmm, stats, obs[i], frames[:n],
+                        _compute_posteriors(fwd[:n], bwd[:n]), fwd[:n],
+                        bwd[:n], params)
+            return logprob, stats
+        for seq in obs:
+            if checkpoint:
+                logprob += self._accumulate_checkpointed_sufficient_statistics(
+                    hmm, stats, seq, params, maxrank, beamlogprob,
+                    None if checkpoint is True else checkpoint, pruning_stats,
+                    target_active)
+                continue
+            framelogprob = _compute_log_likelihood(hmm, seq,
+                                                   framelogprob_cache)
+            lpr, fwdlattice = hmm._do_forward_pass(framelogprob, maxrank,
+                                                   beamlogprob, fbtype,
+                                                   pruning_stats,
+                                                   target_active)
+            hmm._check_pruning(pruning_stats, lpr, maxrank, beamlogprob,
+                               target_active,
+                               lambda: hmm._do_forward_pass(framelogprob)[0])
+            bwdlattice = hmm._do_backward_pass(framelogprob, fwdlattice,
+                                               maxrank, beamlogprob, fbtype,
+                                               pruning_stats)
+            logprob += lpr
+            self._accumulate_sufficient_statistics(hmm, stats, seq,
+                                                   framelogprob,
+                                                   _compute_posteriors(
+                                                       fwdlattice, bwdlattice),
+                                                   fwdlattice, bwdlattice,
+                                                   params)
+        return logprob, stats
+
+    def _accumulate_checkpointed_sufficient_statistics(self, hmm, stats, seq,
+                                                       params, maxrank,
+                                                       beamlogprob,
+                                                       segmentlen=None,
+                                                       pruning_stats=None,
+                                                       target_active=None):
+        """Accumulate the sufficient statistics of `seq` one segment
+        at a time using checkpointed forward-backward.
+
+        Returns the log probability of `seq`.
+        """
+        nobs = stats['nobs']
+        lpr, bounds, checkpoints = hmm._do_checkpointed_forward_pass(
+            seq, maxrank, beamlogprob, segmentlen, pruning_stats,
+            target_active)
+        hmm._check_pruning(pruning_stats, lpr, maxrank, beamlogprob,
+                           target_active,
+                           lambda: hmm._do_checkpointed_forward_pass(
+                               seq, segmentlen=segmentlen)[0])
+        for start, framelogprob, fwdlattice, bwdlattice in \
+                hmm._iter_checkpointed_lattices(seq, bounds, checkpoints,
+                                                maxrank, beamlogprob,
+                                                pruning_stats, target_active):
+            posteriors = _compute_posteriors(fwdlattice, bwdlattice)
+            if start > 0:
+                # The first frame belongs to the previous segment and
+                # is only included for the transitions into this one.
+                posteriors[0] = 0.0
+            self._accumulate_sufficient_statistics(
+                hmm, stats, seq[start:start+len(framelogprob)], framelogprob,
+                posteriors, fwdlattice, bwdlattice, params)
+        stats['nobs'] = nobs + 1
+        return lpr
+
     @abc.abstractmethod
     def _initialize_sufficient_statistics(self, hmm):
         pass
@@ -123,9 +328,14 @@ class BaseHMMBaumWelchTrainer(HMMTrainer):
     emission_type = None
 
     def _initialize_sufficient_statistics(self, hmm):
+        if sp.sparse.issparse(hmm._log_transmat):
+            trans = _sparse_like(hmm._log_transmat,
+                                 np.zeros(hmm._log_transmat.nnz))
+        else:
+            trans = np.zeros((hmm._nstates, hmm._nstates))
         stats = {'nobs':  0,
                  'start': np.zeros(hmm._nstates),
-                 'trans': np.zeros((hmm._nstates, hmm._nstates))}
+                 'trans': trans}
         return stats
 
     def _accumulate_sufficient_statistics(self, hmm, stats, seq, framelogprob, 
@@ -135,16 +345,25 @@ class BaseHMMBaumWelchTrainer(HMMTrainer):
         if 's' in params:
             stats['start'] += posteriors[0]
         if 't' in params:
-            for t in xrange(len(framelogprob)):
-                zeta = (fwdlattice[t-1][:,np.newaxis] + hmm._log_transmat
-                        + framelogprob[t] + bwdlattice[t])
-                stats['trans'] += np.exp(zeta - logsum(zeta))
+            _add_transition_counts(stats, _compute_expected_transitions(
+                hmm._log_transmat, framelogprob, fwdlattice, bwdlattice))
+
+    def _accumulate_aligned_sufficient_statistics(self, hmm, stats, seq,
+                                                  state_sequence, params):
+        """Counterpart of `_accumulate_sufficient_statistics` for the
+        hard alignment `state_sequence` of `seq` (Viterbi training)."""
+        stats['nobs'] += 1
+        if 's' in params:
+            stats['start'][state_sequence[0]] += 1
+        if 't' in params:
+            _add_transition_counts(stats, _count_transitions(
+                hmm._log_transmat, state_sequence))
 
     def _do_mstep(self, hmm, stats, params, **kwargs):
         if 's' in params:
             hmm.startprob = stats['start'] / stats['start'].sum()
         if 't' in params:
-            hmm.transmat = normalize(stats['trans'], axis=1)
+            hmm.transmat = _normalize_transitions(stats['trans'])
 
 
 class GaussianHMMBaumWelchTrainer(BaseHMMBaumWelchTrainer):
@@ -175,12 +394,38 @@ class GaussianHMMBaumWelchTrainer(BaseHMMBaumWelchTrainer):
         if 'c' in params:
             if hmm._cvtype in ('spherical', 'diag'):
                 stats['obs**2'] += np.dot(posteriors.T, obs**2)
-            elif hmm._cvtype in ('tied', 'full'):  
-                for t, o in enumerate(obs):
-                    obsobsT = np.outer(o, o)
-                    for c in xrange(hmm._nstates):
-                        stats['obs*obs.T'][c] += posteriors[t,c] * obsobsT
-                  
+            elif hmm._cvtype in ('tied', 'full'):
+                stats['obs*obs.T'] += _weighted_scatter(obs, posteriors)
+
+    def _accumulate_aligned_sufficient_statistics(self, hmm, stats, obs,
+                                                  state_sequence, params):
+        super(GaussianHMMBaumWelchTrainer,
+              self)._accumulate_aligned_sufficient_statistics(
+                  hmm, stats, obs, state_sequence, params)
+        if not ('m' in params or 'c' in params):
+            return
+        # Sort the frames by state, so that the frames of every
+        # occupied state form one segment that is summed at once.
+        order = np.argsort(state_sequence, kind='mergesort')
+        sorted_obs = obs[order]
+        sorted_states = state_sequence[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], sorted_states[1:] != sorted_states[:-1])))
+        occupied = sorted_states[starts]
+
+        stats['post'] += np.bincount(state_sequence, minlength=hmm._nstates)
+        stats['obs'][occupied] += np.add.reduceat(sorted_obs, starts, axis=0)
+
+        if 'c' in params:
+            if hmm._cvtype in ('spherical', 'diag'):
+                stats['obs**2'][occupied] += np.add.reduceat(sorted_obs**2,
+                                                             starts, axis=0)
+            elif hmm._cvtype in ('tied', 'full'):
+                stops = np.append(starts[1:], len(sorted_obs))
+                for c, start, stop in itertools.izip(occupied, starts, stops):
+                    o = sorted_obs[start:stop]
+                    stats['obs*obs.T'][c] += np.dot(o.T, o)
+
     def _do_mstep(self, hmm, stats, params, covarprior=1e-2, **kwargs):
         super(GaussianHMMBaumWelchTrainer, self)._do_mstep(hmm, stats, params)
 
@@ -200,19 +445,22 @@ class GaussianHMMBaumWelchTrainer(BaseHMMBaumWelchTrainer):
                 elif hmm._cvtype == 'diag':
                     hmm._covars = cv
             elif hmm._cvtype in ('tied', 'full'):
-                cvnum = np.empty((hmm._nstates, hmm._ndim, hmm._ndim))
                 cvprior = np.eye(hmm._ndim) * covarprior
-                for c in xrange(hmm._nstates):
-                    cvnum[c] = (stats['obs*obs.T'][c]
-                                - 2 * np.outer(stats['obs'][c], hmm._means[c])
-                                + np.outer(hmm._means[c] * stats['post'][c],
-                                           hmm._means[c]))
+                obsmean = (stats['obs'][:,:,np.newaxis]
+                           * hmm._means[:,np.newaxis,:])
+                cvnum = (stats['obs*obs.T']
+                         - obsmean - obsmean.transpose(0, 2, 1)
+                         + _weighted_outer(hmm._means, stats['post']))
                 if hmm._cvtype == 'tied':
                     hmm._covars = ((cvnum.sum(axis=0) + cvprior)
                                    / (1.0 + stats['post'].sum()))
                 elif hmm._cvtype == 'full':
                     hmm._covars = ((cvnum + cvprior)
                                    / (1.0 + stats['post'][:,None,None]))
+            hmm._cv_chol = None
+
+        if 'm' in params or 'c' in params:
+            hmm._bump_emission_version()
 
 
 class GaussianHMMMAPTrainer(GaussianHMMBaumWelchTrainer):
@@ -246,8 +494,18 @@ class GaussianHMMMAPTrainer(GaussianHMMBaumWelchTrainer):
             prior = self.transmat_prior
             if prior is None:
                 prior = 1.0
-            hmm.transmat = normalize(np.maximum(prior - 1.0 + stats['trans'],
-                                                1e-20), axis=1)
+            trans = stats['trans']
+            if sp.sparse.issparse(trans):
+                # Only the existing arcs get prior counts.
+                if np.ndim(prior) == 2:
+                    rows = np.repeat(np.arange(trans.shape[0]),
+                                     np.diff(trans.indptr))
+                    prior = np.asarray(prior[rows, trans.indices]).ravel()
+                trans = _sparse_like(trans, np.maximum(prior - 1.0
+                                                       + trans.data, 1e-20))
+            else:
+                trans = np.maximum(prior - 1.0 + trans, 1e-20)
+            hmm.transmat = _normalize_transitions(trans)
 
         denom = stats['post'][:,np.newaxis]
         if 'm' in params:
@@ -284,13 +542,12 @@ class GaussianHMMMAPTrainer(GaussianHMMBaumWelchTrainer):
                 elif hmm._cvtype == 'diag':
                     hmm._covars = (covars_prior + cv_num) / cv_den
             elif hmm._cvtype in ('tied', 'full'):
-                cvnum = np.empty((hmm._nstates, hmm._ndim, hmm._ndim))
-                for c in xrange(hmm._nstates):
-                    cvnum[c] = (means_weight * np.outer(meandiff[c], meandiff[c])
-                                + stats['obs*obs.T'][c] 
-                                - 2 * np.outer(stats['obs'][c], hmm._means[c])
-                                + np.outer(hmm._means[c], hmm._means[c])
-                                * stats['post'][c])
+                obsmean = (stats['obs'][:,:,np.newaxis]
+                           * hmm._means[:,np.newaxis,:])
+                cvnum = (_weighted_outer(meandiff, means_weight)
+                         + stats['obs*obs.T']
+                         - obsmean - obsmean.transpose(0, 2, 1)
+                         + _weighted_outer(hmm._means, stats['post']))
                 cvweight = max(covars_weight - hmm._ndim, 0)
                 if hmm._cvtype == 'tied':
                     hmm._covars = ((covars_prior + cvnum.sum(axis=0))
@@ -298,5 +555,244 @@ class GaussianHMMMAPTrainer(GaussianHMMBaumWelchTrainer):
                 elif hmm._cvtype == 'full':
                     hmm._covars = ((covars_prior + cvnum)
                                    / (cvweight + stats['post'][:,None,None]))
+            hmm._cv_chol = None
 
- 
+        if 'm' in params or 'c' in params:
+            hmm._bump_emission_version()
+
+
+class ViterbiTrainerMixin(object):
+    """Mixin that turns a Baum-Welch trainer into a Viterbi trainer.
+
+    The expectation step aligns each sequence with the Viterbi
+    algorithm instead of running forward-backward, and accumulates
+    the sufficient statistics directly from this hard alignment
+    (segmental k-means) with `_accumulate_aligned_sufficient_statistics`
+    of the trainer it is mixed into.  The maximization step of that
+    trainer is unchanged.  `train` returns the log probabilities
+    computed by `decode`.
+    """
+
+    def _compute_sufficient_statistics(self, hmm, obs, params, maxrank=None,
+                                       beamlogprob=-np.Inf, fbtype='log',
+                                       checkpoint=False, pruning_stats=None,
+                                       target_active=None,
+                                       framelogprob_cache=None,
+                                       batchsize=None):
+        # Viterbi alignments need the full traceback; `fbtype` and
+        # `checkpoint` do not apply.
+        stats = self._initialize_sufficient_statistics(hmm)
+        logprob = 0
+        if batchsize is not None:
+            for batch, framelogprob, lengths in hmm._iter_batches(
+                    obs, batchsize, framelogprob_cache):
+                lpr, state_sequences = hmm._do_viterbi_pass_batch(
+                    framelogprob, lengths, maxrank, beamlogprob)
+                logprob += lpr.sum()
+                for i, n, state_sequence in itertools.izip(
+                        batch, lengths, state_sequences):
+                    self._accumulate_aligned_sufficient_statistics(
+                        hmm, stats, np.asarray(obs[i]), state_sequence[:n],
+                        params)
+            return logprob, stats
+        for seq in obs:
+            framelogprob = _compute_log_likelihood(hmm, seq,
+                                                   framelogprob_cache)
+            lpr, state_sequence = hmm._do_viterbi_pass(framelogprob, maxrank,
+                                                       beamlogprob,
+                                                       pruning_stats,
+                                                       target_active)
+            hmm._check_pruning(pruning_stats, lpr, maxrank, beamlogprob,
+                               target_active,
+                               lambda: hmm._do_viterbi_pass(framelogprob)[0])
+            logprob += lpr
+            self._accumulate_aligned_sufficient_statistics(
+                hmm, stats, np.asarray(seq), state_sequence, params)
+        return logprob, stats
+
+
+class GaussianHMMViterbiTrainer(ViterbiTrainerMixin,
+                                GaussianHMMBaumWelchTrainer):
+    """Viterbi trainer for HMMs with Gaussian emissions.
+
+    Maximum-likelihood updates from Viterbi alignments.  Takes the
+    same keyword arguments to `train` as GaussianHMMBaumWelchTrainer.
+    """
+    emission_type = 'gaussian'
+
+
+class GaussianHMMViterbiMAPTrainer(ViterbiTrainerMixin, GaussianHMMMAPTrainer):
+    """Viterbi trainer for HMMs with Gaussian emissions based on
+    maximum-a-posteriori (MAP) adaptation.
+
+    MAP updates from Viterbi alignments.  Takes the same priors as
+    GaussianHMMMAPTrainer.
+    """
+    emission_type = 'gaussian'
+
+
+def _merge_sufficient_statistics(stats, other):
+    """Add the sufficient statistics in `other` to `stats`."""
+    for key in stats:
+        if sp.sparse.issparse(stats[key]):
+            # Both have the arcs of the transition matrix.
+            stats[key].data += other[key].data
+        else:
+            stats[key] += other[key]
+
+def _init_estep_worker(obs_args, bounds, framelogprob_cache):
+    global _worker_obs, _worker_framelogprob_cache
+    gmm._init_estep_worker(*obs_args)
+    _worker_obs = np.split(gmm._worker_obs, bounds)
+    _worker_framelogprob_cache = framelogprob_cache
+
+def _estep_worker(args):
+    (trainer, hmm, start, stop, params, maxrank, beamlogprob, fbtype,
+     checkpoint, pruning_stats, target_active, batchsize) = args
+    logprob, stats = trainer._compute_sufficient_statistics(
+        hmm, _worker_obs[start:stop], params, maxrank, beamlogprob, fbtype,
+        checkpoint, pruning_stats, target_active, _worker_framelogprob_cache,
+        batchsize)
+    return logprob, stats, pruning_stats
+
+def _weighted_outer(x, w):
+    """Return the outer products w[c] * outer(x[c], x[c]) of the rows
+    of `x` as an array of shape (len(x), ndim, ndim)."""
+    return (np.asarray(w, dtype=np.float64)[...,np.newaxis,np.newaxis]
+            * x[:,:,np.newaxis] * x[:,np.newaxis,:])
+
+def _add_transition_counts(stats, trans):
+    """Add the transition counts `trans` to stats['trans']."""
+    if sp.sparse.issparse(trans):
+        # Same arcs as stats['trans']; accumulate in place so that arcs
+        # with zero counts are kept.
+        stats['trans'].data += trans.data
+    else:
+        stats['trans'] += trans
+
+def _compute_posteriors(fwdlattice, bwdlattice):
+    """State posteriors of every frame from the forward and backward
+    lattices of a sequence."""
+    gamma = fwdlattice + bwdlattice
+    return np.exp(gamma.T - logsum(gamma, axis=1)).T
+
+def _compute_log_likelihood(hmm, seq, framelogprob_cache):
+    """Frame log likelihoods of `seq`, looked up in
+    `framelogprob_cache` if it is not None."""
+    if framelogprob_cache is None:
+        return hmm._compute_log_likelihood(seq)
+    return framelogprob_cache.get(hmm, seq)
+
+def _compute_expected_transitions(log_transmat, framelogprob, fwdlattice,
+                                  bwdlattice):
+    """Sum the transition posteriors over all frames of a sequence.
+
+    Returns sum_t xi_t, where
+        xi_t(i, j) ~ exp(fwdlattice[t-1,i] + log_transmat[i,j]
+                         + framelogprob[t,j] + bwdlattice[t,j])
+    for t = 1, ..., n-1, normalized to sum to one at every frame
+    (which keeps the counts consistent when the lattices were pruned).
+    """
+    if sp.sparse.issparse(log_transmat):
+        return _compute_sparse_expected_transitions(log_transmat, framelogprob,
+                                                    fwdlattice, bwdlattice)
+    nstates = log_transmat.shape[0]
+    if len(framelogprob) < 2:
+        return np.zeros((nstates, nstates))
+
+    # Work in a scaled probability domain: shift every frame of the
+    # forward and backward terms by its maximum so that the sum over
+    # frames becomes a single matrix product.
+    fwd = np.asarray(fwdlattice[:-1], dtype=np.float64)
+    bwd = np.asarray(framelogprob[1:] + bwdlattice[1:], dtype=np.float64)
+    alpha = np.exp(fwd - fwd.max(axis=1)[:,np.newaxis])
+    beta = np.exp(bwd - bwd.max(axis=1)[:,np.newaxis])
+    transmat = np.exp(log_transmat)
+    norm = np.sum(np.dot(alpha, transmat) * beta, axis=1)
+
+    # Frames whose normalizer underflowed in the scaled domain fall
+    # back to the log domain.
+    scaled = norm > 1e-200
+    alpha = alpha[scaled] / norm[scaled][:,np.newaxis]
+    trans = transmat * np.dot(alpha.T, beta[scaled])
+    for t in np.flatnonzero(~scaled):
+        zeta = fwd[t][:,np.newaxis] + log_transmat + bwd[t]
+        zetasum = logsum(zeta)
+        if zetasum > -np.Inf:
+            trans += np.exp(zeta - zetasum)
+    return trans
+
+
+def _compute_sparse_expected_transitions(log_transmat, framelogprob,
+                                         fwdlattice, bwdlattice):
+    """Counterpart of `_compute_expected_transitions` for a CSR matrix
+    of log transition probabilities.
+
+    Only the arcs of `log_transmat` are visited; the counts are
+    returned as a CSR matrix with the same arcs.
+    """
+    src = np.repeat(np.arange(log_transmat.shape[0]),
+                    np.diff(log_transmat.indptr))
+    dst = log_transmat.indices
+    counts = np.zeros(log_transmat.nnz)
+    if len(framelogprob) < 2:
+        return _sparse_like(log_transmat, counts)
+
+    fwd = np.asarray(fwdlattice[:-1], dtype=np.float64)
+    bwd = np.asarray(framelogprob[1:] + bwdlattice[1:], dtype=np.float64)
+    alpha = np.exp(fwd - fwd.max(axis=1)[:,np.newaxis])
+    beta = np.exp(bwd - bwd.max(axis=1)[:,np.newaxis])
+    transmat = _sparse_like(log_transmat, np.exp(log_transmat.data))
+    norm = np.sum(transmat.T.dot(alpha.T).T * beta, axis=1)
+
+    scaled = norm > 1e-200
+    alpha = alpha[scaled] / norm[scaled][:,np.newaxis]
+    beta = beta[scaled]
+    # Bound the size of the (frames, arcs) temporaries.
+    chunksize = max(1, MAX_CHUNK_NELEMENTS // log_transmat.nnz)
+    for start in xrange(0, len(alpha), chunksize):
+        stop = start + chunksize
+        counts += np.sum(alpha[start:stop,src] * beta[start:stop,dst], axis=0)
+    counts *= transmat.data
+    for t in np.flatnonzero(~scaled):
+        zeta = fwd[t,src] + log_transmat.data + bwd[t,dst]
+        zetasum = logsum(zeta)
+        if zetasum > -np.Inf:
+            counts += np.exp(zeta - zetasum)
+    return _sparse_like(log_transmat, counts)
+
+def _count_transitions(log_transmat, state_sequence):
+    """Count the transitions taken by `state_sequence`.
+
+    Returns a matrix like `log_transmat` (a CSR matrix with the same
+    arcs if it is sparse).
+    """
+    src, dst = state_sequence[:-1], state_sequence[1:]
+    nstates = log_transmat.shape[0]
+    if not sp.sparse.issparse(log_transmat):
+        counts = np.bincount(src * nstates + dst, minlength=nstates**2)
+        return counts.reshape((nstates, nstates)).astype(np.float64)
+    # The arcs of a CSR matrix with sorted indices are sorted by
+    # src * nstates + dst.
+    arcs = (np.repeat(np.arange(nstates), np.diff(log_transmat.indptr))
+            * nstates + log_transmat.indices)
+    counts = np.bincount(np.searchsorted(arcs, src * nstates + dst),
+                         minlength=log_transmat.nnz)
+    return _sparse_like(log_transmat, counts.astype(np.float64))
+
+def _sparse_like(A, data):
+    """Return a CSR matrix with the sparsity structure of `A` and the
+    given `data`, keeping explicit zeros."""
+    return sp.sparse.csr_matrix((data, A.indices.copy(), A.indptr.copy()),
+                                shape=A.shape)
+
+def _normalize_transitions(trans):
+    """Normalize the rows of a (possibly sparse) matrix of transition
+    counts."""
+    if not sp.sparse.issparse(trans):
+        return normalize(trans, axis=1)
+    rowsum = np.asarray(trans.sum(axis=1)).ravel()
+    # Make sure we don't divide by zero.
+    rowsum[rowsum == 0] = 1
+    rows = np.repeat(np.arange(trans.shape[0]), np.diff(trans.indptr))
+    return _sparse_like(trans, trans.data / rowsum[rows])
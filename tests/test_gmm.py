@@ -1,4 +1,7 @@
 import itertools
+import os
+import shutil
+import tempfile
 import unittest
 
 from numpy.testing import *
@@ -17,6 +20,30 @@ def _generate_random_spd_matrix(ndim):
     randspd = np.dot(np.dot(U, 1.0+np.diag(np.random.rand(ndim))), V)
     return randspd
 
+def _covar_mstep_slow(gmm, obs, posteriors, avg_obs, norm, min_covar):
+    """Reference implementation of the covariance M-step."""
+    w = posteriors.sum(axis=0)
+    covars = np.zeros(gmm.covars.shape)
+    for c in xrange(gmm._nstates):
+        mu = gmm._means[c]
+        avg_obs2 = np.zeros((gmm._ndim, gmm._ndim))
+        for t,o in enumerate(obs):
+            avg_obs2 += posteriors[t,c] * np.outer(o, o)
+        cv = (avg_obs2 / w[c]
+              - 2 * np.outer(avg_obs[c] / w[c], mu)
+              + np.outer(mu, mu)
+              + min_covar * np.eye(gmm._ndim))
+        if gmm.cvtype == 'spherical':
+            covars[c] = np.diag(cv).mean()
+        elif gmm.cvtype == 'diag':
+            covars[c] = np.diag(cv)
+        elif gmm.cvtype == 'full':
+            covars[c] = cv
+        elif gmm.cvtype == 'tied':
+            covars += cv / gmm._nstates
+    return covars
+
+
 class TestLogsum(unittest.TestCase):
     def test_logsum_1D(self):
         A = np.random.rand(10) + 1.0
@@ -130,6 +157,13 @@ class TestSampleGaussian(unittest.TestCase):
         assert_array_almost_equal(samples.mean(axis), mu, decimal=1)
         assert_array_almost_equal(np.cov(samples), cv, decimal=1)
 
+    def test_sample_gaussian_random_state(self):
+        mu = np.zeros(3)
+        cv = _generate_random_spd_matrix(3)
+        samples = gmm.sample_gaussian(mu, cv, 'full', 5, random_state=1)
+        assert_array_equal(
+            gmm.sample_gaussian(mu, cv, 'full', 5, random_state=1), samples)
+
     def test_sample_gaussian_full_1D(self):
         self._test_sample_gaussian_full(1)
     def test_sample_gaussian_full_2D(self):
@@ -229,6 +263,51 @@ class TestLmvnpdf(unittest.TestCase):
     def test_lmvnpdftied_with_diagonal_covariance(self):
         self._test_lmvnpdftied_with_diagonal_covariance(5, 10)
 
+    def _slow_lmvnpdffull(self, obs, means, covars):
+        lpr = np.empty((len(obs), len(means)))
+        for c, (mu, cv) in enumerate(itertools.izip(means, covars)):
+            icv = np.linalg.inv(cv)
+            for o, currobs in enumerate(obs):
+                dzm = currobs - mu
+                lpr[o,c] = -0.5 * (len(mu) * np.log(2 * np.pi)
+                                   + np.log(np.linalg.det(cv))
+                                   + np.dot(np.dot(dzm, icv), dzm))
+        return lpr
+
+    def test_lmvnpdffull(self):
+        nstates = 4
+        ndim = 10
+        nobs = 50
+
+        mu = np.random.randint(10) * np.random.rand(nstates, ndim)
+        cv = np.array([_generate_random_spd_matrix(ndim)
+                       for x in xrange(nstates)])
+        obs = np.random.randint(10) * np.random.rand(nobs, ndim)
+
+        reference = self._slow_lmvnpdffull(obs, mu, cv)
+        lpr = gmm.lmvnpdf(obs, mu, cv, 'full')
+        assert_array_almost_equal(lpr, reference)
+
+        cv_chol = gmm.covar_cholesky(cv, 'full')
+        lpr = gmm.lmvnpdf(obs, mu, None, 'full', cv_chol)
+        assert_array_almost_equal(lpr, reference)
+
+    def test_lmvnpdf_single_precision(self):
+        rng = np.random.RandomState(5)
+        nstates, ndim, nobs = 4, 6, 50
+        mu = 10 * rng.rand(nstates, ndim)
+        obs = 10 * rng.rand(nobs, ndim)
+        covars = {'spherical': rng.rand(nstates) + 1.0,
+                  'tied': _generate_random_spd_matrix(ndim),
+                  'diag': rng.rand(nstates, ndim) + 1.0,
+                  'full': np.array([_generate_random_spd_matrix(ndim)
+                                    for x in xrange(nstates)])}
+        for cvtype, cv in covars.iteritems():
+            reference = gmm.lmvnpdf(obs, mu, cv, cvtype)
+            lpr = gmm.lmvnpdf(obs, mu, cv, cvtype, dtype=np.float32)
+            self.assertEqual(lpr.dtype, np.float32)
+            assert_array_almost_equal(lpr, reference, decimal=3)
+
     def test_lmvnpdftied_consistent_with_lmvnpdffull(self):
         nstates = 4
         ndim = 20
@@ -245,6 +324,52 @@ class TestLmvnpdf(unittest.TestCase):
         assert_array_almost_equal(lpr, reference)
 
 
+class TestCovarMstep(unittest.TestCase):
+    nstates = 5
+    ndim = 3
+    nobs = 200
+
+    def _setup_gmm(self, cvtype):
+        rng = np.random.RandomState(0)
+        g = gmm.GMM(self.nstates, self.ndim, cvtype)
+        obs = 10 * rng.rand(self.nobs, self.ndim)
+        posteriors = gmm.normalize(rng.rand(self.nobs, self.nstates), axis=1)
+        avg_obs = np.dot(posteriors.T, obs)
+        norm = 1.0 / posteriors.sum(axis=0)[:,np.newaxis]
+        g.means = avg_obs * norm
+        return g, obs, posteriors, avg_obs, norm
+
+    def _compute_stats(self, g, obs, posteriors):
+        stats = g._initialize_sufficient_statistics()
+        g._accumulate_sufficient_statistics(stats, obs, posteriors, 'wmc')
+        return stats
+
+    def test_covar_mstep_full_consistent_with_slow(self):
+        g, obs, posteriors, avg_obs, norm = self._setup_gmm('full')
+        reference = _covar_mstep_slow(g, obs, posteriors, avg_obs, norm, 0.1)
+        stats = self._compute_stats(g, obs, posteriors)
+        cv = gmm._covar_mstep_full(g, stats, norm, 0.1)
+        assert_array_almost_equal(cv, reference)
+
+    def test_covar_mstep_diag_consistent_with_slow(self):
+        g, obs, posteriors, avg_obs, norm = self._setup_gmm('diag')
+        reference = _covar_mstep_slow(g, obs, posteriors, avg_obs, norm, 0.1)
+        stats = self._compute_stats(g, obs, posteriors)
+        cv = gmm._covar_mstep_diag(g, stats, norm, 0.1)
+        assert_array_almost_equal(cv, reference)
+
+    def test_covar_mstep_tied(self):
+        g, obs, posteriors, avg_obs, norm = self._setup_gmm('tied')
+        reference = np.zeros((self.ndim, self.ndim))
+        for t, o in enumerate(obs):
+            for c, mu in enumerate(g.means):
+                reference += posteriors[t,c] * np.outer(o - mu, o - mu)
+        reference = reference / self.nobs + 0.1 * np.eye(self.ndim)
+        stats = self._compute_stats(g, obs, posteriors)
+        cv = gmm._covar_mstep_tied(g, stats, norm, 0.1)
+        assert_array_almost_equal(cv, reference)
+
+
 class GMMTester():
     nstates = 10
     ndim = 4
@@ -306,6 +431,118 @@ class GMMTester():
         assert_array_almost_equal(posteriors.sum(axis=1), np.ones(nobs))
         assert_array_equal(posteriors.argmax(axis=1), gaussidx)
 
+    def test_eval_after_covars_reassigned(self):
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = self.means
+        obs = np.random.randn(20, self.ndim) + g.means[0]
+
+        ll1 = g.lpdf(obs)
+        g.covars = 2 * self.covars[self.cvtype]
+        ll2 = g.lpdf(obs)
+
+        reference = gmm.logsum(gmm.lmvnpdf(obs, g.means, g.covars, self.cvtype)
+                               + np.log(g.weights), axis=1)
+        assert_array_almost_equal(ll2, reference)
+        self.assertFalse(np.allclose(ll1, ll2))
+
+    def test_eval_single_precision(self):
+        rng = np.random.RandomState(6)
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = self.means
+        g.covars = self.covars[self.cvtype] + 1.0
+        g32 = gmm.GMM(self.nstates, self.ndim, self.cvtype, dtype=np.float32)
+        g32.means = g.means
+        g32.covars = g.covars
+        self.assertEqual(g32.dtype, np.float32)
+
+        obs = self.means[rng.randint(self.nstates, size=50)]
+        obs = obs + rng.randn(50, self.ndim)
+
+        ll, posteriors = g.eval(obs)
+        ll32, posteriors32 = g32.eval(obs)
+        self.assertEqual(ll32.dtype, np.float32)
+        self.assertEqual(posteriors32.dtype, np.float32)
+        assert_array_almost_equal(ll32, ll, decimal=3)
+        assert_array_almost_equal(posteriors32, posteriors, decimal=4)
+
+    def test_lpdf_and_decode_consistent_with_eval(self):
+        rng = np.random.RandomState(9)
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = 2 * self.means
+        g.covars = self.covars[self.cvtype]
+        g.weights = self.weights
+        obs = 2 * self.means[rng.randint(self.nstates, size=50)]
+        obs = obs + 3 * rng.randn(50, self.ndim)
+
+        ll, posteriors = g.eval(obs)
+        assert_array_almost_equal(g.lpdf(obs), ll)
+
+        ll2, components = g.decode(obs)
+        assert_array_almost_equal(ll2, ll)
+        assert_array_equal(components, posteriors.argmax(axis=1))
+
+    def test_eval_pruned(self):
+        rng = np.random.RandomState(10)
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = 20 * self.means
+        g.covars = self.covars[self.cvtype]
+        g.weights = self.weights
+        obs = 20 * self.means[rng.randint(self.nstates, size=50)]
+        obs = obs + rng.randn(50, self.ndim)
+
+        ll, posteriors = g.eval(obs)
+
+        # A single cluster without pruning is exact.
+        ll2, posteriors2 = g.eval_pruned(obs, nclusters=1)
+        assert_array_almost_equal(ll2, ll)
+        assert_array_almost_equal(posteriors2.toarray(), posteriors)
+
+        ll3, posteriors3 = g.eval_pruned(obs, maxrank=2, nclusters=4,
+                                         nselect=2, chunksize=7)
+        self.assertEqual(posteriors3.shape, (len(obs), self.nstates))
+        self.assertTrue(np.all(np.diff(posteriors3.indptr) <= 2))
+        assert_array_almost_equal(posteriors3.sum(axis=1).A1,
+                                  np.ones(len(obs)))
+        assert_array_equal(posteriors3.toarray().argmax(axis=1),
+                           posteriors.argmax(axis=1))
+        self.assertTrue(np.all(ll3 <= ll + 1e-6))
+        assert_array_almost_equal(ll3, ll, decimal=2)
+
+        ll4, posteriors4 = g.eval_pruned(obs, beamlogprob=-1e-6)
+        assert_array_equal(np.diff(posteriors4.indptr), np.ones(len(obs)))
+
+        # The selection index follows covariance-only updates.
+        centroids, cluster_covars, members = g._cached_selection_index(4)
+        g.covars = 4 * np.asarray(self.covars[self.cvtype])
+        centroids2, cluster_covars2, members2 = g._cached_selection_index(4)
+        assert_array_almost_equal(centroids2, centroids)
+        self.assertTrue(np.all(cluster_covars2 > cluster_covars))
+        self.assertTrue(g._cached_selection_index(4)[1] is cluster_covars2)
+
+    def test_eval_chunked(self):
+        rng = np.random.RandomState(8)
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = 20 * self.means
+        g.covars = self.covars[self.cvtype]
+        obs = 20 * self.means[rng.randint(self.nstates, size=50)]
+        obs = obs + rng.randn(50, self.ndim)
+
+        ll, posteriors = g.eval(obs)
+        ll2, posteriors2 = g.eval(obs, chunksize=7)
+        assert_array_almost_equal(ll2, ll)
+        assert_array_almost_equal(posteriors2, posteriors)
+
+        out = np.empty(len(obs))
+        ll3 = g.lpdf(obs, chunksize=7, out=out)
+        self.assertTrue(ll3 is out)
+        assert_array_almost_equal(ll3, ll)
+
+        out = (np.empty(len(obs)), np.empty((len(obs), self.nstates)))
+        ll4, posteriors4 = g.eval(obs, chunksize=11, out=out)
+        self.assertTrue(ll4 is out[0])
+        self.assertTrue(posteriors4 is out[1])
+        assert_array_almost_equal(posteriors4, posteriors)
+
     def test_rvs(self, n=1000):
         g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
         # Make sure the means are far apart so posteriors.argmax()
@@ -317,6 +554,22 @@ class GMMTester():
         samples = g.rvs(n)
         self.assertEquals(samples.shape, (n, self.ndim))
 
+    def test_rvs_random_state(self, n=2000):
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = 20 * self.means
+        g.covars = np.maximum(self.covars[self.cvtype], 0.1)
+        g.weights = self.weights
+
+        samples = g.rvs(n, random_state=0)
+        self.assertEquals(samples.shape, (n, self.ndim))
+        assert_array_equal(g.rvs(n, random_state=0), samples)
+        assert_array_equal(g.rvs(n, np.random.RandomState(0)), samples)
+
+        # Samples should be drawn from the right components.
+        ll, components = g.decode(samples)
+        counts = np.bincount(components, minlength=self.nstates)
+        assert_array_almost_equal(counts / float(n), self.weights, decimal=1)
+
     def test_train(self, params='wmc'):
         g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
         g.weights = self.weights
@@ -339,6 +592,127 @@ class GMMTester():
         self.assertTrue(post_testll >= init_testll)
 
 
+    def _generate_obs(self, rng, n):
+        # Draw from a mixture with well separated means using a local
+        # random state so the global one used by the other tests is
+        # left untouched.
+        gaussidx = rng.randint(self.nstates, size=n)
+        return 20 * self.means[gaussidx] + rng.randn(n, self.ndim)
+
+    def test_train_online(self):
+        rng = np.random.RandomState(1)
+        train_obs = self._generate_obs(rng, 400)
+        test_obs = self._generate_obs(rng, 20)
+
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.means = 20 * self.means + 5 * rng.randn(self.nstates, self.ndim)
+        g.init(train_obs, params='wc')
+        init_testll = g.lpdf(test_obs).sum()
+
+        chunks = (train_obs[x:x+40] for x in xrange(0, len(train_obs), 40))
+        trainll = g.train_online(chunks)
+        self.assertEqual(len(trainll), 10)
+
+        post_testll = g.lpdf(test_obs).sum()
+        self.assertTrue(post_testll >= init_testll)
+
+    def test_train_online_single_chunk_consistent_with_train(self):
+        rng = np.random.RandomState(2)
+        obs = self._generate_obs(rng, 100)
+
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.weights = self.weights
+        g.means = 20 * self.means + rng.randn(self.nstates, self.ndim)
+        g.init(obs, params='c')
+
+        g2 = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g2.weights, g2.means, g2.covars = g.weights, g.means, g.covars
+
+        g.train(obs, iter=1)
+        # The first step of the default schedule has eta = 1.
+        g2.train_online([obs])
+        assert_array_almost_equal(g2.weights, g.weights)
+        assert_array_almost_equal(g2.means, g.means)
+        assert_array_almost_equal(g2.covars, g.covars)
+
+        self.assertRaises(ValueError, g2.train_online, [obs], stepsize=2.0)
+
+    def test_train_online_skips_empty_chunks(self):
+        rng = np.random.RandomState(11)
+        obs = self._generate_obs(rng, 100)
+
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.weights = self.weights
+        g.means = 20 * self.means + rng.randn(self.nstates, self.ndim)
+        g.init(obs, params='c')
+
+        g2 = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g2.weights, g2.means, g2.covars = g.weights, g.means, g.covars
+
+        trainll = g.train_online([obs[:60], obs[60:]])
+        # Empty chunks neither contribute nor advance the step size.
+        trainll2 = g2.train_online([obs[:0], obs[:60], obs[60:60], obs[60:]])
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(g2.weights, g.weights)
+        assert_array_almost_equal(g2.means, g.means)
+        assert_array_almost_equal(g2.covars, g.covars)
+
+
+    def test_train_chunked_memmap_consistent_with_train(self):
+        rng = np.random.RandomState(3)
+        obs = self._generate_obs(rng, 200)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'obs.npy')
+            np.save(filename, obs)
+            mmobs = np.load(filename, mmap_mode='r')
+
+            g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+            g.weights = self.weights
+            g.means = 20 * self.means + rng.randn(self.nstates, self.ndim)
+            g.init(mmobs, params='c', chunksize=30)
+            cv = g.covars
+
+            g.init(obs, params='c')
+            assert_array_almost_equal(g.covars, cv)
+
+            g2 = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+            g2.weights, g2.means, g2.covars = g.weights, g.means, g.covars
+
+            trainll = g.train(obs, iter=5, chunksize=len(obs))
+            trainll2 = g2.train(mmobs, iter=5, chunksize=30)
+            del mmobs
+        finally:
+            shutil.rmtree(tmpdir)
+
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(g2.weights, g.weights)
+        assert_array_almost_equal(g2.means, g.means)
+        assert_array_almost_equal(g2.covars, g.covars)
+
+
+    def test_train_parallel_consistent_with_train(self):
+        rng = np.random.RandomState(4)
+        obs = self._generate_obs(rng, 200)
+
+        g = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g.weights = self.weights
+        g.means = 20 * self.means + rng.randn(self.nstates, self.ndim)
+        g.init(obs, params='c')
+
+        g2 = gmm.GMM(self.nstates, self.ndim, self.cvtype)
+        g2.weights, g2.means, g2.covars = g.weights, g.means, g.covars
+
+        trainll = g.train(obs, iter=5)
+        trainll2 = g2.train(obs, iter=5, n_jobs=3)
+
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(g2.weights, g.weights)
+        assert_array_almost_equal(g2.means, g.means)
+        assert_array_almost_equal(g2.covars, g.covars)
+
+
 class TestGMMWithSphericalCovars(unittest.TestCase, GMMTester):
     cvtype = 'spherical'
 
@@ -1,9 +1,14 @@
+import copy
 import itertools
+import os
+import shutil
+import tempfile
 import unittest
 
 from numpy.testing import *
 import numpy as np
 import scipy as sp
+import scipy.sparse
 import scipy.stats
 
 from test_gmm import _generate_random_spd_matrix
@@ -57,15 +62,125 @@ class TestBaseHMM(unittest.TestCase):
         idx = h._prune_states(lattice_frame, 1, -np.Inf)
         assert_array_equal(idx, [lattice_frame.argmax()])
 
+        rng = np.random.RandomState(22)
+        lattice_frame = rng.permutation(h.nstates)
+        idx = h._prune_states(lattice_frame, 4, -np.Inf)
+        assert_array_equal(idx, np.sort(np.argsort(lattice_frame)[-4:]))
+        idx = h._prune_states(lattice_frame, 4, -2)
+        assert_array_equal(idx, np.sort(np.argsort(lattice_frame)[-3:]))
+
     def test_prune_states_beam(self):
         h = self.StubHMM(10)
         lattice_frame = np.arange(h.nstates)
 
         beamlogprob = -h.nstates / 2
         idx = h._prune_states(lattice_frame, None, beamlogprob)
-        refidx, = np.nonzero(lattice_frame >= -beamlogprob)
+        refidx, = np.nonzero(lattice_frame
+                             >= lattice_frame.max() + beamlogprob)
         assert_array_equal(idx, refidx)
 
+    def test_prune_states_adaptive(self):
+        h = self.StubHMM(10)
+        lattice_frame = np.arange(h.nstates, dtype=float)
+
+        idx, beamlogprob = h._prune_states_adaptive(lattice_frame, None, -4,
+                                                    None)
+        assert_array_equal(idx, range(5, 10))
+        self.assertEqual(beamlogprob, -4)
+        # The beam moves halfway towards the one keeping 3 states.
+        idx, beamlogprob = h._prune_states_adaptive(lattice_frame, None, -4,
+                                                    3)
+        assert_array_equal(idx, range(5, 10))
+        self.assertEqual(beamlogprob, -3)
+        idx, beamlogprob = h._prune_states_adaptive(lattice_frame, None,
+                                                    -np.Inf, 3)
+        assert_array_equal(idx, range(4, 10))
+        self.assertEqual(beamlogprob, -2)
+        # At least target_active / 2 states stay active.
+        idx, beamlogprob = h._prune_states_adaptive(lattice_frame, None, 0,
+                                                    4)
+        assert_array_equal(idx, [8, 9])
+        idx, beamlogprob = h._prune_states_adaptive(lattice_frame, 5,
+                                                    -np.Inf, h.nstates)
+        assert_array_equal(idx, range(5, 10))
+        self.assertEqual(beamlogprob, -np.Inf)
+
+    def test_do_viterbi_pass_compact_traceback(self):
+        self.assertEqual(hmm._index_dtype(256), np.uint8)
+        self.assertEqual(hmm._index_dtype(257), np.uint16)
+        traceback = hmm._ViterbiTraceback(3, 5, pruned=True)
+        traceback.append(np.array([4, 0, 2, 2, 1]), np.array([1, 3]))
+        traceback.append(np.array([3, 1, 1, 3, 0]), np.array([0, 3, 4]))
+        traceback.append(np.array([1, 4, 3, 0, 1]))
+        assert_array_equal(traceback._offsets, [0, 2, 5, 10])
+        self.assertEqual(traceback._backpointers.dtype, np.uint8)
+        assert_array_equal(traceback.backtrack(2), [2, 3, 3, 2])
+        dense = hmm._ViterbiTraceback(3, 5, pruned=False)
+        for backpointers in ([4, 0, 2, 2, 1], [3, 1, 1, 3, 0],
+                             [1, 4, 3, 0, 1]):
+            dense.append(np.array(backpointers))
+        assert_array_equal(dense.backtrack(2), [2, 3, 3, 2])
+        # The flat buffers are not sized for the dense traceback.
+        traceback = hmm._ViterbiTraceback(2000, 1000, pruned=True)
+        self.assertTrue(traceback._states.nbytes
+                        + traceback._backpointers.nbytes < 20000)
+
+        # The traceback only keeps the backpointers of the states that
+        # survive pruning; the best path must not change.
+        rng = np.random.RandomState(25)
+        nstates = 6
+        transmat = rng.rand(nstates, nstates)
+        transmat /= transmat.sum(axis=1)[:,np.newaxis]
+        h = self.StubHMM(nstates, transmat=transmat)
+        framelogprob = np.log(rng.rand(30, nstates))
+        for maxrank, beamlogprob in ((None, -np.Inf), (2, -np.Inf),
+                                     (None, -1.0)):
+            logprob, state_sequence = h._do_viterbi_pass(
+                framelogprob, maxrank, beamlogprob)
+            reflogprob, refstate_sequence = h._do_viterbi_pass_batch(
+                framelogprob[np.newaxis], [len(framelogprob)], maxrank,
+                beamlogprob)
+            self.assertAlmostEqual(logprob, reflogprob[0])
+            assert_array_equal(state_sequence, refstate_sequence[0])
+
+    def test_pruning_stats(self):
+        h = self.StubHMM(3)
+        framelogprob = np.log([[0.5, 0.2, 0.3],
+                               [0.1, 0.8, 0.1],
+                               [0.0, 0.0, 0.0],
+                               [0.3, 0.3, 0.4]])
+        stats = hmm.PruningStats()
+        logprob, fwdlattice = h._do_forward_pass(framelogprob, maxrank=2,
+                                                 stats=stats)
+        h._do_backward_pass(framelogprob, fwdlattice, stats=stats)
+        self.assertEqual(stats.npasses('forward'), 1)
+        self.assertEqual(stats.npasses('backward'), 1)
+        self.assertEqual(stats.npasses('viterbi'), 0)
+        assert_array_equal(stats.nactive('forward'), [2, 2, 0])
+        assert_array_equal(stats.histogram('forward'), [1, 0, 2])
+        self.assertEqual(stats.nempty('forward'), 1)
+        summary = stats.summary()
+        self.assertEqual(sorted(summary), ['backward', 'forward'])
+        self.assertEqual(summary['forward']['nsteps'], 3)
+        self.assertEqual(summary['forward']['max_active'], 2)
+
+        # The unpruned scaled pass counts the same active states.
+        unpruned, scaled = hmm.PruningStats(), hmm.PruningStats()
+        reflogprob, reffwdlattice = h._do_forward_pass(framelogprob[[0, 1, 3]],
+                                                       stats=unpruned)
+        logprob, fwdlattice = h._do_forward_pass(framelogprob[[0, 1, 3]],
+                                                 fbtype='scaled', stats=scaled)
+        assert_array_almost_equal(fwdlattice, reffwdlattice)
+        assert_array_equal(scaled.nactive('forward'),
+                           unpruned.nactive('forward'))
+
+        other = hmm.PruningStats()
+        h._do_viterbi_pass(framelogprob[:2], stats=other)
+        stats.merge(other)
+        assert_array_equal(stats.nactive('viterbi'), [3])
+        stats.reset()
+        self.assertEqual(stats.summary(), {})
+
     def setup_example_hmm(self):
         # Example from http://en.wikipedia.org/wiki/Forward-backward_algorithm
         h = self.StubHMM(2)
@@ -118,6 +233,119 @@ class TestBaseHMM(unittest.TestCase):
                                   [1.0000, 1.0000]])
         assert_array_almost_equal(np.exp(bwdlattice), refbwdlattice, 4)
 
+    def test_do_scaled_forward_backward_pass(self):
+        h, framelogprob = self.setup_example_hmm()
+
+        logprob, fwdlattice = h._do_forward_pass(framelogprob)
+        bwdlattice = h._do_backward_pass(framelogprob, fwdlattice)
+        slogprob, sfwdlattice = h._do_forward_pass(framelogprob,
+                                                   fbtype='scaled')
+        sbwdlattice = h._do_backward_pass(framelogprob, sfwdlattice,
+                                          fbtype='scaled')
+        self.assertAlmostEqual(slogprob, logprob)
+        assert_array_almost_equal(sfwdlattice, fwdlattice)
+        assert_array_almost_equal(sbwdlattice, bwdlattice)
+
+        # Frames that underflow in the scaled domain are handled in
+        # the log domain.  States that are negligible relative to
+        # their frame are zero in the scaled lattices, so compare
+        # posteriors.
+        h.transmat = [[1.0, 0.0], [0.0, 1.0]]
+        framelogprob = framelogprob.copy()
+        framelogprob[1] = [0, -5000]
+        framelogprob[2] = [-2000, 0]
+        logprob, fwdlattice = h._do_forward_pass(framelogprob)
+        bwdlattice = h._do_backward_pass(framelogprob, fwdlattice)
+        slogprob, sfwdlattice = h._do_forward_pass(framelogprob,
+                                                   fbtype='scaled')
+        sbwdlattice = h._do_backward_pass(framelogprob, sfwdlattice,
+                                          fbtype='scaled')
+        self.assertAlmostEqual(slogprob, logprob)
+        assert_array_almost_equal(np.exp(sfwdlattice + sbwdlattice - logprob),
+                                  np.exp(fwdlattice + bwdlattice - logprob))
+
+        self.assertRaises(ValueError, h._do_forward_pass, framelogprob,
+                          fbtype='badfbtype')
+
+    def test_sparse_transmat(self):
+        h, framelogprob = self.setup_example_hmm()
+        h.transmat = [[0.7, 0.3], [0.0, 1.0]]
+        hs = self.StubHMM(2, transmat=sp.sparse.lil_matrix(h.transmat))
+        self.assertTrue(sp.sparse.issparse(hs.transmat))
+        self.assertEqual(hs.transmat.nnz, 3)
+        assert_array_almost_equal(hs.transmat.toarray(), h.transmat)
+        self.assertRaises(ValueError, hs.__setattr__, 'transmat',
+                          sp.sparse.csr_matrix([[0.5, 0.0], [0.0, 1.0]]))
+        self.assertRaises(ValueError, hs.__setattr__, 'transmat',
+                          sp.sparse.eye(3).tocsr())
+
+        for fbtype, beamlogprob in itertools.product(('log', 'scaled'),
+                                                     (-np.Inf, -1.0)):
+            logprob, fwdlattice = h._do_forward_pass(
+                framelogprob, beamlogprob=beamlogprob, fbtype=fbtype)
+            bwdlattice = h._do_backward_pass(framelogprob, fwdlattice,
+                                             fbtype=fbtype)
+            slogprob, sfwdlattice = hs._do_forward_pass(
+                framelogprob, beamlogprob=beamlogprob, fbtype=fbtype)
+            sbwdlattice = hs._do_backward_pass(framelogprob, sfwdlattice,
+                                               fbtype=fbtype)
+            self.assertAlmostEqual(slogprob, logprob)
+            assert_array_almost_equal(sfwdlattice, fwdlattice)
+            assert_array_almost_equal(sbwdlattice, bwdlattice)
+
+            viterbi_ll, stateseq = h._do_viterbi_pass(framelogprob,
+                                                      beamlogprob=beamlogprob)
+            sviterbi_ll, sstateseq = hs._do_viterbi_pass(
+                framelogprob, beamlogprob=beamlogprob)
+            self.assertAlmostEqual(sviterbi_ll, viterbi_ll)
+            assert_array_equal(sstateseq, stateseq)
+
+        trans = hmm.hmm_trainers._compute_expected_transitions(
+            h._log_transmat, framelogprob, fwdlattice, bwdlattice)
+        strans = hmm.hmm_trainers._compute_expected_transitions(
+            hs._log_transmat, framelogprob, fwdlattice, bwdlattice)
+        self.assertTrue(sp.sparse.issparse(strans))
+        assert_array_almost_equal(strans.toarray(), trans)
+
+    def test_do_passes_batch(self):
+        rng = np.random.RandomState(14)
+        nstates = 3
+        transmat = np.triu(rng.rand(nstates, nstates))
+        transmat /= transmat.sum(axis=1)[:,np.newaxis]
+        h = self.StubHMM(nstates, transmat=transmat)
+        hs = self.StubHMM(nstates, transmat=sp.sparse.csr_matrix(transmat))
+
+        lengths = np.array([5, 3, 1, 4])
+        framelogprob = np.zeros((len(lengths), lengths.max(), nstates))
+        for i, n in enumerate(lengths):
+            framelogprob[i,:n] = np.log(rng.rand(n, nstates))
+
+        for model, fbtype, beamlogprob in itertools.product(
+            (h, hs), ('log', 'scaled'), (-np.Inf, -2.0)):
+            logprob, fwdlattice = model._do_forward_pass_batch(
+                framelogprob, lengths, beamlogprob=beamlogprob, fbtype=fbtype)
+            bwdlattice = model._do_backward_pass_batch(
+                framelogprob, fwdlattice, lengths, fbtype=fbtype)
+            viterbi_logprob, state_sequence = model._do_viterbi_pass_batch(
+                framelogprob, lengths, beamlogprob=beamlogprob)
+            for i, n in enumerate(lengths):
+                reflogprob, reffwdlattice = model._do_forward_pass(
+                    framelogprob[i,:n], beamlogprob=beamlogprob,
+                    fbtype=fbtype)
+                refbwdlattice = model._do_backward_pass(
+                    framelogprob[i,:n], reffwdlattice, fbtype=fbtype)
+                self.assertAlmostEqual(logprob[i], reflogprob)
+                assert_array_almost_equal(fwdlattice[i,:n], reffwdlattice)
+                assert_array_almost_equal(bwdlattice[i,:n], refbwdlattice)
+                self.assertTrue(np.all(fwdlattice[i,n:] == -np.Inf))
+
+                refviterbi_logprob, refstate_sequence = \
+                    model._do_viterbi_pass(framelogprob[i,:n],
+                                           beamlogprob=beamlogprob)
+                self.assertAlmostEqual(viterbi_logprob[i], refviterbi_logprob)
+                assert_array_equal(state_sequence[i,:n], refstate_sequence)
+                self.assertTrue(np.all(state_sequence[i,n:] == -1))
+
     def test_do_viterbi_pass(self):
         h, framelogprob = self.setup_example_hmm()
 
@@ -147,6 +375,36 @@ class TestBaseHMM(unittest.TestCase):
                                   [0.8673, 0.1327]])
         assert_array_almost_equal(posteriors, refposteriors, decimal=4)
 
+    def test_compute_expected_transitions(self):
+        h, framelogprob = self.setup_example_hmm()
+        logprob, fwdlattice = h._do_forward_pass(framelogprob)
+        bwdlattice = h._do_backward_pass(framelogprob, fwdlattice)
+
+        reference = np.zeros((h.nstates, h.nstates))
+        for t in xrange(1, len(framelogprob)):
+            zeta = (fwdlattice[t-1][:,np.newaxis] + h._log_transmat
+                    + framelogprob[t] + bwdlattice[t])
+            reference += np.exp(zeta - logprob)
+
+        trans = hmm.hmm_trainers._compute_expected_transitions(
+            h._log_transmat, framelogprob, fwdlattice, bwdlattice)
+        assert_array_almost_equal(trans, reference)
+        self.assertAlmostEqual(trans.sum(), len(framelogprob) - 1)
+
+        # Frames that underflow in the scaled domain are handled in
+        # the log domain.
+        h.transmat = [[1.0, 0.0], [0.0, 1.0]]
+        fwdlattice[1] += [0, -1000]
+        bwdlattice[2] += [-1000, 0]
+        reference = np.zeros((h.nstates, h.nstates))
+        for t in xrange(1, len(framelogprob)):
+            zeta = (fwdlattice[t-1][:,np.newaxis] + h._log_transmat
+                    + framelogprob[t] + bwdlattice[t])
+            reference += np.exp(zeta - hmm.logsum(zeta))
+        trans = hmm.hmm_trainers._compute_expected_transitions(
+            h._log_transmat, framelogprob, fwdlattice, bwdlattice)
+        assert_array_almost_equal(trans, reference)
+
     def test_hmm_eval_consistent_with_gmm(self):
         nstates = 8
         nobs = 10
@@ -231,6 +489,20 @@ class GaussianHMMParams(object):
               'full': np.array([_generate_random_spd_matrix(ndim) + np.eye(ndim)
                                 for x in xrange(nstates)])}
 
+    def _make_hmm(self, **kwargs):
+        """Return a GaussianHMM with the parameters above; `kwargs`
+        are passed on to GaussianHMM and override them."""
+        params = dict(startprob=self.startprob, transmat=self.transmat,
+                      means=self.means, covars=self.covars[self.cvtype])
+        params.update(kwargs)
+        return hmm.GaussianHMM(self.nstates, self.ndim, self.cvtype, **params)
+
+    def _sample_obs(self, h, rng, n):
+        """Return `n` frames of unit-variance noise around the means
+        of randomly chosen states of `h`."""
+        return rng.randn(n, self.ndim) + h.means[rng.randint(self.nstates,
+                                                             size=n)]
+
 
 class GaussianHMMTester(GaussianHMMParams):
     def test_bad_cvtype(self):
@@ -293,6 +565,438 @@ class GaussianHMMTester(GaussianHMMParams):
         viterbi_ll, stateseq = h.decode(obs)
         assert_array_equal(stateseq, gaussidx)
 
+    def test_lpdf_and_decode_batch(self):
+        rng = np.random.RandomState(15)
+        h = self._make_hmm()
+        obs = [self._sample_obs(h, rng, n) for n in (7, 3, 12, 1, 7, 5)]
+
+        reflogprob = [h.lpdf(x) for x in obs]
+        assert_array_almost_equal(h.lpdf_batch(obs), reflogprob)
+        assert_array_almost_equal(h.lpdf_batch(obs, batchsize=2), reflogprob)
+        assert_array_almost_equal(h.lpdf_batch(obs, fbtype='scaled'),
+                                  reflogprob)
+
+        viterbi_logprob, state_sequences = h.decode_batch(obs, batchsize=4)
+        for x, ll, stateseq in zip(obs, viterbi_logprob, state_sequences):
+            refll, refstateseq = h.decode(x)
+            self.assertAlmostEqual(ll, refll)
+            assert_array_equal(stateseq, refstateseq)
+
+    def test_streaming_decoder(self):
+        rng = np.random.RandomState(19)
+        h = self._make_hmm()
+        obs = self._sample_obs(h, rng, 100)
+        refviterbi_ll, refstateseq = h.decode(obs)
+
+        decoder = h.streaming_decoder()
+        stateseq = []
+        for start in xrange(0, len(obs), 7):
+            stateseq.extend(decoder.decode(obs[start:start+7]))
+        # Most frames are decided before the end of the stream.
+        self.assertTrue(decoder.ndecided > len(obs) / 2)
+        viterbi_ll, rest = decoder.finish()
+        stateseq.extend(rest)
+        self.assertAlmostEqual(viterbi_ll, refviterbi_ll)
+        assert_array_equal(stateseq, refstateseq)
+        self.assertEqual(decoder.nframes, 0)
+
+        decoder = h.streaming_decoder(maxdelay=3)
+        stateseq = []
+        for x in obs:
+            stateseq.extend(decoder.decode(x))
+            self.assertTrue(decoder.nframes - decoder.ndecided <= 3)
+        stateseq.extend(decoder.finish()[1])
+        self.assertEqual(len(stateseq), len(obs))
+
+    def test_forward_filter(self):
+        rng = np.random.RandomState(20)
+        h = self._make_hmm()
+        obs = self._sample_obs(h, rng, 30)
+        lag = 4
+
+        f = h.forward_filter(lag=lag)
+        assert_array_almost_equal(f.posteriors, h.startprob)
+        logprob = []
+        posteriors = []
+        for start in xrange(0, len(obs), 7):
+            lp, post = f.update(obs[start:start+7])
+            logprob.extend(lp)
+            posteriors.extend(post)
+            # The first smoothed row is the fixed-lag estimate given
+            # every frame received so far.
+            refposteriors = h.eval(obs[:f.nframes])[1]
+            assert_array_almost_equal(f.smooth()[0],
+                                      refposteriors[max(f.nframes - lag - 1,
+                                                        0)])
+        self.assertEqual(f.nframes, len(obs))
+        self.assertAlmostEqual(f.logprob, h.lpdf(obs))
+        assert_array_almost_equal(logprob, [h.lpdf(obs[:n + 1])
+                                            for n in xrange(len(obs))])
+        fwdlattice = h._do_forward_pass(h._compute_log_likelihood(obs))[1]
+        assert_array_almost_equal(
+            posteriors,
+            np.exp(fwdlattice.T - hmm.logsum(fwdlattice, axis=1)).T)
+        assert_array_almost_equal(f.smooth(), h.eval(obs)[1][-lag - 1:])
+
+        f.reset()
+        lp, post = f.update(obs[0])
+        self.assertAlmostEqual(lp[0], h.lpdf(obs[:1]))
+        assert_array_almost_equal(f.smooth(), post)
+
+    def test_pruning_stats(self):
+        rng = np.random.RandomState(23)
+        h = self._make_hmm()
+        obs = [self._sample_obs(h, rng, n) for n in (20, 12, 7)]
+
+        stats = hmm.PruningStats(check_every=2)
+        for seq in obs:
+            h.eval(seq, maxrank=2, pruning_stats=stats)
+        self.assertEqual(stats.npasses('forward'), 3)
+        self.assertEqual(stats.npasses('backward'), 3)
+        self.assertEqual(len(stats.nactive('forward')), 36)
+        self.assertTrue(np.all(stats.nactive('forward') <= 2))
+        self.assertTrue(stats.seconds('forward') >= 0)
+        self.assertEqual(len(stats.logprob_gaps), 1)
+        self.assertAlmostEqual(stats.logprob_gaps[0],
+                               h.lpdf(obs[1], maxrank=2) - h.lpdf(obs[1]))
+        self.assertTrue(stats.logprob_gaps[0] <= 0)
+
+        stats = hmm.PruningStats(check_every=1)
+        h.decode(obs[0], beamlogprob=-5, pruning_stats=stats)
+        h.lpdf(obs[0], pruning_stats=stats)
+        summary = stats.summary()
+        self.assertEqual(summary['viterbi']['npasses'], 1)
+        self.assertEqual(summary['forward']['min_active'], self.nstates)
+        self.assertEqual(summary['logprob_gap']['nchecked'], 2)
+        self.assertEqual(stats.logprob_gaps[1], 0)
+
+        stats = hmm.PruningStats()
+        h.train(obs, iter=2, maxrank=3, n_jobs=2, pruning_stats=stats)
+        self.assertEqual(stats.npasses('forward'), 2 * len(obs))
+        self.assertEqual(stats.npasses('backward'), 2 * len(obs))
+        self.assertEqual(len(stats.nactive('backward')), 2 * 36)
+
+    def test_target_active(self):
+        rng = np.random.RandomState(24)
+        h = self._make_hmm()
+        obs = [self._sample_obs(h, rng, n) for n in (20, 12)]
+
+        self.assertAlmostEqual(h.lpdf(obs[0], target_active=self.nstates),
+                               h.lpdf(obs[0]))
+        stats = hmm.PruningStats(check_every=1)
+        logprob = h.lpdf(obs[0], target_active=2, pruning_stats=stats)
+        self.assertTrue(logprob <= h.lpdf(obs[0]) + 1e-10)
+        nactive = stats.nactive('forward')
+        self.assertTrue(np.all((nactive >= 1) & (nactive <= 4)))
+
+        logprob, stateseq = h.decode(obs[0], beamlogprob=-2, target_active=2)
+        decoder = h.streaming_decoder(beamlogprob=-2, target_active=2)
+        decoder.decode(obs[0])
+        self.assertAlmostEqual(decoder.finish()[0], logprob)
+
+        h2 = copy.deepcopy(h)
+        trainll = h.train(obs, iter=2, target_active=2)
+        trainll2 = h2.train(obs, iter=2, target_active=2, checkpoint=4)
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(h2.means, h.means)
+
+    def test_framelogprob_cache(self):
+        rng = np.random.RandomState(26)
+        h = self._make_hmm()
+        obs = [self._sample_obs(h, rng, n) for n in (20, 12, 7)]
+
+        h2, h3, h4 = [copy.deepcopy(h) for x in xrange(3)]
+        cache = hmm.FrameLogProbCache()
+        trainll = h.train(obs, iter=3, params='st')
+        trainll2 = h2.train(obs, iter=3, params='st', framelogprob_cache=cache)
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(h2.transmat, h.transmat)
+        self.assertEqual(cache.nmisses, len(obs))
+        self.assertEqual(cache.nhits, 2 * len(obs))
+        self.assertEqual(len(cache), len(obs))
+
+        # Reassigning the emission parameters invalidates the entries.
+        h2.means = h2.means + 1.0
+        assert_array_almost_equal(cache.get(h2, obs[0]),
+                                  h2._compute_log_likelihood(obs[0]))
+        self.assertEqual(cache.nmisses, len(obs) + 1)
+        # Training the means misses in every iteration.
+        h2.train(obs, iter=2, params='m', framelogprob_cache=cache)
+        self.assertEqual(cache.nhits, 2 * len(obs) + 1)
+        self.assertEqual(cache.nmisses, 3 * len(obs))
+
+        # Evicted arrays are spilled to disk and reused from there.
+        spilldir = tempfile.mkdtemp()
+        try:
+            cache = hmm.FrameLogProbCache(maxbytes=1, spilldir=spilldir)
+            trainll3 = h3.train(obs, iter=3, params='st',
+                                framelogprob_cache=cache)
+            assert_array_almost_equal(trainll3, trainll)
+            self.assertEqual(cache.nhits, 2 * len(obs))
+            self.assertEqual(cache.nbytes, 0)
+            self.assertEqual(len(os.listdir(spilldir)), len(obs))
+            cache.clear()
+            self.assertEqual(os.listdir(spilldir), [])
+        finally:
+            shutil.rmtree(spilldir)
+
+        trainll4 = h4.train(obs, iter=3, params='st', n_jobs=2,
+                            framelogprob_cache=hmm.FrameLogProbCache())
+        assert_array_almost_equal(trainll4, trainll)
+        assert_array_almost_equal(h4.transmat, h.transmat)
+
+    def test_emission_version(self):
+        h = self._make_hmm()
+        version = h._emission_version
+        self.assertTrue(version is not None)
+        # Modifying the parameters in place does not change it.
+        h.means[0] += 1
+        self.assertEqual(h._emission_version, version)
+
+        h.means = h.means
+        self.assertNotEqual(h._emission_version, version)
+        version = h._emission_version
+        h.covars = h.covars
+        self.assertNotEqual(h._emission_version, version)
+        h2 = copy.deepcopy(h)
+        self.assertEqual(h2._emission_version, h._emission_version)
+
+        obs = [self._sample_obs(h, np.random.RandomState(27), 10)]
+        version = h._emission_version
+        h.train(obs, iter=1, params='st')
+        self.assertEqual(h._emission_version, version)
+        h.train(obs, iter=1, params='m')
+        self.assertNotEqual(h._emission_version, version)
+        self.assertNotEqual(h._emission_version, h2._emission_version)
+
+    def test_eval_and_decode_single_precision(self):
+        rng = np.random.RandomState(7)
+        h = self._make_hmm()
+        h32 = self._make_hmm(dtype=np.float32)
+        self.assertEqual(h32.dtype, np.float32)
+
+        gaussidx = np.repeat(range(self.nstates), 5)
+        obs = rng.randn(len(gaussidx), self.ndim) + h.means[gaussidx]
+
+        ll, posteriors = h.eval(obs)
+        ll32, posteriors32 = h32.eval(obs)
+        self.assertEqual(posteriors32.dtype, np.float32)
+        self.assertAlmostEqual(ll32, ll, places=2)
+        assert_array_almost_equal(posteriors32, posteriors, decimal=4)
+
+        viterbi_ll, stateseq = h.decode(obs)
+        viterbi_ll32, stateseq32 = h32.decode(obs)
+        assert_array_equal(stateseq32, stateseq)
+
+    def test_eval_and_train_scaled(self):
+        rng = np.random.RandomState(11)
+        h = self._make_hmm()
+        obs = [self._sample_obs(h, rng, 10) for x in xrange(5)]
+
+        ll, posteriors = h.eval(obs[0])
+        sll, sposteriors = h.eval(obs[0], fbtype='scaled')
+        self.assertAlmostEqual(sll, ll)
+        assert_array_almost_equal(sposteriors, posteriors)
+        self.assertAlmostEqual(h.lpdf(obs[0], fbtype='scaled'), ll)
+
+        h2 = copy.deepcopy(h)
+        trainll = h.train(obs, iter=3)
+        strainll = h2.train(obs, iter=3, fbtype='scaled')
+        assert_array_almost_equal(strainll, trainll)
+        assert_array_almost_equal(h2.transmat, h.transmat)
+        assert_array_almost_equal(h2.means, h.means)
+
+    def test_sparse_transmat(self):
+        rng = np.random.RandomState(12)
+        # Left-to-right topology.
+        transmat = hmm.normalize(np.triu(self.transmat), axis=1)
+        h = self._make_hmm(transmat=transmat)
+        hs = copy.deepcopy(h)
+        hs.transmat = sp.sparse.csr_matrix(transmat)
+        gaussidx = np.repeat(range(self.nstates), 2)
+        obs = [rng.randn(len(gaussidx), self.ndim) + h.means[gaussidx]
+               for x in xrange(5)]
+
+        ll, posteriors = h.eval(obs[0])
+        sll, sposteriors = hs.eval(obs[0])
+        self.assertAlmostEqual(sll, ll)
+        assert_array_almost_equal(sposteriors, posteriors)
+
+        viterbi_ll, stateseq = h.decode(obs[0])
+        sviterbi_ll, sstateseq = hs.decode(obs[0])
+        self.assertAlmostEqual(sviterbi_ll, viterbi_ll)
+        assert_array_equal(sstateseq, stateseq)
+
+        trainll = h.train(obs, iter=3)
+        strainll = hs.train(obs, iter=3)
+        assert_array_almost_equal(strainll, trainll)
+        self.assertTrue(sp.sparse.issparse(hs.transmat))
+        assert_array_almost_equal(hs.transmat.toarray(), h.transmat)
+
+    def test_train_parallel_consistent_with_train(self):
+        rng = np.random.RandomState(16)
+        h = self._make_hmm(means=20 * self.means)
+        obs = [self._sample_obs(h, rng, n) for n in (10, 3, 25, 8, 12, 5, 9)]
+
+        h2 = copy.deepcopy(h)
+        trainll = h.train(obs, iter=3)
+        trainll2 = h2.train(obs, iter=3, n_jobs=3)
+
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(h2.startprob, h.startprob)
+        assert_array_almost_equal(h2.transmat, h.transmat)
+        assert_array_almost_equal(h2.means, h.means)
+        assert_array_almost_equal(h2.covars, h.covars)
+
+    def test_train_batched_consistent_with_train(self):
+        rng = np.random.RandomState(29)
+        h = self._make_hmm(means=20 * self.means)
+        obs = [self._sample_obs(h, rng, n) for n in (10, 3, 25, 1, 12, 5, 9)]
+
+        for kwargs in (dict(), dict(fbtype='scaled'), dict(beamlogprob=-10),
+                       dict(params='st',
+                            framelogprob_cache=hmm.FrameLogProbCache())):
+            h1, h2 = copy.deepcopy(h), copy.deepcopy(h)
+            trainll = h1.train(obs, iter=3, **kwargs)
+            trainll2 = h2.train(obs, iter=3, batchsize=3, **kwargs)
+            assert_array_almost_equal(trainll2, trainll)
+            assert_array_almost_equal(h2.startprob, h1.startprob)
+            assert_array_almost_equal(h2.transmat, h1.transmat)
+            assert_array_almost_equal(h2.means, h1.means)
+            assert_array_almost_equal(h2.covars, h1.covars)
+
+        h1, h2 = copy.deepcopy(h), copy.deepcopy(h)
+        trainll = h1.train(obs, iter=3)
+        trainll2 = h2.train(obs, iter=3, batchsize=2, n_jobs=2)
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(h2.means, h1.means)
+
+        h.trainer = hmm.hmm_trainers.GaussianHMMViterbiTrainer()
+        h1, h2 = copy.deepcopy(h), copy.deepcopy(h)
+        trainll = h1.train(obs, iter=3)
+        trainll2 = h2.train(obs, iter=3, batchsize=4)
+        assert_array_almost_equal(trainll2, trainll)
+        assert_array_almost_equal(h2.transmat, h1.transmat)
+        assert_array_almost_equal(h2.means, h1.means)
+        assert_array_almost_equal(h2.covars, h1.covars)
+
+        self.assertRaises(ValueError, h.train, obs, batchsize=2,
+                          checkpoint=True)
+
+    def test_train_checkpointed_consistent_with_train(self):
+        rng = np.random.RandomState(21)
+        h = self._make_hmm(means=20 * self.means)
+        obs = [self._sample_obs(h, rng, n) for n in (30, 1, 17)]
+
+        framelogprob = h._compute_log_likelihood(obs[0])
+        reflogprob, reffwdlattice = h._do_forward_pass(framelogprob,
+                                                       beamlogprob=-10)
+        refbwdlattice = h._do_backward_pass(framelogprob, reffwdlattice)
+        logprob, bounds, checkpoints = h._do_checkpointed_forward_pass(
+            obs[0], beamlogprob=-10, segmentlen=7)
+        self.assertAlmostEqual(logprob, reflogprob)
+        assert_array_equal(bounds, [0, 7, 14, 21, 28, 30])
+        self.assertEqual(len(checkpoints), 4)
+        ends = []
+        for start, flp, fwdlattice, bwdlattice in \
+                h._iter_checkpointed_lattices(obs[0], bounds, checkpoints,
+                                              beamlogprob=-10):
+            stop = start + len(flp)
+            ends.append(stop)
+            assert_array_almost_equal(flp, framelogprob[start:stop])
+            assert_array_almost_equal(fwdlattice, reffwdlattice[start:stop])
+            assert_array_almost_equal(bwdlattice, refbwdlattice[start:stop])
+        assert_array_equal(ends, bounds[:0:-1])
+
+        h2 = copy.deepcopy(h)
+        h3 = copy.deepcopy(h)
+        trainll = h.train(obs, iter=3)
+        trainll2 = h2.train(obs, iter=3, checkpoint=True)
+        trainll3 = h3.train(obs, iter=3, checkpoint=4)
+        for model, ll in ((h2, trainll2), (h3, trainll3)):
+            assert_array_almost_equal(ll, trainll)
+            assert_array_almost_equal(model.startprob, h.startprob)
+            assert_array_almost_equal(model.transmat, h.transmat)
+            assert_array_almost_equal(model.means, h.means)
+            assert_array_almost_equal(model.covars, h.covars)
+
+    def test_accumulate_sufficient_statistics(self):
+        rng = np.random.RandomState(27)
+        h = self._make_hmm()
+        obs = rng.randn(15, self.ndim)
+        posteriors = rng.rand(15, self.nstates)
+        posteriors /= posteriors.sum(axis=1)[:,np.newaxis]
+
+        trainer = hmm.hmm_trainers.GaussianHMMBaumWelchTrainer()
+        stats = trainer._initialize_sufficient_statistics(h)
+        trainer._accumulate_sufficient_statistics(
+            h, stats, obs, h._compute_log_likelihood(obs), posteriors,
+            None, None, 'c')
+        assert_array_almost_equal(stats['post'], posteriors.sum(axis=0))
+        if self.cvtype in ('tied', 'full'):
+            refobsobsT = np.zeros((self.nstates, self.ndim, self.ndim))
+            for t, o in enumerate(obs):
+                for c in xrange(self.nstates):
+                    refobsobsT[c] += posteriors[t,c] * np.outer(o, o)
+            assert_array_almost_equal(stats['obs*obs.T'], refobsobsT)
+
+    def test_accumulate_aligned_sufficient_statistics(self):
+        rng = np.random.RandomState(28)
+        h = self._make_hmm()
+        # The second sequence leaves some states unoccupied.
+        obs = [rng.randn(15, self.ndim), rng.randn(40, self.ndim)]
+        state_sequences = [rng.randint(self.nstates, size=15),
+                           rng.randint(2, size=40) * (self.nstates - 1)]
+
+        # Hard counts match soft counts with one-hot posteriors.
+        trainer = hmm.hmm_trainers.GaussianHMMViterbiTrainer()
+        stats = trainer._initialize_sufficient_statistics(h)
+        refstats = trainer._initialize_sufficient_statistics(h)
+        for x, state_sequence in zip(obs, state_sequences):
+            trainer._accumulate_aligned_sufficient_statistics(
+                h, stats, x, state_sequence, 'stmc')
+            posteriors = np.zeros((len(x), self.nstates))
+            posteriors[np.arange(len(x)), state_sequence] = 1.0
+            trainer._accumulate_sufficient_statistics(
+                h, refstats, x, h._compute_log_likelihood(x), posteriors,
+                None, None, 'mc')
+            refstats['start'][state_sequence[0]] += 1
+            refstats['trans'] += hmm.hmm_trainers._count_transitions(
+                h._log_transmat, state_sequence)
+        self.assertEqual(stats['nobs'], 2)
+        for key in ('start', 'trans', 'post', 'obs', 'obs**2', 'obs*obs.T'):
+            assert_array_almost_equal(stats[key], refstats[key])
+
+    def test_train_viterbi(self):
+        rng = np.random.RandomState(17)
+        gaussidx = np.repeat(range(self.nstates), 3)
+        obs = [rng.randn(len(gaussidx), self.ndim) + 20 * self.means[gaussidx]
+               for x in xrange(4)]
+
+        # The means are far apart, so the Viterbi alignments are
+        # gaussidx and one iteration gives the hard-count estimates.
+        refmeans = np.array([np.mean([x[gaussidx == c] for x in obs],
+                                     axis=0).mean(axis=0)
+                             for c in xrange(self.nstates)])
+        reftransmat = np.zeros((self.nstates, self.nstates))
+        for i, j in zip(gaussidx[:-1], gaussidx[1:]):
+            reftransmat[i,j] += 1
+        reftransmat /= reftransmat.sum(axis=1)[:,np.newaxis]
+        refstartprob = np.zeros(self.nstates)
+        refstartprob[0] = 1.0
+
+        for transmat in (self.transmat, sp.sparse.csr_matrix(self.transmat)):
+            h = self._make_hmm(
+                transmat=transmat, means=20 * self.means,
+                trainer=hmm.hmm_trainers.GaussianHMMViterbiTrainer())
+            h.train(obs, iter=1)
+            assert_array_almost_equal(h.means, refmeans)
+            assert_array_almost_equal(h.startprob, refstartprob)
+            transmat = h.transmat
+            if sp.sparse.issparse(transmat):
+                transmat = transmat.toarray()
+            assert_array_almost_equal(transmat, reftransmat)
+
     def test_rvs(self, n=1000):
         h = hmm.GaussianHMM(self.nstates, self.ndim, self.cvtype)
         # Make sure the means are far apart so posteriors.argmax()
@@ -406,6 +1110,47 @@ class GaussianHMMMAPTrainerTester(GaussianHMMParams):
     def test_train_covars(self):
         self.test_train('c')
 
+    def test_train_viterbi(self):
+        rng = np.random.RandomState(18)
+        covars_weight = 2.0
+        if self.cvtype in ('full', 'tied'):
+            covars_weight += self.ndim
+        trainer = hmm.hmm_trainers.GaussianHMMViterbiMAPTrainer(
+            startprob_prior=10*self.startprob + 2.0,
+            transmat_prior=10*self.transmat + 2.0,
+            means_prior=20 * self.means,
+            means_weight=2.0,
+            covars_prior=self.covars[self.cvtype],
+            covars_weight=covars_weight)
+        h = self._make_hmm(means=20 * self.means + rng.randn(self.nstates,
+                                                             self.ndim),
+                           trainer=trainer)
+        gaussidx = np.repeat(range(self.nstates), 3)
+        obs = [rng.randn(len(gaussidx), self.ndim) + 20 * self.means[gaussidx]
+               for x in xrange(4)]
+
+        init_ll = np.sum([h.decode(x)[0] for x in obs])
+        trainll = h.train(obs, iter=3)
+        self.assertAlmostEqual(trainll[0], init_ll)
+        self.assertTrue(np.sum([h.decode(x)[0] for x in obs]) > init_ll)
+
+    def test_train_sparse_transmat(self):
+        rng = np.random.RandomState(13)
+        transmat = hmm.normalize(np.triu(self.transmat), axis=1)
+        trainer = hmm.hmm_trainers.GaussianHMMMAPTrainer(
+            transmat_prior=10*self.transmat + 2.0)
+        h = self._make_hmm(transmat=sp.sparse.csr_matrix(transmat),
+                           trainer=trainer)
+        gaussidx = np.repeat(range(self.nstates), 2)
+        obs = [rng.randn(len(gaussidx), self.ndim) + h.means[gaussidx]
+               for x in xrange(5)]
+
+        h.train(obs, iter=2, params='t')
+        # Prior counts are only added to the existing arcs.
+        self.assertTrue(sp.sparse.issparse(h.transmat))
+        assert_array_equal(h.transmat.toarray() > 0, transmat > 0)
+        assert_array_almost_equal(h.transmat.sum(axis=1), 1.0)
+
 
 class TestGaussianHMMMAPTrainerWithSphericalCovars(unittest.TestCase,
                                                    GaussianHMMMAPTrainerTester):